@@ -0,0 +1,68 @@
+"""
+    DmimData/categorical.py
+    Dylan H. Ross
+    2021/01/15
+
+    description:
+        Compact categorical encoding of the per-entry metadata (names, adducts, parent drug groups), each column is
+        stored as an array of small integer codes plus a lookup table of the distinct values, so that the strings
+        are only stored once and group-wise operations (counts, splits) work on integers
+"""
+
+
+import re
+
+from numpy import unique, min_scalar_type, bincount
+
+
+# metabolite suffix of the compound names (see build/add_measurement_data.py)
+MET_SUFFIX_PAT = re.compile(r'_met[0-9]{3}$')
+
+
+def encode(values):
+    """
+encode
+    description:
+        encodes an array of values as integer codes into a sorted lookup table of the distinct values
+    parameters:
+        values (numpy.ndarray) -- values to encode
+    returns:
+        codes (numpy.ndarray(uint)) -- index of each value in the lookup table (smallest unsigned dtype that fits)
+        categories (numpy.ndarray) -- lookup table, categories[codes] gives back the values
+"""
+    categories, codes = unique(values, return_inverse=True)
+    return codes.astype(min_scalar_type(max(len(categories) - 1, 0))), categories
+
+
+def parent_groups(name_codes, names):
+    """
+parent_groups
+    description:
+        groups entries by parent drug (metabolites are named after their parent drug with a _metNNN suffix), only
+        the lookup table of names is processed, not every entry
+    parameters:
+        name_codes (numpy.ndarray(uint)) -- encoded names
+        names (numpy.ndarray(str)) -- lookup table of names
+    returns:
+        group_codes (numpy.ndarray(uint)) -- parent drug group of each entry
+        groups (numpy.ndarray(str)) -- lookup table of parent drug names
+"""
+    name_group_codes, groups = encode([MET_SUFFIX_PAT.sub('', name) for name in names])
+    return name_group_codes[name_codes], groups
+
+
+def count_codes(codes, categories, mask=None):
+    """
+count_codes
+    description:
+        counts the entries in each category
+    parameters:
+        codes (numpy.ndarray(uint)) -- encoded values
+        categories (numpy.ndarray) -- lookup table
+        [mask (numpy.ndarray(bool) or None)] -- only count the entries where mask is True [optional, default=None]
+    returns:
+        counts (numpy.ndarray(int)) -- number of entries in each category, same order as the lookup table
+"""
+    if mask is not None:
+        codes = codes[mask]
+    return bincount(codes, minlength=len(categories))
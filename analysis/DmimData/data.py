@@ -8,11 +8,59 @@
 """
 
 
+import os
+
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import StratifiedShuffleSplit
+from sklearn.model_selection import StratifiedShuffleSplit, GroupShuffleSplit
 from numpy import concatenate, percentile, digitize, count_nonzero, array
 
-from DmimData.db_interface import qry_mz, qry_mqn, qry_md3d, qry_combined
+from DmimData.feature_cache import load_feature_table
+from DmimData.shared_arrays import shared_array
+from DmimData.categorical import count_codes
+
+
+# names of the MQNs and MD3Ds in the order they appear in the feature tables ('combined' has the MQNs then the MD3Ds)
+MQN_NAMES = [
+    'c', 'f', 'cl', 'br',
+    'i', 's', 'p', 'an',
+    'cn', 'ao', 'co', 'hac',
+    'hbam', 'hba', 'hbdm',
+    'hbd', 'neg', 'pos',
+    'asb', 'adb', 'atb', 'csb',
+    'cdb', 'ctb', 'rbc',
+    'asv', 'adv', 'atv', 'aqv',
+    'cdv', 'ctv', 'cqv', 'r3',
+    'r4', 'r5', 'r6', 'r7',
+    'r8', 'r9', 'rg10',
+    'afr', 'bfr'
+]
+MD3D_NAMES = [
+    'pmi1', 'pmi2', 'pmi3',
+    'rmd02', 'rmd24', 'rmd46', 'rmd68', 'rmd8p'
+]
+
+
+def feature_names(features, custom_mqns=None, custom_md3ds=None):
+    """
+feature_names
+    description:
+        names of the features in a feature set, in the same order as the columns produced by DMD.featurize(...)
+    parameters:
+        features (str) -- feature set (must be one of 'mz', 'mqn', 'md3d', 'combined', 'custom')
+        custom_mqns (None or list(str)) -- used with 'custom' feature set to determine specific MQNs to include
+        custom_md3ds (None or list(str)) -- used with 'custom' feature set to determine specific MD3Ds to include
+    returns:
+        names (list(str)) -- feature names
+"""
+    if features == 'mz':
+        return ['mz']
+    if features == 'mqn':
+        return list(MQN_NAMES)
+    if features == 'md3d':
+        return list(MD3D_NAMES)
+    if features == 'combined':
+        return MQN_NAMES + MD3D_NAMES
+    return list(custom_mqns) + list(custom_md3ds)
 
 
 class DMD:
@@ -33,8 +81,12 @@ DMD.__init__
             self.db_path_
             self.seed_
         The following instance variables are initialized as None (must be set by calls to other methods):
-            self.name_          (name or annotation -> set by self.featurize(...))
-            self.adduct_        (MS adduct -> set by self.featurize(...))
+            self.name_codes_    (name or annotation, codes into self.names_ -> set by self.featurize(...))
+            self.names_         (lookup table of names -> set by self.featurize(...))
+            self.adduct_codes_  (MS adduct, codes into self.adducts_ -> set by self.featurize(...))
+            self.adducts_       (lookup table of MS adducts -> set by self.featurize(...))
+            self.group_codes_   (parent drug group, codes into self.groups_ -> set by self.featurize(...))
+            self.groups_        (lookup table of parent drugs -> set by self.featurize(...))
             self.met_n_         (metabolite number -> set by self.featurize(...))
             self.mz_            (m/z -> set by self.featurize(...))
             self.n_             (number of entries -> set by self.featurize(...))
@@ -43,6 +95,10 @@ DMD.__init__
             self.X_             (full array of features -> set by self.featurize(...))
             self.y_             (full array of labels -> set by self.featurize(...))
             self.n_features_    (number of features -> set by self.featurize(...))
+            self.features_      (feature set -> set by self.featurize(...))
+            self.custom_mqns_   (MQNs in the 'custom' feature set -> set by self.featurize(...))
+            self.custom_md3ds_  (MD3Ds in the 'custom' feature set -> set by self.featurize(...))
+            self.feature_names_ (names of the features, in column order -> set by self.featurize(...))
             self.X_train_       (training set split of features -> set by self.train_test_split(...))
             self.y_train_       (training set split of labels -> set by self.train_test_split(...))
             self.n_train_       (training set size -> set by self.train_test_split(...)) 
@@ -53,6 +109,7 @@ DMD.__init__
             self.SScaler_       (StandardScaler instance -> set by self.center_and_scale(...))
             self.X_train_ss_    (centered/scaled training set features -> set by self.center_and_scale(...))
             self.X_test_ss_     (centered/scaled test set features -> set by self.center_and_scale(...))
+            self.shared_dir_    (directory of the memory-mapped train/test arrays -> set by self.share_arrays(...))
     parameters:
         db_path (str) -- path to C3S.db database file  
         seed (int) -- pRNG seed to use for any data preparation steps with a stochastic component, stored in the
@@ -64,12 +121,20 @@ DMD.__init__
         # declare instance variables to use later
         self.X_ = None
         self.y_ = None
-        self.name_ = None
-        self.adduct_ = None
+        self.name_codes_ = None
+        self.names_ = None
+        self.adduct_codes_ = None
+        self.adducts_ = None
+        self.group_codes_ = None
+        self.groups_ = None
         self.met_n_ = None
         self.mz_ = None
         self.n_ = None
         self.n_features_ = None
+        self.features_ = None
+        self.custom_mqns_ = None
+        self.custom_md3ds_ = None
+        self.feature_names_ = None
         self.n_parent_ = None
         self.n_metab_ = None
         self.X_train_ = None
@@ -82,6 +147,19 @@ DMD.__init__
         self.SScaler_ = None
         self.X_train_ss_ = None
         self.X_test_ss_ = None
+        self.shared_dir_ = None
+
+
+    @property
+    def name_(self):
+        """ name or annotation of each entry (decoded from self.name_codes_ on access) """
+        return None if self.name_codes_ is None else self.names_[self.name_codes_]
+
+
+    @property
+    def adduct_(self):
+        """ MS adduct of each entry (decoded from self.adduct_codes_ on access) """
+        return None if self.adduct_codes_ is None else self.adducts_[self.adduct_codes_]
 
 
     def mqns_to_indices(self, mqns):
@@ -94,20 +172,7 @@ DMD.mqns_to_indices
     returns:
         mqn_indices (list(int)) -- list of indices for desired MQNs
 """
-        m2i = {
-            'c': 0, 'f': 1, 'cl': 2, 'br': 3, 
-            'i': 4, 's': 5, 'p': 6, 'an': 7,
-            'cn': 8, 'ao': 9, 'co': 10, 'hac': 11,
-            'hbam': 12, 'hba': 13, 'hbdm': 14,
-            'hbd': 15, 'neg': 16, 'pos': 17,
-            'asb': 18, 'adb': 19, 'atb': 20, 'csb': 21,
-            'cdb': 22, 'ctb': 23, 'rbc': 24,
-            'asv': 25, 'adv': 26, 'atv': 27, 'aqv': 28,
-            'cdv': 29, 'ctv': 30, 'cqv': 31, 'r3': 32,
-            'r4': 33, 'r5': 34, 'r6': 35, 'r7': 36,
-            'r8': 37, 'r9': 38, 'rg10': 39, 
-            'afr': 40, 'bfr': 41
-        }
+        m2i = {name: i for i, name in enumerate(MQN_NAMES)}
         return [m2i[_] for _ in mqns]
 
 
@@ -121,10 +186,7 @@ DMD.md3ds_to_indices
     returns:
         md3d_indices (list(int)) -- list of indices for desired MD3Ds
 """
-        m2i = {
-            'pmi1': 0, 'pmi2': 1, 'pmi3': 2,  
-            'rmd02': 3, 'rmd24': 4, 'rmd46': 5, 'rmd68': 6, 'rmd8p': 7
-        }
+        m2i = {name: i for i, name in enumerate(MD3D_NAMES)}
         return [m2i[_] for _ in md3ds]
 
 
@@ -134,16 +196,26 @@ DMD.featurize
     description:
         Generates features for the dataset,
         Sets the following instance variables:
-            self.name_          (name or annotation)
-            self.adduct_        (MS adduct)
+            self.name_codes_    (name or annotation, codes into self.names_)
+            self.names_         (lookup table of names)
+            self.adduct_codes_  (MS adduct, codes into self.adducts_)
+            self.adducts_       (lookup table of MS adducts)
+            self.group_codes_   (parent drug group, codes into self.groups_)
+            self.groups_        (lookup table of parent drugs)
             self.met_n_         (metabolite number)
             self.mz_            (m/z)
             self.n_             (number of entries)
             self.X_             (full array of features)
             self.y_             (full array of labels)
             self.n_features_    (number of features)
+            self.features_, self.custom_mqns_, self.custom_md3ds_ (feature set selection)
+            self.feature_names_ (names of the features, in column order)
             self.n_parent_      (number of parent drugs)
             self.n_metab_       (number of metabolites)
+        The feature tables are loaded through the feature cache (see feature_cache.py), so the DB is only queried
+        once per DB file, the 'custom' feature set is a column selection of the 'combined' feature table, the other
+        feature sets (and all of the other instance variables) are read-only arrays shared with any other DMD that
+        uses the same DB file
     parameters:
         features (str) -- specify the feature set to use (must be one of 'mz', 'mqn', 'md3d', 'combined', 'custom')
         custom_mqns (None or list(str)) -- used with 'custom' feature set to determine specific MQNs to include
@@ -153,14 +225,70 @@ DMD.featurize
         if features not in ['mz', 'mqn', 'md3d', 'combined', 'custom']:
             m = 'DMD: featurize: feature set "{features}" invalid'.format(features=features)
             raise ValueError(m)
-        qry = {
-            'mz': qry_mz,
-            'mqn': qry_mqn,
-            'md3d': qry_md3d,
-            'combined': qry_combined, 
-            'custom': qry_combined
-        }
-        X, y, name, adduct, met_n, mz = qry[features](self.db_path_)
+        table = 'combined' if features == 'custom' else features
+        X, y, name_codes, names, adduct_codes, adducts, group_codes, groups, met_n, mz = \
+            load_feature_table(self.db_path_, table)
+        X = self.select_features(features, X, custom_mqns=custom_mqns, custom_md3ds=custom_md3ds)
+        self.name_codes_, self.names_ = name_codes, names
+        self.adduct_codes_, self.adducts_ = adduct_codes, adducts
+        self.group_codes_, self.groups_ = group_codes, groups
+        self.met_n_ = met_n
+        self.mz_ = mz
+        self.X_ = X
+        self.y_ = y
+        self.n_, self.n_features_ = self.X_.shape
+        self.features_ = features
+        self.custom_mqns_, self.custom_md3ds_ = custom_mqns, custom_md3ds
+        self.feature_names_ = feature_names(features, custom_mqns=custom_mqns, custom_md3ds=custom_md3ds)
+        self.n_parent_ = int(count_nonzero(self.met_n_ == 0))
+        self.n_metab_ = self.n_ - self.n_parent_
+
+
+    def group_counts(self):
+        """
+DMD.group_counts
+    description:
+        counts the parent and metabolite entries for each parent drug group
+
+        ! self.featurize(...) must be called first !
+    returns:
+        groups (numpy.ndarray(str)) -- parent drug names
+        n_parent (numpy.ndarray(int)) -- number of parent entries in each group
+        n_metab (numpy.ndarray(int)) -- number of metabolite entries in each group
+"""
+        is_parent = self.met_n_ == 0
+        return (self.groups_, count_codes(self.group_codes_, self.groups_, mask=is_parent),
+                count_codes(self.group_codes_, self.groups_, mask=~is_parent))
+
+
+    def adduct_counts(self):
+        """
+DMD.adduct_counts
+    description:
+        counts the entries with each MS adduct
+
+        ! self.featurize(...) must be called first !
+    returns:
+        adducts (numpy.ndarray(str)) -- MS adducts
+        counts (numpy.ndarray(int)) -- number of entries with each adduct
+"""
+        return self.adducts_, count_codes(self.adduct_codes_, self.adducts_)
+
+
+    def select_features(self, features, X, custom_mqns=None, custom_md3ds=None):
+        """
+DMD.select_features
+    description:
+        Produces the features for a feature set from the features of its feature table (the 'custom' feature set
+        comes from the 'combined' feature table, the others come from the feature table with the same name)
+    parameters:
+        features (str) -- feature set (must be one of 'mz', 'mqn', 'md3d', 'combined', 'custom')
+        X (numpy.ndarray) -- features from the feature table (see db_interface.py)
+        custom_mqns (None or list(str)) -- used with 'custom' feature set to determine specific MQNs to include
+        custom_md3ds (None or list(str)) -- used with 'custom' feature set to determine specific MD3Ds to include
+    returns:
+        X (numpy.ndarray) -- features, shape: (n, n_features)
+"""
         # further processing required for 'mz' and 'custom' feature sets
         if features == 'mz':
             X = X.reshape(-1, 1)
@@ -171,23 +299,44 @@ DMD.featurize
                 raise ValueError(m)
             mqn_indices = self.mqns_to_indices(custom_mqns)
             md3d_indices = self.md3ds_to_indices(custom_md3ds)
-            # shift md3d indices by 42 since they are added at the end 
-            md3d_indices = [i + 42 for i in md3d_indices]
+            # shift md3d indices since they are added at the end
+            md3d_indices = [i + len(MQN_NAMES) for i in md3d_indices]
             all_indices = mqn_indices + md3d_indices
             # keep only the desired indices
-            X = array([_[all_indices] for _ in X])
-        self.name_ = name
-        self.adduct_ = adduct
-        self.met_n_ = met_n
-        self.mz_ = mz
-        self.X_ = X
-        self.y_ = y
-        self.n_, self.n_features_ = self.X_.shape
-        self.n_parent_ = len([_ for _ in self.met_n_ if _ == 0])
-        self.n_metab_ = self.n_ - self.n_parent_
+            X = X.take(all_indices, axis=1)
+        return X
 
 
-    def train_test_split(self, test_frac=0.2):
+    def split_indices(self, test_frac=0.2, stratify='ccs'):
+        """
+DMD.split_indices
+    description:
+        Shuffles the entries and splits them into a training set and a test set (see self.train_test_split(...)),
+        only the labels and metadata are used, not the features. Sets the following instance variables:
+            self.SSSplit_       (StratifiedShuffleSplit or GroupShuffleSplit instance)
+    parameters:
+        [test_frac (float)] -- fraction of the complete dataset to reserve as a test set [optional, default=0.2]
+        [stratify (str)] -- 'ccs', 'adduct' or 'group' [optional, default='ccs']
+    returns:
+        train_index, test_index (numpy.ndarray(int), numpy.ndarray(int)) -- indices of the training/test set entries
+"""
+        if stratify not in ['ccs', 'adduct', 'group']:
+            raise ValueError('DMD: split_indices: stratify "{}" invalid'.format(stratify))
+        if stratify != 'ccs' and self.group_codes_ is None:
+            msg = 'DMD: split_indices: stratify="{}" requires the categorical metadata (self.adduct_codes_, ' + \
+                  'self.group_codes_)'
+            raise RuntimeError(msg.format(stratify))
+        # the splitters only use the number of entries from the features
+        n_entries = self.y_.reshape(-1, 1)
+        if stratify == 'group':
+            self.SSSplit_ = GroupShuffleSplit(n_splits=1, test_size=test_frac, random_state=self.seed_)
+            return next(self.SSSplit_.split(n_entries, groups=self.group_codes_))
+        y_cat = self.get_categorical_y() if stratify == 'ccs' else self.adduct_codes_
+        self.SSSplit_ = StratifiedShuffleSplit(n_splits=1, test_size=test_frac, random_state=self.seed_)
+        return next(self.SSSplit_.split(n_entries, y_cat))
+
+
+    def train_test_split(self, test_frac=0.2, stratify='ccs'):
         """
 DMD.train_test_split
     description:
@@ -197,6 +346,8 @@ DMD.train_test_split
         binned into a rough histogram (8 bins) and the train/test sets are split such that they each contain similar 
         proportions of this roughly binned CCS distribution. In the latter case, the train/test sets are split such
         that they each preserve the rough proportions of all dataset sources present in the complete dataset.
+        The split can also be stratified by MS adduct, or done group-wise by parent drug so that each parent drug
+        and all of its metabolites end up in the same set (test_frac is then the fraction of parent drug groups).
         This method DOES NOT get called on DMD objects in the self.datasets_ instance variable.
 
         Sets the following instance variables:
@@ -206,25 +357,24 @@ DMD.train_test_split
             self.X_test_        (test set split of features)
             self.y_test_        (test set split of labels)
             self.n_test_        (test set size)
-            self.SSSplit_       (StratifiedShuffleSplit instance)
+            self.SSSplit_       (StratifiedShuffleSplit or GroupShuffleSplit instance)
 
         ! self.featurize(...) must be called first to generate the features and labels (self.X_, self.y_) !
     parameters:
         [test_frac (float)] -- fraction of the complete dataset to reserve as a test set, defaults to an 80 % / 20 %
                                split for the train / test sets, respectively [optional, default=0.2]
+        [stratify (str)] -- stratify the split by binned CCS ('ccs'), by MS adduct ('adduct') or split by parent
+                            drug group ('group') [optional, default='ccs']
 """
         # make sure self.featurize(...) has been called
         if self.X_ is None:
             msg = 'DMD: train_test_split: self.X_ is not initialized, self.featurize(...) must be called before ' + \
                     'calling self.train_test_split(...)'
             raise RuntimeError(msg)
-        y_cat = self.get_categorical_y()
-        # initialize StratifiedShuffleSplit
-        self.SSSplit_ = StratifiedShuffleSplit(n_splits=1, test_size=test_frac, random_state=self.seed_)
+        train_index, test_index = self.split_indices(test_frac=test_frac, stratify=stratify)
         # split and store the X and y train/test sets as instance variables
-        for train_index, test_index in self.SSSplit_.split(self.X_, y_cat):
-            self.X_train_, self.X_test_ = self.X_[train_index], self.X_[test_index]
-            self.y_train_, self.y_test_ = self.y_[train_index], self.y_[test_index]
+        self.X_train_, self.X_test_ = self.X_[train_index], self.X_[test_index]
+        self.y_train_, self.y_test_ = self.y_[train_index], self.y_[test_index]
         # store the size of the train/test sets in instance variables
         self.n_train_ = self.X_train_.shape[0] 
         self.n_test_ = self.X_test_.shape[0] 
@@ -286,8 +436,31 @@ DMD.center_and_scale
         self.X_test_ss_ = self.SScaler_.transform(self.X_test_)
 
 
+    def share_arrays(self, shared_dir=None):
+        """
+DMD.share_arrays
+    description:
+        Replaces the train/test set features and labels with read-only memory-mapped arrays (see shared_arrays.py)
+        so that they are shared by worker processes instead of copied to each of them, e.g. when they are passed to
+        GridSearchCV(n_jobs=-1). The contents of the arrays do not change.
 
+        replaces the following instance variables with memory-mapped arrays:
+            self.X_train_, self.y_train_, self.X_test_, self.y_test_
+            self.X_train_ss_, self.X_test_ss_
 
+        sets the following instance variables:
+            self.shared_dir_    (directory of the memory-mapped arrays)
 
-
-
+        ! self.center_and_scale(...) must be called first to generate the centered/scaled training and testing
+        features (self.X_train_ss_, self.X_test_ss_) !
+    parameters:
+        [shared_dir (str or None)] -- directory to store the arrays in, None to use a temporary directory that is
+                                      removed when the process exits [optional, default=None]
+"""
+        if self.X_train_ss_ is None:
+            msg = 'DMD: share_arrays: self.X_train_ss_ is not initialized, self.center_and_scale(...) must be ' + \
+                  'called before calling self.share_arrays(...)'
+            raise RuntimeError(msg)
+        for name in ['X_train_', 'y_train_', 'X_test_', 'y_test_', 'X_train_ss_', 'X_test_ss_']:
+            setattr(self, name, shared_array(getattr(self, name), name.rstrip('_'), shared_dir=shared_dir))
+        self.shared_dir_ = os.path.dirname(self.X_train_ss_.filename)
@@ -4,13 +4,160 @@
     2021/01/15
     
     description:
-        Functions for getting data from the DMIM_v?.?.db SQLite3 database 
+        Functions for getting data from the DMIM_v?.?.db SQLite3 database, either the complete result set of a
+        feature table query at once (qry_mz, qry_mqn, qry_md3d, qry_combined) or in chunks (iter_qry)
 
 """
 
 
 from sqlite3 import connect
-from numpy import array
+from numpy import array, frombuffer, concatenate
+
+
+# MQNs are stored as 42 little-endian uint16 per row (see build/add_mqns.py)
+N_MQNS = 42
+MQNS_DTYPE = '<u2'
+
+
+def mqns_to_array(blobs):
+    """
+mqns_to_array
+    description:
+        decodes the packed MQNs from a whole result set in a single call
+    parameters:
+        blobs (list(bytes)) -- packed MQNs, one per row
+    returns:
+        mqn (numpy.ndarray(int)) -- MQNs, shape: (len(blobs), 42)
+"""
+    return frombuffer(b''.join(blobs), dtype=MQNS_DTYPE).reshape(len(blobs), N_MQNS).astype(int)
+
+
+def _columns(rows, n_cols):
+    """ transposes a result set into a list of columns """
+    return list(zip(*rows)) if rows else [() for _ in range(n_cols)]
+
+
+# queries for each feature table, the feature columns come first followed by ccs, name/annotation, adduct, met_n, mz
+SQL_MZ = """
+    SELECT
+        mz, ccs_avg, name, adduct, met_n, mz
+    FROM
+        dmim
+    ORDER BY
+        plate, dmim_id
+;"""
+
+SQL_MQN = """
+    SELECT
+        mqns, ccs_avg, annotation, adduct, met_n, mz
+    FROM
+        dmim_mqn
+        JOIN dmim_ann
+            ON dmim_mqn.ann_id = dmim_ann.ann_id
+        JOIN dmim
+            ON dmim_ann.dmim_id = dmim.dmim_id
+    ORDER BY
+        plate, dmim_mqn.ann_id
+;"""
+
+SQL_MD3D = """
+    SELECT
+        pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p, ccs_avg, annotation, adduct, met_n, mz
+    FROM
+        dmim_md3d
+        JOIN dmim_3d
+            ON dmim_md3d.str_id = dmim_3d.str_id
+        JOIN dmim_ann
+            ON dmim_3d.ann_id = dmim_ann.ann_id
+        JOIN dmim
+            ON dmim_ann.dmim_id = dmim.dmim_id
+    ORDER BY
+        plate, dmim_md3d.str_id
+;"""
+
+SQL_COMBINED = """
+    SELECT
+        mqns, pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p, ccs_avg, annotation, adduct, met_n, mz
+    FROM
+        dmim_md3d
+        JOIN dmim_3d
+            ON dmim_md3d.str_id = dmim_3d.str_id
+        JOIN dmim_ann
+            ON dmim_3d.ann_id = dmim_ann.ann_id
+        JOIN dmim_mqn
+            ON dmim_ann.ann_id = dmim_mqn.ann_id
+        JOIN dmim
+            ON dmim_ann.dmim_id = dmim.dmim_id
+    ORDER BY
+        plate, dmim_md3d.str_id
+;"""
+
+# query and number of feature columns for each feature table
+FEATURE_SQL = {
+    'mz': (SQL_MZ, 1),
+    'mqn': (SQL_MQN, 1),
+    'md3d': (SQL_MD3D, 8),
+    'combined': (SQL_COMBINED, 9),
+}
+
+
+def rows_to_arrays(table, rows):
+    """
+rows_to_arrays
+    description:
+        converts rows from one of the feature table queries into arrays
+    parameters:
+        table (str) -- feature table (must be one of 'mz', 'mqn', 'md3d', 'combined')
+        rows (list(tuple)) -- rows returned by the query in FEATURE_SQL[table]
+    returns:
+        X, ccs, name, adduct, met_n, mz (numpy.ndarray) -- features (shape (n,) for 'mz') and labels/metadata
+"""
+    n_x = FEATURE_SQL[table][1]
+    cols = _columns(rows, n_x + 5)
+    x, (ccs, name, adduct, met_n, mz) = cols[:n_x], cols[n_x:]
+    if table == 'mz':
+        X = array(x[0], dtype=float)
+    elif table == 'mqn':
+        X = mqns_to_array(x[0])
+    elif table == 'md3d':
+        X = array(x, dtype=float).reshape(8, -1).T.copy()
+    else:
+        # combine mqn and md3d into single vector
+        X = concatenate([mqns_to_array(x[0]), array(x[1:], dtype=float).reshape(8, -1).T], axis=1)
+    return X, array(ccs, dtype=float), array(name, dtype=str), array(adduct, dtype=str), array(met_n, dtype=int), \
+        array(mz, dtype=float)
+
+
+def _qry_table(db_path, table):
+    """ runs one of the feature table queries and returns the result set as arrays """
+    con = connect(db_path)
+    rows = con.execute(FEATURE_SQL[table][0]).fetchall()
+    con.close()
+    return rows_to_arrays(table, rows)
+
+
+def iter_qry(db_path, table, chunk_size=10000):
+    """
+iter_qry
+    description:
+        streams one of the feature table queries, converting chunk_size rows at a time into arrays so that the
+        complete result set never has to fit in memory
+    parameters:
+        db_path (str) -- path to DMIM_v?.?.db database file
+        table (str) -- feature table (must be one of 'mz', 'mqn', 'md3d', 'combined')
+        [chunk_size (int)] -- number of rows per chunk [optional, default=10000]
+    yields:
+        X, ccs, name, adduct, met_n, mz (numpy.ndarray) -- same as rows_to_arrays, for each chunk
+"""
+    con = connect(db_path)
+    try:
+        cur = con.execute(FEATURE_SQL[table][0])
+        rows = cur.fetchmany(chunk_size)
+        while rows:
+            yield rows_to_arrays(table, rows)
+            rows = cur.fetchmany(chunk_size)
+    finally:
+        con.close()
 
 
 def qry_mz(db_path):
@@ -23,29 +170,7 @@ qry_mz
     returns:
         mz, ccs, name, adduct, met_n (numpy.ndarray(float, float, str, str, int))
 """
-    con = connect(db_path)
-    cur = con.cursor()
-    # define the query
-    qry = """
-        SELECT
-            mz, ccs_avg, name, adduct, met_n
-        FROM
-            plate_{n}
-    ;"""
-    # accumulate values
-    mz, ccs, name, adduct, met_n = [], [], [], [], []
-    # iterate through all of the plates
-    for n in range(1, 8):
-        # fetch data from the database
-        for mz_, ccs_, name_, adduct_, met_n_ in cur.execute(qry.format(n=n)):
-            mz.append(float(mz_))
-            ccs.append(float(ccs_))
-            name.append(name_)
-            adduct.append(adduct_)
-            met_n.append(int(met_n_))
-    # close the database and return the data as np.ndarrays
-    con.close()
-    return array(mz), array(ccs), array(name), array(adduct), array(met_n), array(mz)
+    return _qry_table(db_path, 'mz')
 
 
 def qry_mqn(db_path):
@@ -58,34 +183,7 @@ qry_mqn
     returns:
         mqn, ccs, annotation, adduct, met_n (numpy.ndarray((int,), float, str, str, int))
 """
-    con = connect(db_path)
-    cur = con.cursor()
-    # define the query
-    qry = """
-        SELECT
-            mqns, ccs_avg, annotation, adduct, met_n, mz
-        FROM
-            plate_{n}_mqn
-            JOIN plate_{n}_id
-                ON plate_{n}_mqn.ann_id = plate_{n}_id.ann_id
-            JOIN plate_{n}
-                ON plate_{n}_id.dmim_id = plate_{n}.dmim_id
-    ;"""
-    # accumulate values
-    mqn, ccs, annotation, adduct, met_n, mz = [], [], [], [], [], []
-    # iterate through all of the plates
-    for n in range(1, 8):
-        # fetch data from the database
-        for mqn_, ccs_, annotation_, adduct_, met_n_, mz_ in cur.execute(qry.format(n=n)):
-            mqn.append([int(_) for _ in mqn_.split()])
-            ccs.append(float(ccs_))
-            annotation.append(annotation_)
-            adduct.append(adduct_)
-            met_n.append(int(met_n_))
-            mz.append(float(mz_))
-    # close the database and return the data as np.ndarrays
-    con.close()
-    return array(mqn), array(ccs), array(annotation), array(adduct), array(met_n), array(mz)
+    return _qry_table(db_path, 'mqn')
 
 
 def qry_md3d(db_path):
@@ -98,36 +196,7 @@ qry_md3d
     returns:
         md3d, ccs, annotation, adduct, met_n (numpy.ndarray((float,), float, str, str, int))
 """
-    con = connect(db_path)
-    cur = con.cursor()
-    # define the query
-    qry = """
-        SELECT
-            pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p, ccs_avg, annotation, adduct, met_n, mz
-        FROM
-            plate_{n}_md3d
-            JOIN plate_{n}_3d
-                ON plate_{n}_md3d.str_id = plate_{n}_3d.str_id
-            JOIN plate_{n}_id
-                ON plate_{n}_3d.ann_id = plate_{n}_id.ann_id
-            JOIN plate_{n}
-                ON plate_{n}_id.dmim_id = plate_{n}.dmim_id
-    ;"""
-    # accumulate values
-    md3d, ccs, annotation, adduct, met_n, mz = [], [], [], [], [], []
-    # iterate through all of the plates
-    for n in range(1, 8):
-        # fetch data from the database
-        for pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p, ccs_, annotation_, adduct_, met_n_, mz_ in cur.execute(qry.format(n=n)):
-            md3d.append([pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p])
-            ccs.append(float(ccs_))
-            annotation.append(annotation_)
-            adduct.append(adduct_)
-            met_n.append(int(met_n_))
-            mz.append(float(mz_))
-    # close the database and return the data as np.ndarrays
-    con.close()
-    return array(md3d), array(ccs), array(annotation), array(adduct), array(met_n), array(mz)
+    return _qry_table(db_path, 'md3d')
 
 
 def qry_combined(db_path):
@@ -140,39 +209,4 @@ qry_combined
     returns:
         X, ccs, annotation, adduct, met_n (numpy.ndarray((float,), float, str, str, int))
 """
-    con = connect(db_path)
-    cur = con.cursor()
-    # define the query
-    qry = """
-        SELECT
-            mqns, pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p, ccs_avg, annotation, adduct, met_n, mz
-        FROM
-            plate_{n}_md3d
-            JOIN plate_{n}_3d
-                ON plate_{n}_md3d.str_id = plate_{n}_3d.str_id
-            JOIN plate_{n}_id
-                ON plate_{n}_3d.ann_id = plate_{n}_id.ann_id
-            JOIN plate_{n}_mqn
-                ON plate_{n}_id.ann_id = plate_{n}_mqn.ann_id
-            JOIN plate_{n}
-                ON plate_{n}_id.dmim_id = plate_{n}.dmim_id
-    ;"""
-    # accumulate values
-    mqn, md3d, ccs, annotation, adduct, met_n, mz = [], [], [], [], [], [], []
-    # iterate through all of the plates
-    for n in range(1, 8):
-        # fetch data from the database
-        for mqn_, pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p, ccs_, annotation_, adduct_, met_n_, mz_ in cur.execute(qry.format(n=n)):
-            mqn.append([int(_) for _ in mqn_.split()])
-            md3d.append([pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p])
-            ccs.append(float(ccs_))
-            annotation.append(annotation_)
-            adduct.append(adduct_)
-            met_n.append(int(met_n_))
-            mz.append(float(mz_))
-    # combine mqn and md3d into single vector
-    x = [a_ + b_ for a_, b_ in zip(mqn, md3d)]
-    # close the database and return the data as np.ndarrays
-    con.close()
-    return array(x), array(ccs), array(annotation), array(adduct), array(met_n), array(mz)
-
+    return _qry_table(db_path, 'combined')
@@ -0,0 +1,146 @@
+"""
+    DmimData/feature_cache.py
+    Dylan H. Ross
+    2021/01/15
+
+    description:
+        In-process and on-disk cache of the feature tables queried from the DMIM_v?.?.db SQLite3 database (see
+        db_interface.py). Each feature table ('mz', 'mqn', 'md3d', 'combined') is queried at most once per DB file
+        and kept in memory for the rest of the process, it is also saved as a set of .npy files in a sidecar directory
+        next to the DB (DMIM_v?.?.db.features/) which later processes load memory-mapped instead of querying the DB.
+        Both caches are keyed on the (resolved) path, modification time and size of the DB file so they are
+        invalidated whenever the DB is rebuilt. The cached arrays are read-only since they are shared by every DMD
+        that uses the same DB file.
+"""
+
+
+import os
+import json
+
+from numpy import load, save
+
+from DmimData.db_interface import qry_mz, qry_mqn, qry_md3d, qry_combined
+from DmimData.categorical import encode, parent_groups
+
+
+# query function for each feature table
+FEATURE_TABLES = {
+    'mz': qry_mz,
+    'mqn': qry_mqn,
+    'md3d': qry_md3d,
+    'combined': qry_combined,
+}
+
+# names of the arrays in a cached feature table (see encode_table)
+ARRAY_NAMES = [
+    'X', 'y', 'name_codes', 'names', 'adduct_codes', 'adducts', 'group_codes', 'groups', 'met_n', 'mz'
+]
+
+# version of the sidecar cache format, change this if the feature tables change
+CACHE_VERSION = 2
+
+# in-process cache, (resolved DB path, table) -> (fingerprint, arrays)
+_tables = {}
+
+
+def db_fingerprint(db_path):
+    """
+db_fingerprint
+    description:
+        identifies a version of a DB file using its resolved path (symlinks in analysis/ and prediction/ point to the
+        same file), modification time and size
+    parameters:
+        db_path (str) -- path to DMIM_v?.?.db database file
+    returns:
+        fingerprint (dict(str -> str or int)) -- path, mtime_ns, size and cache version
+"""
+    path = os.path.realpath(db_path)
+    st = os.stat(path)
+    return {'path': path, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'version': CACHE_VERSION}
+
+
+def sidecar_dir(db_path):
+    """ directory where the .npy feature tables for a DB file are stored """
+    return os.path.realpath(db_path) + '.features'
+
+
+def _load_sidecar(db_path, table, fingerprint):
+    """ loads a feature table from the sidecar directory (memory-mapped), returns None if missing or stale """
+    d = sidecar_dir(db_path)
+    try:
+        with open(os.path.join(d, table + '.json'), 'r') as j:
+            if json.load(j) != fingerprint:
+                return None
+        return tuple(load(os.path.join(d, '{}_{}.npy'.format(table, name)), mmap_mode='r', allow_pickle=False)
+                     for name in ARRAY_NAMES)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_sidecar(db_path, table, fingerprint, arrays):
+    """ saves a feature table to the sidecar directory, the fingerprint is written last so partial writes are stale """
+    d = sidecar_dir(db_path)
+    try:
+        os.makedirs(d, exist_ok=True)
+        for name, a in zip(ARRAY_NAMES, arrays):
+            fname = os.path.join(d, '{}_{}.npy'.format(table, name))
+            with open(fname + '.tmp', 'wb') as f:
+                save(f, a, allow_pickle=False)
+            os.replace(fname + '.tmp', fname)
+        fname = os.path.join(d, table + '.json')
+        with open(fname + '.tmp', 'w') as j:
+            json.dump(fingerprint, j)
+        os.replace(fname + '.tmp', fname)
+    except OSError:
+        # the cache is only an optimization, a read-only location just means the DB is queried next time
+        pass
+
+
+def encode_table(X, y, name, adduct, met_n, mz):
+    """
+encode_table
+    description:
+        converts the arrays returned by the query functions into their cached form, names and adducts are encoded
+        as integer codes with lookup tables, the entries are also grouped by parent drug (see categorical.py) and
+        metabolite numbers are stored as int16
+    returns:
+        X, y, name_codes, names, adduct_codes, adducts, group_codes, groups, met_n, mz (numpy.ndarray)
+"""
+    name_codes, names = encode(name)
+    adduct_codes, adducts = encode(adduct)
+    group_codes, groups = parent_groups(name_codes, names)
+    return X, y, name_codes, names, adduct_codes, adducts, group_codes, groups, met_n.astype('int16'), mz
+
+
+def load_feature_table(db_path, table, sidecar=True):
+    """
+load_feature_table
+    description:
+        returns a feature table, from the in-process cache, the sidecar .npy cache (if sidecar is True) or by
+        querying the DB (then stores it in both caches), the returned arrays are read-only
+    parameters:
+        db_path (str) -- path to DMIM_v?.?.db database file
+        table (str) -- feature table (must be one of 'mz', 'mqn', 'md3d', 'combined')
+        [sidecar (bool)] -- use the on-disk sidecar cache [optional, default=True]
+    returns:
+        X, ccs, name_codes, names, adduct_codes, adducts, group_codes, groups, met_n, mz (numpy.ndarray) -- see
+        encode_table
+"""
+    fingerprint = db_fingerprint(db_path)
+    key = (fingerprint['path'], table)
+    if key in _tables and _tables[key][0] == fingerprint:
+        return _tables[key][1]
+    arrays = _load_sidecar(db_path, table, fingerprint) if sidecar else None
+    if arrays is None:
+        arrays = encode_table(*FEATURE_TABLES[table](db_path))
+        for a in arrays:
+            a.flags.writeable = False
+        if sidecar:
+            _save_sidecar(db_path, table, fingerprint, arrays)
+    _tables[key] = (fingerprint, arrays)
+    return arrays
+
+
+def clear_feature_cache():
+    """ empties the in-process cache (the sidecar cache is left as is) """
+    _tables.clear()
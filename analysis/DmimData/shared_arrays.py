@@ -0,0 +1,58 @@
+"""
+    DmimData/shared_arrays.py
+    Dylan H. Ross
+    2021/01/15
+
+    description:
+        Read-only memory-mapped arrays for sharing data with worker processes (e.g. GridSearchCV(n_jobs=-1) or
+        permutation_importance(n_jobs=-1)). An array is written to a .npy file once and replaced with a read-only
+        numpy.memmap of that file, joblib passes memory-mapped arrays to its workers by reference (file name and
+        offset) so each worker maps the same file instead of receiving a pickled copy, and the pages are shared by
+        all of the processes through the OS page cache.
+"""
+
+
+import os
+import atexit
+from itertools import count
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from numpy import load, save, ascontiguousarray
+
+
+# directory used when one is not specified, created on first use and removed when the process exits
+_default_dir = None
+
+# makes file names unique, files are never overwritten since other arrays may still be mapped to them
+_counter = count()
+
+
+def default_shared_dir():
+    """ temporary directory for shared arrays, removed when the process exits """
+    global _default_dir
+    if _default_dir is None:
+        _default_dir = mkdtemp(prefix='dmd_shared_')
+        atexit.register(rmtree, _default_dir, ignore_errors=True)
+    return _default_dir
+
+
+def shared_array(a, name, shared_dir=None):
+    """
+shared_array
+    description:
+        writes an array to a .npy file and returns a read-only memory-mapped view of it
+    parameters:
+        a (numpy.ndarray) -- array to share
+        name (str) -- label used in the file name (a unique suffix is added)
+        [shared_dir (str or None)] -- directory to write the array to, None to use a temporary directory that is
+                                      removed when the process exits [optional, default=None]
+    returns:
+        (numpy.memmap) -- read-only memory-mapped array with the same contents as a
+"""
+    if shared_dir is None:
+        shared_dir = default_shared_dir()
+    os.makedirs(shared_dir, exist_ok=True)
+    fname = os.path.join(shared_dir, '{}_{}_{}.npy'.format(name, os.getpid(), next(_counter)))
+    save(fname, ascontiguousarray(a), allow_pickle=False)
+    return load(fname, mmap_mode='r', allow_pickle=False)
@@ -0,0 +1,261 @@
+"""
+    DmimData/stream.py
+    Dylan H. Ross
+    2021/01/15
+
+    description:
+        Out-of-core version of DMD for datasets that are too large to fit in memory (e.g. DMIM merged with CCSbase
+        and in-house libraries), the features are streamed from the database in chunks whenever they are needed
+"""
+
+
+from numpy import count_nonzero, zeros, concatenate, unique, searchsorted, min_scalar_type
+from numpy.random import RandomState
+from sklearn.preprocessing import StandardScaler
+
+from DmimData.data import DMD, feature_names
+from DmimData.db_interface import iter_qry
+from DmimData.categorical import encode, parent_groups
+
+
+def merge_codes(chunks):
+    """
+merge_codes
+    description:
+        combines categorical codes that were encoded one chunk at a time (see categorical.encode) into codes into a
+        single sorted lookup table, same as encoding all of the values at once
+    parameters:
+        chunks (list(tuple(numpy.ndarray(uint), numpy.ndarray))) -- codes and lookup table of each chunk
+    returns:
+        codes (numpy.ndarray(uint)) -- index of each value in the combined lookup table
+        categories (numpy.ndarray) -- combined lookup table
+"""
+    if not chunks:
+        return encode([])
+    categories = unique(concatenate([cats for _, cats in chunks]))
+    codes = concatenate([searchsorted(categories, cats)[codes] for codes, cats in chunks])
+    return codes.astype(min_scalar_type(max(len(categories) - 1, 0))), categories
+
+
+class StreamDMD(DMD):
+    """
+StreamDMD
+    description:
+        Streaming version of DMD, the feature sets and the train/test split are the same as with DMD but only the
+        labels, metabolite numbers, encoded adducts and parent drug groups (see categorical.py) and train/test
+        assignments (a few bytes per entry) are kept in memory. Features
+        are read from the database chunk_size rows at a time, the StandardScaler is fit incrementally (partial_fit)
+        over the training set chunks, and centered/scaled batches are handed out for training incremental learners
+        (any estimator with a partial_fit method, e.g. SGDRegressor or MLPRegressor) and for prediction.
+
+        Instance variables that hold the full features or metadata (self.X_, self.X_train_, self.X_test_,
+        self.X_train_ss_, self.X_test_ss_, self.name_, self.mz_) are never set, use self.iter_batches(...)
+        instead. Entries are always in database order, so self.y_train_ and self.y_test_ contain the same labels as
+        with DMD (same seed) but in a different order.
+"""
+
+    def __init__(self, db_path, seed, chunk_size=10000):
+        """
+StreamDMD.__init__
+    description:
+        Initializes a new StreamDMD object, same as DMD.__init__ with the following additional instance variables:
+            self.chunk_size_    (number of rows read from the database at a time)
+            self.is_test_       (test set membership of each entry -> set by self.train_test_split(...))
+    parameters:
+        db_path (str) -- path to DMIM_v?.?.db database file
+        seed (int) -- pRNG seed to use for any data preparation steps with a stochastic component
+        [chunk_size (int)] -- number of rows read from the database at a time [optional, default=10000]
+"""
+        super().__init__(db_path, seed)
+        self.chunk_size_ = chunk_size
+        self.is_test_ = None
+
+
+    def iter_chunks(self):
+        """
+StreamDMD.iter_chunks
+    description:
+        streams the features and labels from the database for the feature set selected by self.featurize(...)
+    yields:
+        X, y (numpy.ndarray, numpy.ndarray) -- features and labels for each chunk of up to self.chunk_size_ entries
+"""
+        table = 'combined' if self.features_ == 'custom' else self.features_
+        for X, y, _, _, _, _ in iter_qry(self.db_path_, table, chunk_size=self.chunk_size_):
+            yield self.select_features(self.features_, X, custom_mqns=self.custom_mqns_,
+                                       custom_md3ds=self.custom_md3ds_), y
+
+
+    def featurize(self, features, custom_mqns=None, custom_md3ds=None):
+        """
+StreamDMD.featurize
+    description:
+        Selects the feature set and makes one pass over the database to collect the labels and metadata, sets the
+        following instance variables:
+            self.features_, self.custom_mqns_, self.custom_md3ds_
+            self.feature_names_ (names of the features, in column order)
+            self.adduct_codes_  (MS adduct, codes into self.adducts_)
+            self.adducts_       (lookup table of MS adducts)
+            self.group_codes_   (parent drug group, codes into self.groups_)
+            self.groups_        (lookup table of parent drugs)
+            self.met_n_         (metabolite number)
+            self.n_             (number of entries)
+            self.y_             (full array of labels)
+            self.n_features_    (number of features)
+            self.n_parent_      (number of parent drugs)
+            self.n_metab_       (number of metabolites)
+    parameters:
+        features (str) -- specify the feature set to use (must be one of 'mz', 'mqn', 'md3d', 'combined', 'custom')
+        custom_mqns (None or list(str)) -- used with 'custom' feature set to determine specific MQNs to include
+        custom_md3ds (None or list(str)) -- used with 'custom' feature set to determine specific MD3Ds to include
+"""
+        if features not in ['mz', 'mqn', 'md3d', 'combined', 'custom']:
+            m = 'StreamDMD: featurize: feature set "{features}" invalid'.format(features=features)
+            raise ValueError(m)
+        self.features_ = features
+        self.custom_mqns_ = custom_mqns
+        self.custom_md3ds_ = custom_md3ds
+        self.feature_names_ = feature_names(features, custom_mqns=custom_mqns, custom_md3ds=custom_md3ds)
+        table = 'combined' if features == 'custom' else features
+        y, met_n, adducts, groups, n_features = [], [], [], [], None
+        for X_, y_, name_, adduct_, met_n_, _ in iter_qry(self.db_path_, table, chunk_size=self.chunk_size_):
+            n_features = self.select_features(features, X_[:1], custom_mqns=custom_mqns,
+                                              custom_md3ds=custom_md3ds).shape[1]
+            y.append(y_)
+            met_n.append(met_n_)
+            adducts.append(encode(adduct_))
+            groups.append(parent_groups(*encode(name_)))
+        self.y_ = concatenate(y) if y else zeros(0)
+        self.adduct_codes_, self.adducts_ = merge_codes(adducts)
+        self.group_codes_, self.groups_ = merge_codes(groups)
+        self.met_n_ = (concatenate(met_n) if met_n else zeros(0, dtype=int)).astype('int16')
+        self.n_ = len(self.y_)
+        self.n_features_ = n_features
+        self.n_parent_ = int(count_nonzero(self.met_n_ == 0))
+        self.n_metab_ = self.n_ - self.n_parent_
+
+
+    def train_test_split(self, test_frac=0.2, stratify='ccs'):
+        """
+StreamDMD.train_test_split
+    description:
+        Same split as DMD.train_test_split (which only depends on the labels and metadata), but instead of
+        splitting the features it stores the test set membership of each entry, the features are split chunk by
+        chunk as they are streamed. Sets the following instance variables:
+            self.is_test_       (test set membership of each entry)
+            self.y_train_       (training set split of labels, in database order)
+            self.n_train_       (training set size)
+            self.y_test_        (test set split of labels, in database order)
+            self.n_test_        (test set size)
+            self.SSSplit_       (StratifiedShuffleSplit or GroupShuffleSplit instance)
+
+        ! self.featurize(...) must be called first to collect the labels (self.y_) !
+    parameters:
+        [test_frac (float)] -- fraction of the complete dataset to reserve as a test set, defaults to an 80 % / 20 %
+                               split for the train / test sets, respectively [optional, default=0.2]
+        [stratify (str)] -- stratify the split by binned CCS ('ccs'), by MS adduct ('adduct') or split by parent
+                            drug group ('group') [optional, default='ccs']
+"""
+        if self.y_ is None:
+            msg = 'StreamDMD: train_test_split: self.y_ is not initialized, self.featurize(...) must be called ' + \
+                  'before calling self.train_test_split(...)'
+            raise RuntimeError(msg)
+        _, test_index = self.split_indices(test_frac=test_frac, stratify=stratify)
+        self.is_test_ = zeros(self.n_, dtype=bool)
+        self.is_test_[test_index] = True
+        self.y_train_, self.y_test_ = self.y_[~self.is_test_], self.y_[self.is_test_]
+        self.n_train_, self.n_test_ = len(self.y_train_), len(self.y_test_)
+
+
+    def center_and_scale(self):
+        """
+StreamDMD.center_and_scale
+    description:
+        Fits a StandardScaler to the training set features one chunk at a time (partial_fit), the scaling is applied
+        to the batches from self.iter_batches(...). Sets the following instance variables:
+            self.SScaler_       (StandardScaler instance)
+
+        ! self.train_test_split(...) must be called first to assign the entries to the training and test sets !
+"""
+        if self.is_test_ is None:
+            msg = 'StreamDMD: center_and_scale: self.is_test_ is not initialized, self.train_test_split(...) must ' + \
+                  'be called before calling self.center_and_scale(...)'
+            raise RuntimeError(msg)
+        self.SScaler_ = StandardScaler()
+        for X, _ in self.iter_batches(subset='train', scaled=False):
+            self.SScaler_.partial_fit(X)
+
+
+    def iter_batches(self, subset='train', scaled=True, random_state=None):
+        """
+StreamDMD.iter_batches
+    description:
+        streams batches of features and labels from one subset of the data (at most self.chunk_size_ entries per
+        batch, chunks without any entries in the subset are skipped)
+    parameters:
+        [subset (str)] -- 'train', 'test' or 'all' [optional, default='train']
+        [scaled (bool)] -- center/scale the features using self.SScaler_ [optional, default=True]
+        [random_state (numpy.random.RandomState or None)] -- if provided, shuffles the entries within each batch
+                                                             [optional, default=None]
+    yields:
+        X, y (numpy.ndarray, numpy.ndarray) -- features and labels of each batch
+"""
+        if subset not in ['train', 'test', 'all']:
+            raise ValueError('StreamDMD: iter_batches: subset "{}" invalid'.format(subset))
+        if subset != 'all' and self.is_test_ is None:
+            msg = 'StreamDMD: iter_batches: self.is_test_ is not initialized, self.train_test_split(...) must be ' + \
+                  'called before selecting the training or test set'
+            raise RuntimeError(msg)
+        if scaled and self.SScaler_ is None:
+            msg = 'StreamDMD: iter_batches: self.SScaler_ is not initialized, self.center_and_scale(...) must be ' + \
+                  'called before requesting scaled batches'
+            raise RuntimeError(msg)
+        i = 0
+        for X, y in self.iter_chunks():
+            n = len(y)
+            if subset == 'all':
+                X_, y_ = X, y
+            else:
+                mask = self.is_test_[i:i + n] if subset == 'test' else ~self.is_test_[i:i + n]
+                X_, y_ = X[mask], y[mask]
+            i += n
+            if len(y_) == 0:
+                continue
+            if random_state is not None:
+                idx = random_state.permutation(len(y_))
+                X_, y_ = X_[idx], y_[idx]
+            yield (self.SScaler_.transform(X_) if scaled else X_), y_
+
+
+    def fit_incremental(self, estimator, n_epochs=1, shuffle=True):
+        """
+StreamDMD.fit_incremental
+    description:
+        trains an incremental learner on the centered/scaled training set, one batch at a time, using its
+        partial_fit method
+    parameters:
+        estimator (object) -- estimator with a partial_fit(X, y) method (e.g. SGDRegressor, MLPRegressor)
+        [n_epochs (int)] -- number of passes over the training set [optional, default=1]
+        [shuffle (bool)] -- shuffle the entries within each batch (seeded with self.seed_) [optional, default=True]
+    returns:
+        estimator (object) -- the trained estimator
+"""
+        random_state = RandomState(self.seed_) if shuffle else None
+        for _ in range(n_epochs):
+            for X, y in self.iter_batches(subset='train', random_state=random_state):
+                estimator.partial_fit(X, y)
+        return estimator
+
+
+    def predict(self, estimator, subset='test'):
+        """
+StreamDMD.predict
+    description:
+        predicts labels for one subset of the data (centered/scaled) one batch at a time
+    parameters:
+        estimator (object) -- trained estimator
+        [subset (str)] -- 'train', 'test' or 'all' [optional, default='test']
+    returns:
+        y_pred (numpy.ndarray(float)) -- predicted labels, in the same order as self.y_train_/self.y_test_/self.y_
+"""
+        y_pred = [estimator.predict(X) for X, _ in self.iter_batches(subset=subset)]
+        return concatenate(y_pred) if y_pred else zeros(0)
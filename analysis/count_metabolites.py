@@ -35,20 +35,19 @@ def main():
     con = connect('DMIM_v1.0.db')
     cur1, cur2 = con.cursor(), con.cursor()
 
-    qry_parent = 'SELECT well, mz, adduct FROM plate_{n} JOIN plate_{n}_id ON plate_{n}.dmim_id = plate_{n}_id.dmim_id WHERE met_n = 0'
-    qry_metab = 'SELECT mz, adduct FROM plate_{n} JOIN plate_{n}_id ON plate_{n}.dmim_id = plate_{n}_id.dmim_id WHERE well = ? AND met_n > 0'
+    qry_parent = 'SELECT plate, well, mz, adduct FROM dmim JOIN dmim_ann ON dmim.dmim_id = dmim_ann.dmim_id WHERE met_n = 0 ORDER BY ann_id'
+    qry_metab = 'SELECT mz, adduct FROM dmim JOIN dmim_ann ON dmim.dmim_id = dmim_ann.dmim_id WHERE plate = ? AND well = ? AND met_n > 0 ORDER BY ann_id'
 
     mass_shifts = []
     i = 0
     prev_well = ''
-    for n in range(1, 8):
-        for well, parent_mz, parent_adduct in cur1.execute(qry_parent.format(n=n)):
-            parent_neutral_mass = neutral_mass(float(parent_mz), parent_adduct)
-            #print(well, parent_mz, parent_adduct)
-            if well != prev_well:
-                for metab_mz, metab_adduct in cur2.execute(qry_metab.format(n=n), (well,)):
-                    mass_shifts.append(neutral_mass(float(metab_mz), metab_adduct) - parent_neutral_mass)
-            prev_well = well
+    for n, well, parent_mz, parent_adduct in cur1.execute(qry_parent):
+        parent_neutral_mass = neutral_mass(float(parent_mz), parent_adduct)
+        #print(well, parent_mz, parent_adduct)
+        if well != prev_well:
+            for metab_mz, metab_adduct in cur2.execute(qry_metab, (n, well)):
+                mass_shifts.append(neutral_mass(float(metab_mz), metab_adduct) - parent_neutral_mass)
+        prev_well = well
 
     mass_shifts = array(mass_shifts)
 
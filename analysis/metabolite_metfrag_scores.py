@@ -14,10 +14,10 @@ qry_metabolite_metfrag_scores = """
 SELECT 
     metfrag_score
 FROM
-    plate_{n}_ms2
+    dmim_ms2
 JOIN 
-    plate_{n}
-    ON plate_{n}.dmim_id = plate_{n}_ms2.dmim_id
+    dmim
+    ON dmim.dmim_id = dmim_ms2.dmim_id
 WHERE
     -- only metabolites
     met_n > 0
@@ -26,9 +26,8 @@ WHERE
 con = connect('DMIM_v1.1.db')
 cur = con.cursor()
 scores = []
-for n in range(1, 8):
-    for score in cur.execute(qry_metabolite_metfrag_scores.format(n=n)).fetchall():
-        scores.append(score)
+for score in cur.execute(qry_metabolite_metfrag_scores).fetchall():
+    scores.append(score)
 metfrag_scores = array(scores)
 con.close()
 #metfrag_scores = loadtxt('build/DMIM_metfrag_scores_prefilter.txt')
@@ -0,0 +1,353 @@
+#!/usr/local/Cellar/python@3.9/3.9.1_6/bin/python3
+"""
+    MS2 spectral similarity (cosine and modified cosine) between the spectra in the DMIM database
+
+    Spectra are binned (bin_width, same bins as the fragment index, see build/ms2_spectra.py), intensities are scaled
+    (intensity ** power) and each spectrum is normalized to unit length, all of the spectra go into a single sparse
+    matrix (one row per spectrum) that is built once:
+        cosine - the dot product of two rows, top-k queries for any number of query spectra are a single sparse
+            matrix product
+        modified cosine - fragments are matched either at the same m/z or shifted by the difference in precursor m/z,
+            each peak is matched at most once (matches are assigned greedily in order of decreasing score, as in the
+            usual modified cosine), computed for many pairs of spectra at once
+
+    Parent-metabolite similarity is computed for every well in one batch: every metabolite spectrum is compared with
+    every parent spectrum from the same plate and well.
+
+    usage:
+        python3 ms2_similarity.py DMIM_v1.1.db
+"""
+
+import sys
+from sqlite3 import connect
+
+from numpy import (
+    array, arange, repeat, concatenate, cumsum, argsort, lexsort, searchsorted, bincount, zeros, ones, sqrt,
+    argpartition, int64, float64
+)
+from scipy.sparse import csr_matrix, diags
+
+from build.ms2_spectra import FRAG_BIN_WIDTH, mz_to_bin, unpack_spectrum
+
+
+# default intensity scaling (intensity ** power)
+POWER = 0.5
+
+# approximate number of peak comparisons in each block when computing modified cosine for many pairs
+BLOCK_SIZE = 1000000
+
+
+# define queries
+# get the packed spectra with their precursor m/z
+qry_spectra = """
+SELECT
+    dmim.dmim_id, mz, spectrum_mz, spectrum_intensity
+FROM
+    dmim_ms2
+    JOIN dmim
+        ON dmim_ms2.dmim_id = dmim.dmim_id
+WHERE
+    n_peaks > 0
+ORDER BY
+    dmim.dmim_id
+;"""
+
+# get every (parent, metabolite) pair of spectra from the same well
+qry_parent_metab_pairs = """
+SELECT
+    p.dmim_id, m.dmim_id
+FROM
+    dmim AS p
+    JOIN dmim AS m
+        ON p.plate = m.plate
+        AND p.well = m.well
+    JOIN dmim_ms2 AS p_ms2
+        ON p.dmim_id = p_ms2.dmim_id
+    JOIN dmim_ms2 AS m_ms2
+        ON m.dmim_id = m_ms2.dmim_id
+WHERE
+    p.met_n = 0
+    AND m.met_n > 0
+    AND p_ms2.n_peaks > 0
+    AND m_ms2.n_peaks > 0
+ORDER BY
+    p.plate, p.well, m.dmim_id, p.dmim_id
+;"""
+
+
+class SpectrumMatrix:
+    """ binned, intensity-scaled and normalized spectra stored as the rows of a sparse matrix """
+
+    def __init__(self, ids, spectra, precursor_mzs=None, bin_width=FRAG_BIN_WIDTH, power=POWER):
+        """
+            ids - identifier for each spectrum (e.g. dmim_id)
+            spectra - list of (m/z, intensity) arrays
+            precursor_mzs - precursor m/z of each spectrum (required for modified cosine)
+            bin_width - m/z bin width
+            power - intensities are scaled as intensity ** power before normalizing
+        """
+        self.ids = list(ids)
+        self.index = {id_: i for i, id_ in enumerate(self.ids)}
+        self.precursor_mzs = None if precursor_mzs is None else array(precursor_mzs, dtype=float64)
+        self.bin_width = bin_width
+        self.power = power
+        n_peaks = array([len(mz) for mz, _ in spectra], dtype=int64)
+        rows = repeat(arange(len(spectra)), n_peaks)
+        if len(rows):
+            bins = mz_to_bin(concatenate([mz for mz, _ in spectra]).astype(float64), bin_width=bin_width)
+            intensities = concatenate([i for _, i in spectra]).astype(float64)
+        else:
+            bins, intensities = zeros(0, dtype=int64), zeros(0)
+        n_bins = int(bins.max()) + 1 if len(bins) else 1
+        # peaks that fall in the same bin are summed before scaling
+        matrix = csr_matrix((intensities, (rows, bins)), shape=(len(spectra), n_bins))
+        matrix.sum_duplicates()
+        matrix.data **= power
+        norms = sqrt(array(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.
+        self.matrix = csr_matrix(diags(1. / norms) @ matrix)
+        self.matrix.sort_indices()
+
+    @classmethod
+    def from_db(cls, dmim_cursor, bin_width=FRAG_BIN_WIDTH, power=POWER):
+        """ builds the matrix from all of the (non-empty) MS2 spectra in the DMIM database """
+        ids, precursor_mzs, spectra = [], [], []
+        for dmim_id, mz, mz_blob, intensity_blob in dmim_cursor.execute(qry_spectra).fetchall():
+            ids.append(dmim_id)
+            precursor_mzs.append(mz)
+            spectra.append(unpack_spectrum(mz_blob, intensity_blob))
+        return cls(ids, spectra, precursor_mzs=precursor_mzs, bin_width=bin_width, power=power)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def with_bins(self, n_bins):
+        """ the spectrum matrix with (at least) n_bins columns, so it can be multiplied with another one """
+        if self.matrix.shape[1] >= n_bins:
+            return self.matrix
+        return csr_matrix((self.matrix.data, self.matrix.indices, self.matrix.indptr), shape=(len(self), n_bins))
+
+
+def _check_compatible(queries, library):
+    """ makes sure two spectrum matrices were binned and scaled the same way """
+    if queries.bin_width != library.bin_width or queries.power != library.power:
+        raise ValueError('_check_compatible: query and library spectra must use the same bin_width and power')
+
+
+def _top_k_rows(scores, k, exclude=None):
+    """ top k (column, score) for each row of a sparse score matrix, highest score first, optionally excluding one
+        column per row (exclude) """
+    top = []
+    for i in range(scores.shape[0]):
+        cols = scores.indices[scores.indptr[i]:scores.indptr[i + 1]]
+        vals = scores.data[scores.indptr[i]:scores.indptr[i + 1]]
+        if exclude is not None:
+            keep = cols != exclude[i]
+            cols, vals = cols[keep], vals[keep]
+        if len(vals) > k:
+            part = argpartition(-vals, k)[:k]
+            cols, vals = cols[part], vals[part]
+        order = lexsort((cols, -vals))
+        top.append(list(zip(cols[order].tolist(), vals[order].tolist())))
+    return top
+
+
+def cosine_matrix(queries, library):
+    """ cosine similarity of every query spectrum to every library spectrum, as a sparse matrix with shape
+        (n_queries, n_library) (pairs without any shared bins are not stored) """
+    _check_compatible(queries, library)
+    n_bins = max(queries.matrix.shape[1], library.matrix.shape[1])
+    return csr_matrix(queries.with_bins(n_bins) @ library.with_bins(n_bins).T)
+
+
+def cosine_top_k(queries, library, k=10, exclude_self=False):
+    """
+        top k most similar library spectra (by cosine) for each query spectrum
+        exclude_self - do not match spectra to themselves (for all-vs-all searches, matched by id)
+        returns: list (one per query) of lists of (library id, cosine), highest first
+    """
+    scores = cosine_matrix(queries, library)
+    exclude = array([library.index.get(id_, -1) for id_ in queries.ids]) if exclude_self else None
+    return [[(library.ids[j], s) for j, s in top] for top in _top_k_rows(scores, k, exclude=exclude)]
+
+
+def _pair_peaks(matrix, rows):
+    """ the peaks of the given rows of a spectrum matrix laid out end to end
+        returns: pair index, peak index (into matrix.indices) for each peak """
+    n = matrix.indptr[rows + 1] - matrix.indptr[rows]
+    pair = repeat(arange(len(rows)), n)
+    start = repeat(matrix.indptr[rows] - concatenate([[0], cumsum(n)[:-1]]), n)
+    return pair, arange(n.sum()) + start
+
+
+def _greedy_match(e, f, score):
+    """ greedy one-to-one assignment of candidate matches between peaks e and f (non-negative peak indices), in order
+        of decreasing score
+        returns: mask of the accepted matches """
+    accepted = zeros(len(score), dtype=bool)
+    # a unique rank for every candidate (score, then position) so there are no ties
+    rank = zeros(len(score), dtype=int64)
+    rank[argsort(-score, kind='stable')] = arange(len(score))
+    alive = ones(len(score), dtype=bool)
+    used_e = zeros(e.max() + 1 if len(e) else 0, dtype=bool)
+    used_f = zeros(f.max() + 1 if len(f) else 0, dtype=bool)
+    while alive.any():
+        idx = alive.nonzero()[0]
+        # candidates that are the best remaining match for both of their peaks are exactly the ones greedy would
+        # accept next, accept all of them at once then drop every candidate that shares a peak with them
+        best = ones(len(idx), dtype=bool)
+        for peaks in [e[idx], f[idx]]:
+            order = lexsort((rank[idx], peaks))
+            first = ones(len(order), dtype=bool)
+            first[1:] = peaks[order][1:] != peaks[order][:-1]
+            is_first = zeros(len(idx), dtype=bool)
+            is_first[order[first]] = True
+            best &= is_first
+        accepted[idx[best]] = True
+        used_e[e[idx[best]]] = True
+        used_f[f[idx[best]]] = True
+        alive[idx] = ~used_e[e[idx]] & ~used_f[f[idx]]
+    return accepted
+
+
+def _match_scores(queries, qi, library, lj, modified):
+    """ cosine or modified cosine for the pairs (queries row qi[p], library row lj[p]) """
+    qm, lm = queries.matrix, library.matrix
+    q_pair, q_peak = _pair_peaks(qm, qi)
+    l_pair, l_peak = _pair_peaks(lm, lj)
+    offset = max(qm.shape[1], lm.shape[1])
+    stride = 3 * offset
+    # each library peak gets a key unique to its pair and bin, library bins within a row are unique and sorted so the
+    # keys are sorted as well
+    l_key = l_pair * stride + lm.indices[l_peak] + offset
+    shifts = [zeros(len(qi), dtype=int64)]
+    if modified:
+        delta = queries.precursor_mzs[qi] - library.precursor_mzs[lj]
+        shifts.append(mz_to_bin(delta, bin_width=queries.bin_width))
+    e, f, score, pair = [], [], [], []
+    for i, shift in enumerate(shifts):
+        q_bins = qm.indices[q_peak] - shift[q_pair]
+        ok = (q_bins >= -offset) & (q_bins < 2 * offset)
+        if i > 0:
+            # shifted matches are the same as the unshifted ones when the precursors fall in the same bin
+            ok &= shift[q_pair] != 0
+        q_key = q_pair[ok] * stride + q_bins[ok] + offset
+        pos = searchsorted(l_key, q_key)
+        pos[pos == len(l_key)] = 0
+        hit = (l_key[pos] == q_key) if len(l_key) else zeros(len(q_key), dtype=bool)
+        # peaks are identified by their position in the pair layout, the same spectrum can be in many pairs
+        e.append(arange(len(q_peak))[ok][hit])
+        f.append(pos[hit])
+        score.append(qm.data[q_peak[ok][hit]] * lm.data[l_peak[pos[hit]]])
+        pair.append(q_pair[ok][hit])
+    e, f, score, pair = [concatenate(_) for _ in [e, f, score, pair]]
+    if modified:
+        keep = _greedy_match(e, f, score)
+        score, pair = score[keep], pair[keep]
+    return bincount(pair, weights=score, minlength=len(qi))
+
+
+def pair_scores(queries, qi, library, lj, modified=False, block_size=BLOCK_SIZE):
+    """
+        cosine or modified cosine for many pairs of spectra at once
+        qi - rows of the query spectrum matrix
+        lj - rows of the library spectrum matrix (same length as qi)
+        modified - compute modified cosine (requires precursor m/z for both matrices)
+        block_size - approximate number of peaks per block, pairs are processed in blocks to bound memory
+        returns: score for each pair
+    """
+    _check_compatible(queries, library)
+    if modified and (queries.precursor_mzs is None or library.precursor_mzs is None):
+        raise ValueError('pair_scores: modified cosine requires precursor m/z for all spectra')
+    qi, lj = array(qi, dtype=int64), array(lj, dtype=int64)
+    n = (queries.matrix.indptr[qi + 1] - queries.matrix.indptr[qi]
+         + library.matrix.indptr[lj + 1] - library.matrix.indptr[lj])
+    scores, start = [], 0
+    blocks = cumsum(n) // max(block_size, 1)
+    for b in sorted(set(blocks.tolist())):
+        stop = searchsorted(blocks, b, side='right')
+        scores.append(_match_scores(queries, qi[start:stop], library, lj[start:stop], modified))
+        start = stop
+    return concatenate(scores) if scores else zeros(0)
+
+
+def _precursor_relative_bins(spectra, widen=0):
+    """ peak bins of each spectrum relative to its precursor bin (precursor bin - peak bin)
+        widen - also include the relative bins within this many bins of each peak
+        returns: spectrum row, relative bin (for each peak and each of its neighbouring bins) """
+    m = spectra.matrix
+    rows = repeat(arange(len(spectra)), m.indptr[1:] - m.indptr[:-1])
+    rel = mz_to_bin(spectra.precursor_mzs, bin_width=spectra.bin_width)[rows] - m.indices
+    rows = concatenate([rows] * (2 * widen + 1))
+    rel = concatenate([rel + d for d in range(-widen, widen + 1)])
+    return rows, rel
+
+
+def _modified_candidates(queries, library):
+    """ pairs of spectra that can have a non-zero modified cosine: the ones that share a bin (non-zero cosine) and the
+        ones that share a bin after shifting by the precursor difference, shift = bin(precursor difference) is within
+        one bin of the difference in precursor bins so the peak bins relative to the precursor bins of a shifted
+        match are within one bin of each other, both sets come from a sparse product so pairs without anything in
+        common are never looked at
+        returns: qi, lj (rows of the query and library spectrum matrices) """
+    q_rows, q_rel = _precursor_relative_bins(queries)
+    l_rows, l_rel = _precursor_relative_bins(library, widen=1)
+    low = min(q_rel.min(initial=0), l_rel.min(initial=0))
+    n_bins = max(q_rel.max(initial=0), l_rel.max(initial=0)) - low + 1
+    q_mat = csr_matrix((ones(len(q_rows)), (q_rows, q_rel - low)), shape=(len(queries), n_bins))
+    l_mat = csr_matrix((ones(len(l_rows)), (l_rows, l_rel - low)), shape=(len(library), n_bins))
+    candidates = (cosine_matrix(queries, library) != 0) + (q_mat @ l_mat.T != 0)
+    candidates = candidates.tocoo()
+    return candidates.row.astype(int64), candidates.col.astype(int64)
+
+
+def modified_cosine_top_k(queries, library, k=10, exclude_self=False, block_size=BLOCK_SIZE):
+    """
+        top k most similar library spectra (by modified cosine) for each query spectrum, only the pairs that have any
+        matching peaks (see _modified_candidates) are scored
+        exclude_self - do not match spectra to themselves (for all-vs-all searches, matched by id)
+        returns: list (one per query) of lists of (library id, modified cosine), highest first
+    """
+    _check_compatible(queries, library)
+    if queries.precursor_mzs is None or library.precursor_mzs is None:
+        raise ValueError('modified_cosine_top_k: modified cosine requires precursor m/z for all spectra')
+    qi, lj = _modified_candidates(queries, library)
+    scores = pair_scores(queries, qi, library, lj, modified=True, block_size=block_size)
+    scores = csr_matrix((scores, (qi, lj)), shape=(len(queries), len(library)))
+    scores.eliminate_zeros()
+    exclude = array([library.index.get(id_, -1) for id_ in queries.ids]) if exclude_self else None
+    return [[(library.ids[j], s) for j, s in top] for top in _top_k_rows(scores, k, exclude=exclude)]
+
+
+def parent_metabolite_similarity(dmim_cursor, spectra=None):
+    """
+        cosine and modified cosine between every metabolite spectrum and every parent spectrum from the same well
+        spectra - spectrum matrix with all of the spectra in the database (built with SpectrumMatrix.from_db if not
+            provided)
+        returns: list of (parent dmim_id, metabolite dmim_id, cosine, modified cosine)
+    """
+    if spectra is None:
+        spectra = SpectrumMatrix.from_db(dmim_cursor)
+    pairs = dmim_cursor.execute(qry_parent_metab_pairs).fetchall()
+    pi = array([spectra.index[p] for p, _ in pairs], dtype=int64)
+    mi = array([spectra.index[m] for _, m in pairs], dtype=int64)
+    cos = pair_scores(spectra, mi, spectra, pi)
+    mod = pair_scores(spectra, mi, spectra, pi, modified=True)
+    return [(p, m, c, d) for (p, m), c, d in zip(pairs, cos.tolist(), mod.tolist())]
+
+
+def main(dmim_fname):
+    """ main execution """
+    con = connect(dmim_fname)
+    cur = con.cursor()
+    results = parent_metabolite_similarity(cur)
+    con.close()
+    with open('DMIM_parent_metabolite_ms2_similarity.txt', 'w') as f:
+        f.write('parent metabolite cosine modified_cosine\n')
+        for p, m, c, d in results:
+            f.write('{} {} {:.4f} {:.4f}\n'.format(p, m, c, d))
+    print(len(results), 'parent-metabolite spectrum pairs')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -3,77 +3,86 @@
     Computes MQNs for all annotations
 """
 
-from sqlite3 import connect
-from json import load as jload
+from bulk_writer import build_connect, BulkWriter
+from stage_graph import ReuseIds
+from xyzmq import pack_xyzmq
+from cmpd_index import CmpdIndex
 
 
 # define queries
 # get data from the DMIM DB
-qry_dmim_plate_n_id = """
+qry_dmim_ann = """
 SELECT 
     ann_id, smi, annotation, adduct
 FROM
-    plate_{n}_id
+    dmim_ann
     JOIN
-        plate_{n}
-        ON plate_{n}_id.dmim_id = plate_{n}.dmim_id
+        dmim
+        ON dmim_ann.dmim_id = dmim.dmim_id
+ORDER BY
+    plate, ann_id
 ;"""
 
-# insert MQNs for plate N
-qry_dmim_plate_n_3d = """
-INSERT INTO plate_{n}_3d
-    (ann_id, str_id, structure)
+# get existing 3D structures (to reuse their str_ids)
+qry_dmim_existing_3d = """
+SELECT
+    ann_id, structure, str_id
+FROM
+    main.dmim_3d
+;"""
+
+# insert 3D structures
+qry_dmim_3d = """
+INSERT INTO dmim_3d
+    (ann_id, str_id, structure, n_atoms, xyzmq)
 VALUES
-    (?,?,?)
+    (?,?,?,?,?)
 ;"""
 
 
-def get_structures(dmim_cursor1, dmim_cursor2):
+def get_structures(dmim_cursor, str_writer, str_ids):
     """ annotations can be taken directly from the main table for parent compounds
         and SMILES structures taken from parent_data_rmsd.json """
 
-    # load parent_data_rmsd.json
-    with open('parent_data_rmsd.json', 'r') as j:
-        pdata = jload(j)
-    # load metab_data_fixed_rmsd.json
-    with open('metab_data_fixed_rmsd.json', 'r') as j:
-        mdata = jload(j)
-
-    # count annotations without structures
-    nostr = 0
-
-    # unique structure ID 
-    str_id = 1
-
-    # iterate through all plates
-    for n in range(1, 8):
-        for ann_id, smi, annotation, adduct in dmim_cursor1.execute(qry_dmim_plate_n_id.format(n=n)).fetchall():
-            matched = False
-            for cmpd in pdata + mdata:
-                if annotation == cmpd['name'] and smi == cmpd['SMILES'] and adduct == cmpd['adduct'] and 'structures' in cmpd and cmpd['structures'] != []:
-                    matched = True
-                    for structure in cmpd['structures']:
-                        qdata = (ann_id, str_id, structure)
-                        dmim_cursor2.execute(qry_dmim_plate_n_3d.format(n=n), qdata)
-                        str_id += 1
-                    break
-            if not matched:
-                nostr += 1
-    print(nostr, 'annotations do not have 3D structure(s)')
+    # load and index parent_data_rmsd.json and metab_data_fixed_rmsd.json
+    index = CmpdIndex.from_json('parent_data_rmsd.json', 'metab_data_fixed_rmsd.json')
+
+    # iterate through all annotations
+    for ann_id, smi, annotation, adduct in dmim_cursor.execute(qry_dmim_ann).fetchall():
+        for structure in index.get_structures(annotation, smi, adduct):
+            str_id = str_ids.get((ann_id, structure))
+            qdata = (ann_id, str_id, structure, *pack_xyzmq(structure))
+            str_writer.add(qdata)
+    print(len(index.unmatched_keys), 'annotations do not have 3D structure(s)')
+    index.report('get_structures')
+    return len(index.unmatched_keys)
+
+
+def build_stage(dmim_con):
+    """ build stage entry point (see build.py)
+        returns: counts for the build report """
+    dmim_cur = dmim_con.cursor()
+
+    # structures that are unchanged from a previous build keep their str_id
+    existing = [((ann_id, structure), str_id)
+                for ann_id, structure, str_id in dmim_cur.execute(qry_dmim_existing_3d).fetchall()]
+    str_ids = ReuseIds(existing)
+
+    # fetch 3D structures for parent compounds
+    with BulkWriter(dmim_con, qry_dmim_3d, 'add_3d') as str_writer:
+        nostr = get_structures(dmim_cur, str_writer, str_ids)
+    return {'structures': str_writer.n_rows, 'no_3d': nostr}
 
 
 def main(version):
     """ main execution """
     dmim_fname = 'DMIM_v{version}.db'.format(version=version)
 
-    # initialize the database connections
-    dmim_con = connect(dmim_fname)
-    dmim_cur1, dmim_cur2 = dmim_con.cursor(), dmim_con.cursor()
+    # initialize the database connection
+    dmim_con = build_connect(dmim_fname)
 
-    # fetch 3D structures for parent compounds
-    get_structures(dmim_cur1, dmim_cur2)
+    build_stage(dmim_con)
 
-    # commit changes and close DB connections
-    dmim_con.commit()
+    # close DB connection
     dmim_con.close()
 
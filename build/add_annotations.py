@@ -3,36 +3,60 @@
 """
 
 from sqlite3 import connect
-from json import load as jload
+
+from bulk_writer import build_connect, BulkWriter
+from stage_graph import ReuseIds
+from cmpd_index import CmpdIndex
+
+
+# replicate data DB
+rep_fname = 'replicate_data_assigned_MS2.db'
 
 
 # define queries
 # get parent data from the DMIM DB
-qry_dmim_parent_plate_n = """
+qry_dmim_parent = """
 SELECT
     dmim_id, name
 FROM 
-    plate_{n}
+    dmim
 WHERE
     met_n = 0
+ORDER BY
+    dmim_id
 ;"""
 
-# insert annotation for plate N
-qry_dmim_plate_n_id = """
-INSERT INTO plate_{n}_id
+# insert annotation
+qry_dmim_ann = """
+INSERT INTO dmim_ann
     (dmim_id, ann_id, annotation, smi, notes)
 VALUES
     (?,?,?,?,?)
 ;"""
 
 # get metabolite data from the DMIM DB
-qry_dmim_metab_plate_n = """
+qry_dmim_metab = """
 SELECT
-    dmim_id, name, well, met_n
+    dmim_id, plate, name, well, met_n
 FROM 
-    plate_{n}
+    dmim
 WHERE
     met_n > 0
+ORDER BY
+    dmim_id
+;"""
+
+# get existing annotations, including the ones removed by the MetFrag score filter (to reuse their ann_ids)
+qry_dmim_existing_ann = """
+SELECT
+    dmim_id, annotation, smi, notes, ann_id
+FROM
+    main.dmim_ann
+UNION ALL
+SELECT
+    dmim_id, annotation, smi, notes, ann_id
+FROM
+    main.dmim_ann_filtered
 ;"""
 
 # get metabolite annotations from the replicate DB
@@ -51,7 +75,7 @@ qry_dmim_dup_dmim_ids = """
 SELECT 
     COUNT(*) AS c, dmim_id 
 FROM 
-    plate_{n}_id 
+    dmim_ann 
 GROUP BY 
     dmim_id, annotation, smi, notes 
     HAVING 
@@ -63,108 +87,112 @@ qry_dmim_dup_ann_ids = """
 SELECT 
     ann_id 
 FROM 
-    plate_{n}_id 
+    dmim_ann 
 WHERE
     dmim_id = ?
+ORDER BY
+    ann_id
 ;"""
 
-# select ann_ids of duplicate annotations
+# drop ann_ids of duplicate annotations
 qry_drop_dup_ann_ids = """
 DELETE FROM 
-    plate_{n}_id 
+    dmim_ann 
 WHERE
     ann_id = ?
 ;"""
 
 
-def parent_annotations(dmim_cursor1, dmim_cursor2):
+def parent_annotations(dmim_cursor, ann_writer, ann_ids):
     """ annotations can be taken directly from the main table for parent compounds
         and SMILES structures taken from parent_data_rmsd.json """
 
-    ann_id = 1
-
-    # load parent_data_rmsd.json
-    with open('parent_data_rmsd.json', 'r') as j:
-        pdata = jload(j)
-
-    # iterate through all plates
-    for n in range(1, 8):
-        for dmim_id, name in dmim_cursor1.execute(qry_dmim_parent_plate_n.format(n=n)).fetchall():
-            matched = False
-            for cmpd in pdata:
-                if name == cmpd['name']:
-                    smi = cmpd['SMILES']
-                    qdata = (dmim_id, ann_id, name, smi, 'ParentDrug')
-                    dmim_cursor2.execute(qry_dmim_plate_n_id.format(n=n), qdata)
-                    matched = True
-                    ann_id += 1
-                    break
-            if not matched:
-                #print('ERROR! no annotation for: {} ({})'.format(name, dmim_id))
-                pass
-    # return the next available annotation ID
-    return ann_id
-
-
-def transfer_annotations(dmim_cursor1, dmim_cursor2, rep_cursor, ann_id_start):
-    """ transfer annotations from the replicate DB to the DMIM DB """
-    # annotation id
-    ann_id = ann_id_start
+    # load and index parent_data_rmsd.json
+    pindex = CmpdIndex.from_json('parent_data_rmsd.json')
+
+    # iterate through all parents
+    for dmim_id, name in dmim_cursor.execute(qry_dmim_parent).fetchall():
+        cmpd = pindex.get_name(name)
+        if cmpd is not None:
+            smi = cmpd['SMILES']
+            ann_id = ann_ids.get((dmim_id, name, smi, 'ParentDrug'))
+            qdata = (dmim_id, ann_id, name, smi, 'ParentDrug')
+            ann_writer.add(qdata)
+    pindex.report('parent_annotations')
+
+
+def transfer_annotations(dmim_cursor, ann_writer, rep_cursor, ann_ids):
+    """ transfer annotations from the replicate DB to the DMIM DB
+        returns: number of parents, metabolites without annotations """
     # count the number of dmim_ids without annotations
     noann_p, noann_m = 0, 0
-    # iterate through all plates
-    for n in range(1, 8):
-        for dmim_id, name, well, met_n in dmim_cursor1.execute(qry_dmim_metab_plate_n.format(n=n)).fetchall():
-            matched = False
-            qdata1 = (well, met_n)
-            for name, smi, notes in rep_cursor.execute(qry_rep_plate_n_id.format(n=n), qdata1).fetchall():
-                    qdata2 = (dmim_id, ann_id, name, smi, notes)
-                    dmim_cursor2.execute(qry_dmim_plate_n_id.format(n=n), qdata2)
-                    ann_id += 1
-                    matched = True
-            if not matched:
-                if met_n > 0:
-                    noann_m += 1
-                else:
-                    noann_p += 1
-                #print('ERROR! annotation for: {} {} {}'.format(dmim_id, well, met_n))
+    # iterate through all metabolites, annotations come from the plate_N_id table of the replicate DB
+    for dmim_id, n, name, well, met_n in dmim_cursor.execute(qry_dmim_metab).fetchall():
+        matched = False
+        qdata1 = (well, met_n)
+        for name, smi, notes in rep_cursor.execute(qry_rep_plate_n_id.format(n=n), qdata1).fetchall():
+                ann_id = ann_ids.get((dmim_id, name, smi, notes))
+                qdata2 = (dmim_id, ann_id, name, smi, notes)
+                ann_writer.add(qdata2)
+                matched = True
+        if not matched:
+            if met_n > 0:
+                noann_m += 1
+            else:
+                noann_p += 1
+            #print('ERROR! annotation for: {} {} {}'.format(dmim_id, well, met_n))
     print(noann_p + noann_m, 'have no verified annotations', '({} parents, {} metabolites)'.format(noann_p, noann_m))
+    return noann_p, noann_m
 
 
-def remove_duplicate_annotations(dmim_cursor1, dmim_cursor2):
+def remove_duplicate_annotations(dmim_cursor1, dmim_cursor2, drop_writer):
     """ remove any duplicates in the annotations (dmim_id, annotation, smi, and notes are the same) """
-    # iterate through all plates
-    for n in range(1, 8):
-        rm_anns = []
-        for c, dmim_id in dmim_cursor1.execute(qry_dmim_dup_dmim_ids.format(n=n)).fetchall():
-            rm_anns += [_[0] for _ in dmim_cursor2.execute(qry_dmim_dup_ann_ids.format(n=n), (dmim_id,))][1:]
-        for rm_ann in rm_anns:
-            dmim_cursor2.execute(qry_drop_dup_ann_ids.format(n=n), (rm_ann,))
+    for c, dmim_id in dmim_cursor1.execute(qry_dmim_dup_dmim_ids).fetchall():
+        for rm_ann in [_[0] for _ in dmim_cursor2.execute(qry_dmim_dup_ann_ids, (dmim_id,))][1:]:
+            drop_writer.add((rm_ann,))
             
 
-def main(version):
-    """ main execution """
-    dmim_fname = 'DMIM_v{version}.db'.format(version=version)
-    rep_fname = 'replicate_data_assigned_MS2.db'
-
-    # initialize the database connections
-    dmim_con = connect(dmim_fname)
+def build_stage(dmim_con):
+    """ build stage entry point (see build.py)
+        returns: counts for the build report """
     dmim_cur1, dmim_cur2 = dmim_con.cursor(), dmim_con.cursor()
     rep_con = connect(rep_fname)
     rep_cur = rep_con.cursor()
 
-    # make annotations for parent compounds
-    aid = parent_annotations(dmim_cur1, dmim_cur2)
+    # annotations that are unchanged from a previous build keep their ann_id
+    existing = [((dmim_id, annotation, smi, notes), ann_id)
+                for dmim_id, annotation, smi, notes, ann_id in dmim_cur1.execute(qry_dmim_existing_ann).fetchall()]
+    ann_ids = ReuseIds(existing)
 
-    # transfer data from replicate DB to DMIM DB
-    transfer_annotations(dmim_cur1, dmim_cur2, rep_cur, aid)
+    with BulkWriter(dmim_con, qry_dmim_ann, 'add_annotations') as ann_writer:
+        # make annotations for parent compounds
+        parent_annotations(dmim_cur1, ann_writer, ann_ids)
 
-    # remove duplicate annotations
-    remove_duplicate_annotations(dmim_cur1, dmim_cur2)
+        # transfer data from replicate DB to DMIM DB
+        noann_p, noann_m = transfer_annotations(dmim_cur1, ann_writer, rep_cur, ann_ids)
+
+    # remove duplicate annotations (all annotations must be written first)
+    with BulkWriter(dmim_con, qry_drop_dup_ann_ids, 'add_annotations (drop duplicates)') as drop_writer:
+        remove_duplicate_annotations(dmim_cur1, dmim_cur2, drop_writer)
 
-    # commit changes and close DB connections
-    dmim_con.commit()
-    dmim_con.close()
     rep_con.close()
+    return {
+        'annotations': ann_writer.n_rows - drop_writer.n_rows,
+        'no_annotation_parents': noann_p,
+        'no_annotation_metabolites': noann_m,
+    }
+
+
+def main(version):
+    """ main execution """
+    dmim_fname = 'DMIM_v{version}.db'.format(version=version)
+
+    # initialize the database connection
+    dmim_con = build_connect(dmim_fname)
+
+    build_stage(dmim_con)
+
+    # close DB connection
+    dmim_con.close()
 
 
@@ -3,24 +3,41 @@
     Computes MQNs for all annotations
 """
 
-from sqlite3 import connect
 from io import StringIO
-from numpy import loadtxt, array, sum, abs, sqrt, dot, histogram, concatenate
+from numpy import (
+    loadtxt, array, sum, abs, sqrt, dot, histogram, concatenate, asarray, empty, unique, matmul,
+    searchsorted, zeros, arange, add, frombuffer
+)
 from numpy.linalg import eigh
 
+try:
+    from bulk_writer import build_connect, BulkWriter
+    from xyzmq import xyzmq_to_array, iter_structure_arrays
+    from descriptor_cache import content_key, default_cache
+except ImportError:
+    # imported as part of the build package (e.g. by prediction/helpers.py)
+    from .bulk_writer import build_connect, BulkWriter
+    from .xyzmq import xyzmq_to_array, iter_structure_arrays
+    from .descriptor_cache import content_key, default_cache
+
 
 # define queries
-# get data from the DMIM DB
-qry_dmim_plate_n_3d = """
+# get data from the DMIM DB (only structures that do not have MD3Ds yet), packed structures along with the text ones
+# for any that are not packed (see xyzmq.iter_structure_arrays)
+qry_dmim_3d = """
 SELECT 
-    str_id, structure
+    str_id, n_atoms, xyzmq, structure
 FROM
-    plate_{n}_3d
+    dmim_3d
+WHERE
+    str_id NOT IN (SELECT str_id FROM dmim_md3d)
+ORDER BY
+    str_id
 ;"""
 
-# insert MQNs for plate N
-qry_dmim_plate_n_md3d = """
-INSERT INTO plate_{n}_md3d
+# insert MD3Ds
+qry_dmim_md3d = """
+INSERT INTO dmim_md3d
     (str_id, pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p)
 VALUES
     (?,?,?,?,?,?,?,?,?)
@@ -28,7 +45,15 @@ VALUES
 
 
 def load_and_center_xyzmq(str_data):
-    *xyz, m, q = loadtxt(StringIO(str_data), unpack=True)
+    return center_xyzmq(loadtxt(StringIO(str_data), ndmin=2))
+
+
+def center_xyzmq(values):
+    """
+        values - structure array, shape: (n_atoms, 5), columns are x, y, z, mass, charge (see xyzmq.py)
+        returns: mass-centered x, y, and z coords with shape (3, n_atoms), atom masses with shape (n_atoms,)
+    """
+    *xyz, m, q = asarray(values, dtype=float).T
     xyz = array(xyz)
     tm = sum(m)
     com = array([sum(m * _ / tm) for _ in xyz])
@@ -84,9 +109,18 @@ def mass_dist(mcxyz):
     return mdist
 
 
+# RMD bins, hard-coded based on distributions of all structures
+rmd_bins = [0, 2, 4, 6, 8, 20]
+
+# definition of the MD3Ds stored in the descriptor cache, change this if the way they are computed changes
+MD3D_DEFINITION = 'pmi, rmd v1 (bins {})'.format(','.join(str(_) for _ in rmd_bins))
+
+# packed MD3D dtype in the descriptor cache
+md3d_dtype = '<f8'
+
+
 def mass_hist(mdist):
-    bins = [0, 2, 4, 6, 8, 20]  # hard-coded based on distributions of all structures
-    mhist, _ = histogram(mdist, bins=bins, density=True)
+    mhist, _ = histogram(mdist, bins=rmd_bins, density=True)
     return mhist
 
 
@@ -101,36 +135,194 @@ def compute_3d_descriptors(structure):
     return I1, I2, I3, *mhist
 
 
-def add_md3d(dmim_cursor1, dmim_cursor2):
-    """ compute 3D molecular descriptors for all 3D structures """
-    # count the number of dmim_ids without annotations
-    nomd3ds = 0
-    # iterate through all plates
-    for n in range(1, 8):
-        for str_id, structure in dmim_cursor1.execute(qry_dmim_plate_n_3d.format(n=n)).fetchall():
-            success = False
-            try:
-                qdata = (str_id, *compute_3d_descriptors(structure))
-                dmim_cursor2.execute(qry_dmim_plate_n_md3d.format(n=n), qdata)
-                success = True
-            except Exception as e:
-                print(e)
-                nomd3ds += 1
+def parse_xyzmq(structure):
+    """
+        parses a structure in xyzmq format (text) without the overhead of loadtxt
+        returns: xyz coordinates with shape (n_atoms, 3), atom masses with shape (n_atoms,)
+    """
+    values = xyzmq_to_array(structure)
+    return values[:, :3], values[:, 3]
+
+
+def batch_inertia_tensor(mcxyz, m):
+    """
+        mcxyz - centered x, y, and z coords, shape: (n_structures, 3, n_atoms)
+        m - atom masses, shape: (n_structures, n_atoms)
+        returns: inertia tensors, shape: (n_structures, 3, 3)
+    """
+    cx, cy, cz = mcxyz[:, 0], mcxyz[:, 1], mcxyz[:, 2]
+    I = empty((len(m), 3, 3))
+    I[:, 0, 0] = sum(m * (cy**2. + cz**2.), axis=1)
+    I[:, 1, 1] = sum(m * (cx**2. + cz**2.), axis=1)
+    I[:, 2, 2] = sum(m * (cy**2. + cx**2.), axis=1)
+    I[:, 0, 1] = I[:, 1, 0] = -sum(m * cx * cy, axis=1)
+    I[:, 0, 2] = I[:, 2, 0] = -sum(m * cx * cz, axis=1)
+    I[:, 1, 2] = I[:, 2, 1] = -sum(m * cz * cy, axis=1)
+    return I
+
+
+def _batch_3d_descriptors_n(xyz, m):
+    """
+        computes 3D descriptors for a batch of structures that all have the same number of atoms, uses the same
+        operations (in the same order) as compute_3d_descriptors, so the results are identical
+        xyz - coordinates, shape: (n_structures, 3, n_atoms)
+        m - atom masses, shape: (n_structures, n_atoms)
+    """
+    # center
+    tm = sum(m, axis=1)
+    com = sum(m[:, None, :] * xyz / tm[:, None, None], axis=2)
+    mcxyz = xyz - com[:, :, None]
+    # PMI, all of the inertia tensors are diagonalized with one batched eigh call
+    _, axes = eigh(batch_inertia_tensor(mcxyz, m))
+    rxyz = matmul(mcxyz.transpose(0, 2, 1), axes).transpose(0, 2, 1)
+    pmis, _ = eigh(batch_inertia_tensor(rxyz, m))
+    # binned mass distances, same bin assignment and density normalization as numpy.histogram
+    cx, cy, cz = mcxyz[:, 0], mcxyz[:, 1], mcxyz[:, 2]
+    mdist = sqrt(cx**2. + cy**2. + cz**2.)
+    n_bins = len(rmd_bins) - 1
+    ibin = searchsorted(rmd_bins, mdist, side='right') - 1
+    # the last bin includes its right edge
+    ibin[mdist == rmd_bins[-1]] = n_bins - 1
+    inside = (mdist >= rmd_bins[0]) & (mdist <= rmd_bins[-1])
+    rows = arange(len(m))[:, None].repeat(m.shape[1], axis=1)
+    counts = zeros((len(m), n_bins), dtype=int)
+    add.at(counts, (rows[inside], ibin[inside]), 1)
+    widths = array([b - a for a, b in zip(rmd_bins[:-1], rmd_bins[1:])], dtype=float)
+    mhist = counts / widths / sum(counts, axis=1)[:, None]
+    return concatenate([pmis, mhist], axis=1)
+
+
+def batch_3d_descriptors(xyz, m, n_atoms=None):
+    """
+        computes 3D descriptors for many structures at once, results are identical to compute_3d_descriptors
+        structures are grouped by number of atoms and each group is computed as one dense array
+        xyz - coordinates, either a list of arrays with shape (n_atoms_i, 3) (ragged) or an array with shape
+              (n_structures, max_atoms, 3) (padded)
+        m - atom masses, either a list of arrays with shape (n_atoms_i,) (ragged) or an array with shape
+            (n_structures, max_atoms) (padded)
+        n_atoms - number of atoms in each structure, required with padded arrays
+        returns: descriptors (pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p), shape: (n_structures, 8)
+    """
+    if n_atoms is None:
+        n_atoms = array([len(_) for _ in m], dtype=int)
+    else:
+        n_atoms = asarray(n_atoms, dtype=int)
+    md3ds = empty((len(n_atoms), 8))
+    for n in unique(n_atoms):
+        idx = (n_atoms == n).nonzero()[0]
+        group_xyz = array([asarray(xyz[i], dtype=float)[:n].T for i in idx])
+        group_m = array([asarray(m[i], dtype=float)[:n] for i in idx])
+        md3ds[idx] = _batch_3d_descriptors_n(group_xyz, group_m)
+    return md3ds
+
+
+def structure_key(xyz, m):
+    """ descriptor cache key of a structure, a hash of its parsed coordinates and masses (charges are not used) """
+    return content_key('xyzm', asarray(xyz, dtype=md3d_dtype).tobytes(), asarray(m, dtype=md3d_dtype).tobytes())
+
+
+def cached_md3ds(xyz, m, cache):
+    """
+        same as batch_3d_descriptors (with ragged arrays) but looks the descriptors up in a DescriptorCache first,
+        only the structures that are missing are computed (and added to the cache)
+        cache - DescriptorCache or None to compute everything
+        returns: descriptors, shape: (n_structures, 8)
+    """
+    if cache is None:
+        return batch_3d_descriptors(xyz, m)
+    keys = [structure_key(_xyz, _m) for _xyz, _m in zip(xyz, m)]
+    found = cache.get_many('md3d', MD3D_DEFINITION, keys)
+    md3ds = empty((len(keys), 8))
+    missing = []
+    for i, key in enumerate(keys):
+        if key in found:
+            md3ds[i] = frombuffer(found[key], dtype=md3d_dtype)
+        else:
+            missing.append(i)
+    if missing:
+        md3ds[missing] = batch_3d_descriptors([xyz[i] for i in missing], [m[i] for i in missing])
+        new_entries = {keys[i]: md3ds[i].astype(md3d_dtype).tobytes() for i in missing}
+        cache.put_many('md3d', MD3D_DEFINITION, new_entries.items())
+    return md3ds
+
+
+def compute_3d_descriptors_batch(structures, cache=None):
+    """
+        batch version of compute_3d_descriptors, takes a list of structures (xyzmq format, text)
+        cache - DescriptorCache used to avoid recomputing descriptors (None to compute everything)
+        returns: descriptors, shape: (n_structures, 8)
+    """
+    xyz, m = [], []
+    for structure in structures:
+        _xyz, _m = parse_xyzmq(structure)
+        xyz.append(_xyz)
+        m.append(_m)
+    return cached_md3ds(xyz, m, cache)
+
+
+def add_md3d(dmim_cursor, md3d_writer, chunk_size=5000, cache=None):
+    """ compute 3D molecular descriptors for all 3D structures, chunk_size structures at a time, structures are read
+        as arrays (see xyzmq.iter_structure_arrays) so the packed ones do not need to be parsed
+        cache - DescriptorCache used to avoid recomputing descriptors (None to compute everything)
+        returns: number of structures without MD3Ds """
+    # structures that could not be parsed (no MD3Ds)
+    errors = []
+    structures = list(iter_structure_arrays(dmim_cursor, qry=qry_dmim_3d, errors=errors))
+    for _, e in errors:
+        print(e)
+    nomd3ds = len(errors)
+    for i in range(0, len(structures), chunk_size):
+        str_ids = [str_id for str_id, _ in structures[i:i + chunk_size]]
+        xyz = [values[:, :3] for _, values in structures[i:i + chunk_size]]
+        m = [values[:, 3] for _, values in structures[i:i + chunk_size]]
+        n_atoms = [len(values) for _, values in structures[i:i + chunk_size]]
+        try:
+            if cache is None:
+                md3ds = batch_3d_descriptors(xyz, m, n_atoms)
+            else:
+                md3ds = cached_md3ds(xyz, m, cache)
+        except Exception:
+            # fall back to one structure at a time to find the one(s) that fail
+            md3ds, ok_ids = [], []
+            for str_id, _xyz, _m in zip(str_ids, xyz, m):
+                try:
+                    md3ds.append(batch_3d_descriptors([_xyz], [_m])[0])
+                    ok_ids.append(str_id)
+                except Exception as e:
+                    print(e)
+                    nomd3ds += 1
+            str_ids = ok_ids
+        for str_id, md3d in zip(str_ids, md3ds):
+            md3d_writer.add((str_id, *md3d))
     print(nomd3ds, 'structures have no MD3Ds')
+    return nomd3ds
+
+
+def build_stage(dmim_con):
+    """ build stage entry point (see build.py)
+        returns: counts for the build report """
+    dmim_cur = dmim_con.cursor()
+
+    # compute MD3Ds for all 3D structures, reusing any that are in the descriptor cache
+    cache = default_cache()
+    with BulkWriter(dmim_con, qry_dmim_md3d, 'add_md3d') as md3d_writer:
+        nomd3ds = add_md3d(dmim_cur, md3d_writer, cache=cache)
+    counts = {'md3ds': md3d_writer.n_rows, 'no_md3d': nomd3ds}
+    if cache is not None:
+        counts['cached_md3ds'] = cache.hits
+        cache.close()
+    return counts
 
 
 def main(version):
     """ main execution """
     dmim_fname = 'DMIM_v{version}.db'.format(version=version)
 
-    # initialize the database connections
-    dmim_con = connect(dmim_fname)
-    dmim_cur1, dmim_cur2 = dmim_con.cursor(), dmim_con.cursor()
+    # initialize the database connection
+    dmim_con = build_connect(dmim_fname)
 
-    # transfer parent MS spectra from replicate DB to DMIM DB
-    add_md3d(dmim_cur1, dmim_cur2)
+    build_stage(dmim_con)
 
-    # commit changes and close DB connections
-    dmim_con.commit()
+    # close DB connection
     dmim_con.close()
 
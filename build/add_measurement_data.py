@@ -1,29 +1,59 @@
 """
     Adds all of the CCS measurement data (from replicate data DB)
     Only adds entries which have 3 replicate CCS values and abs(RSD) < 5%
+
+    The replicate data DB is attached to the DMIM DB connection and each plate is transferred with a single
+    INSERT ... SELECT, parse_cmpd and sd_to_rsd are registered as SQL functions so they can be used in the query
 """
 
-from sqlite3 import connect
 import re
 
+from bulk_writer import build_connect
+from stage_graph import ReuseIds
+
+
+# replicate data DB
+rep_fname = 'replicate_data_assigned_MS2.db'
+
 
 # define queries
-# fetch data from plate N, only compounds that have 3 CCS reps
-qry_rep_plate_n = """
-SELECT 
-    cmpd, well, mz, ccs_avg, ccs_sd, ccs_r1, ccs_r2, ccs_r3
+# get existing entries (to reuse their dmim_ids)
+qry_dmim_existing = """
+SELECT
+    plate, well, name, adduct, dmim_id
 FROM
-    plate_{n}
+    main.dmim
+;"""
+
+# transfer data from plate N of the (attached) replicate DB, only compounds that have 3 CCS reps and abs(RSD) < 5%,
+# entries that were already in the DB keep their DMIM ID, new entries are numbered consecutively (in the order of the
+# replicate DB) after the highest DMIM ID used so far
+qry_transfer_plate_n = """
+INSERT INTO dmim
+    (dmim_id, plate, well, name, met_n, adduct, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3)
+SELECT
+    reuse_dmim_id({n}, well, cmpd_name(cmpd), cmpd_adduct(cmpd)),
+    {n}, well, cmpd_name(cmpd), cmpd_met_n(cmpd), cmpd_adduct(cmpd), mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3
+FROM (
+    SELECT
+        rowid, cmpd, well, mz, ccs_avg, sd_to_rsd(ccs_avg, ccs_sd) AS ccs_rsd, ccs_r1, ccs_r2, ccs_r3
+    FROM
+        rep.plate_{n}
+    WHERE
+        ccs_reps = 3
+)
 WHERE
-    ccs_reps = 3
+    abs(ccs_rsd) < 5.
+ORDER BY
+    rowid
 ;"""
 
-# add an entry to plate N of the DMIM DB
-qry_dmim_plate_n = """
-INSERT INTO plate_{n}
-    (dmim_id, well, name, met_n, adduct, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3)
-VALUES
-    (?,?,?,?,?,?,?,?,?,?,?)
+# count the entries that were transferred
+qry_dmim_count = """
+SELECT
+    COUNT(*), COALESCE(SUM(met_n = 0), 0), COALESCE(SUM(met_n > 0), 0)
+FROM
+    dmim
 ;"""
 
 # define regex patterns
@@ -46,47 +76,64 @@ def sd_to_rsd(ccs_avg, ccs_sd):
     return 100. * ccs_sd / ccs_avg 
 
 
-def transfer_data(dmim_cursor, rep_cursor):
-    """ transfer data from replicate DB to DMIM DB """
-    # DMIM ID starts at 1
-    i = 1
-    n_p, n_m = 0, 0
+def reuse_dmim_id_func(dmim_cursor):
+    """ makes a function that assigns the DMIM ID of an entry from its natural key (plate, well, name, adduct),
+        entries that are already in the DB keep their DMIM ID so that an incremental build only replaces the entries
+        that actually changed
+        returns: function(plate, well, name, adduct) -> DMIM ID """
+    existing = [((plate, well, name, adduct), int(dmim_id[4:]))
+                for plate, well, name, adduct, dmim_id in dmim_cursor.execute(qry_dmim_existing).fetchall()]
+    dmim_ids = ReuseIds(existing)
+    return lambda plate, well, name, adduct: 'DMIM{:05d}'.format(dmim_ids.get((plate, well, name, adduct)))
+
+
+def register_functions(dmim_con):
+    """ registers parse_cmpd (as cmpd_name, cmpd_met_n, cmpd_adduct), sd_to_rsd and the DMIM ID assignment (as
+        reuse_dmim_id, see reuse_dmim_id_func) as SQL functions """
+    dmim_con.create_function('cmpd_name', 1, lambda cmpd: parse_cmpd(cmpd)[0], deterministic=True)
+    dmim_con.create_function('cmpd_met_n', 1, lambda cmpd: parse_cmpd(cmpd)[1], deterministic=True)
+    dmim_con.create_function('cmpd_adduct', 1, lambda cmpd: parse_cmpd(cmpd)[2], deterministic=True)
+    dmim_con.create_function('sd_to_rsd', 2, sd_to_rsd, deterministic=True)
+    # not deterministic, new IDs are handed out in the order the rows are transferred
+    dmim_con.create_function('reuse_dmim_id', 4, reuse_dmim_id_func(dmim_con.cursor()))
+
 
+def transfer_data(dmim_cursor):
+    """ transfer data from replicate DB (attached as rep) to DMIM DB
+        returns: number of entries, parents, metabolites """
     # iterate through all plates
     for n in range(1, 8):
-        # iterate through all of the compounds in the replicate DB
-        for cmpd, well, mz, ccs_avg, ccs_sd, ccs_r1, ccs_r2, ccs_r3 in rep_cursor.execute(qry_rep_plate_n.format(n=n)).fetchall():
-            name, met_n, adduct = parse_cmpd(cmpd)
-            ccs_rsd = sd_to_rsd(ccs_avg, ccs_sd)
-            if abs(ccs_rsd) < 5.:
-                dmim_id = 'DMIM{:05d}'.format(i)
-                qdata = (dmim_id, well, name, met_n, adduct, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3)
-                dmim_cursor.execute(qry_dmim_plate_n.format(n=n), qdata)
-                i += 1
-                if met_n > 0:
-                    n_m += 1
-                else:
-                    n_p += 1
-    print('{} entries total'.format(i - 1), '({} parents, {} metabolites)'.format(n_p, n_m))
+        dmim_cursor.execute(qry_transfer_plate_n.format(n=n))
+    n_all, n_p, n_m = dmim_cursor.execute(qry_dmim_count).fetchall()[0]
+    print('{} entries total'.format(n_all), '({} parents, {} metabolites)'.format(n_p, n_m))
+    return n_all, n_p, n_m
+
+
+def build_stage(dmim_con):
+    """ build stage entry point (see build.py)
+        returns: counts for the build report """
+    dmim_cur = dmim_con.cursor()
+    register_functions(dmim_con)
+    dmim_cur.execute('ATTACH DATABASE ? AS rep;', (rep_fname,))
+
+    # transfer data from replicate DB to DMIM DB
+    n_all, n_p, n_m = transfer_data(dmim_cur)
+    dmim_con.commit()
+
+    dmim_cur.execute('DETACH DATABASE rep;')
+    return {'entries': n_all, 'parents': n_p, 'metabolites': n_m}
 
 
 def main(version):
     """ main execution """
     dmim_fname = 'DMIM_v{version}.db'.format(version=version)
-    rep_fname = 'replicate_data_assigned_MS2.db'
 
-    # initialize the database connections
-    dmim_con = connect(dmim_fname)
-    dmim_cur = dmim_con.cursor()
-    rep_con = connect(rep_fname)
-    rep_cur = rep_con.cursor()
+    # initialize the database connection
+    dmim_con = build_connect(dmim_fname)
 
-    # transfer data from replicate DB to DMIM DB
-    transfer_data(dmim_cur, rep_cur)
+    build_stage(dmim_con)
 
-    # commit changes and close DB connections
-    dmim_con.commit()
+    # close DB connection
     dmim_con.close()
-    rep_con.close()
 
 
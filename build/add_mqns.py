@@ -1,68 +1,236 @@
 #!/usr/local/Cellar/python@3.9/3.9.0_4/bin/python3 
 """
     Computes MQNs for all annotations
+
+    MQNs are computed by iter_mqns, which splits the SMILES structures into chunks that are parsed by a pool of worker
+    processes and streams the results back in input order. It is also used to featurize new compounds (see
+    prediction/helpers.py), so it works on any iterable of (key, SMILES) pairs, not just the annotations in the DB.
+    cached_mqns looks the MQNs up in the persistent descriptor cache first (see descriptor_cache.py) and only computes
+    the ones that are missing, the workers also return the canonical SMILES of each structure so that nothing is
+    parsed in the main process.
 """
 
-from sqlite3 import connect
-from rdkit import Chem
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from numpy import array, frombuffer
+
+from rdkit import Chem, rdBase
 from rdkit.Chem import Descriptors
 
+try:
+    from bulk_writer import build_connect, BulkWriter
+    from descriptor_cache import content_key, default_cache
+except ImportError:
+    # imported as part of the build package (e.g. by prediction/helpers.py)
+    from .bulk_writer import build_connect, BulkWriter
+    from .descriptor_cache import content_key, default_cache
+
 
 
 # define queries
-# get data from the DMIM DB
-qry_dmim_plate_n_id = """
+# get data from the DMIM DB (only annotations that do not have MQNs yet)
+qry_dmim_ann = """
 SELECT 
     ann_id, smi
 FROM
-    plate_{n}_id
+    dmim_ann
+WHERE
+    ann_id NOT IN (SELECT ann_id FROM dmim_mqn)
+ORDER BY
+    ann_id
 ;"""
 
-# insert MQNs for plate N
-qry_dmim_plate_n_mqn = """
-INSERT INTO plate_{n}_mqn
+# insert MQNs
+qry_dmim_mqn = """
+INSERT INTO dmim_mqn
     (ann_id, mqns)
 VALUES
     (?,?)
 ;"""
 
 
+# packed MQN dtype, explicitly little-endian so the BLOBs are portable
+mqns_dtype = '<u2'
+
+# definition of the MQNs stored in the descriptor cache, change this if the way they are computed changes
+MQN_DEFINITION = 'MQNs_ v1 (rdkit {})'.format(rdBase.rdkitVersion)
+
+
+def pack_mqns(mqns):
+    """ packs a vector of 42 MQNs into a BLOB of little-endian uint16 """
+    packed = array(mqns, dtype=int)
+    if packed.shape != (42,) or packed.min() < 0 or packed.max() > 65535:
+        raise ValueError('pack_mqns: expected 42 MQNs in the range 0-65535')
+    return packed.astype(mqns_dtype).tobytes()
+
+
+def unpack_mqns(blob):
+    """ unpacks MQNs packed with pack_mqns, returns an array with shape (42,) """
+    return frombuffer(blob, dtype=mqns_dtype)
+
+
 def smi_to_mqn(smi):
     """ returns MQNs for an input SMILES structure """
     return Descriptors.rdMolDescriptors.MQNs_(Chem.MolFromSmiles(smi))
 
 
-def compute_mqns(dmim_cursor1, dmim_cursor2):
-    """ compute MQNs for all of the annotations """
-    # count the number of dmim_ids without annotations
-    nomqns = 0
-    # iterate through all plates
-    for n in range(1, 8):
-        for ann_id, smi in dmim_cursor1.execute(qry_dmim_plate_n_id.format(n=n)).fetchall():
-            success = False
-            try:
-                mqns = smi_to_mqn(smi)
-                qdata = (ann_id, ' '.join([str(_) for _ in mqns]))
-                dmim_cursor2.execute(qry_dmim_plate_n_mqn.format(n=n), qdata)
-                success = True
-            except Exception as e:
-                print(e)
-                nomqns += 1
-    print(nomqns, 'annotations have no MQNs')
+def smi_to_mqn_canonical(smi):
+    """ returns MQNs and the RDKit canonical SMILES for an input SMILES structure (parsed only once) """
+    mol = Chem.MolFromSmiles(smi)
+    return Descriptors.rdMolDescriptors.MQNs_(mol), Chem.MolToSmiles(mol)
+
+
+def mqn_chunk(chunk, canonical=False):
+    """ computes MQNs for a chunk of (key, SMILES) pairs, this is what runs in the worker processes
+        canonical - also compute the canonical SMILES of each structure
+        returns: list of (key, MQNs or None, error message or None), or (key, MQNs or None, error message or None,
+                 canonical SMILES or None) with canonical=True """
+    results = []
+    for key, smi in chunk:
+        try:
+            if canonical:
+                mqns, canon = smi_to_mqn_canonical(smi)
+                results.append((key, mqns, None, canon))
+            else:
+                results.append((key, smi_to_mqn(smi), None))
+        except Exception as e:
+            results.append((key, None, str(e), None) if canonical else (key, None, str(e)))
+    return results
+
+
+def iter_chunks(items, chunk_size):
+    """ yields lists of up to chunk_size items from an iterable """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_mqns(items, n_workers=None, chunk_size=500, errors=None, canonical=False):
+    """ computes MQNs for an iterable of (key, SMILES) pairs using a pool of worker processes
+        yields (key, MQNs) in the same order as the input, items that fail are skipped and (key, error message) is
+        appended to errors (if provided), at most 2 chunks per worker are in flight so the input is only consumed as
+        fast as the results are
+        n_workers - number of worker processes (None to use the number of CPUs, 1 to run in this process)
+        chunk_size - number of SMILES sent to a worker at a time
+        canonical - yield (key, MQNs, canonical SMILES) instead, the canonical SMILES are computed by the workers """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers == 1:
+        chunk_results = (mqn_chunk(chunk, canonical) for chunk in iter_chunks(items, chunk_size))
+        yield from _unpack_chunks(chunk_results, errors)
+        return
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        in_flight = deque()
+        for chunk in iter_chunks(items, chunk_size):
+            in_flight.append(pool.submit(mqn_chunk, chunk, canonical))
+            if len(in_flight) >= 2 * n_workers:
+                yield from _unpack_chunks([in_flight.popleft().result()], errors)
+        yield from _unpack_chunks((future.result() for future in in_flight), errors)
+
+
+def _unpack_chunks(chunk_results, errors):
+    """ yields (key, MQNs) or (key, MQNs, canonical SMILES) from chunk results, collecting errors """
+    for results in chunk_results:
+        for key, mqns, err, *canon in results:
+            if err is None:
+                yield (key, mqns, *canon)
+            elif errors is not None:
+                errors.append((key, err))
+
+
+def cached_mqns(items, cache, n_workers=None, errors=None):
+    """ same as iter_mqns but looks the MQNs up in a DescriptorCache first, only the ones that are missing are computed
+        (and added to the cache), entries are keyed on the SMILES as given, so that exact repeats do not need to be
+        parsed at all, and on the canonical SMILES computed by the workers along with the MQNs, SMILES that are
+        looked up are tried as both (any canonical SMILES finds the MQNs computed from other forms of the same
+        structure) so nothing is parsed in this process
+        cache - DescriptorCache or None to compute everything
+        returns: list of (key, MQNs) in the same order as the input """
+    items = list(items)
+    if cache is None:
+        return list(iter_mqns(items, n_workers=n_workers, errors=errors))
+    # look up the SMILES as given
+    smi_keys = [content_key('smi', smi) for _, smi in items]
+    found = cache.get_many('mqn', MQN_DEFINITION, smi_keys)
+    # then as canonical SMILES
+    canon_keys = {smi_key: content_key('canonical', smi) for (_, smi), smi_key in zip(items, smi_keys)
+                  if smi_key not in found}
+    found_canon = cache.get_many('mqn', MQN_DEFINITION, canon_keys.values())
+    new_entries = []
+    for smi_key, canon_key in canon_keys.items():
+        if canon_key in found_canon and smi_key not in found:
+            found[smi_key] = found_canon[canon_key]
+            new_entries.append((smi_key, found_canon[canon_key]))
+    # compute the rest
+    missing, queued = [], set()
+    for i, ((_, smi), smi_key) in enumerate(zip(items, smi_keys)):
+        if smi_key not in found and smi_key not in queued:
+            missing.append((i, smi))
+            queued.add(smi_key)
+    mqn_errors = []
+    for i, mqns, canon in iter_mqns(missing, n_workers=n_workers, errors=mqn_errors, canonical=True):
+        blob = pack_mqns(mqns)
+        found[smi_keys[i]] = blob
+        new_entries.append((smi_keys[i], blob))
+        new_entries.append((content_key('canonical', canon), blob))
+    if new_entries:
+        cache.put_many('mqn', MQN_DEFINITION, new_entries)
+    if errors is not None:
+        failed = {smi_keys[i]: err for i, err in mqn_errors}
+        errors += [(key, failed[smi_key]) for (key, _), smi_key in zip(items, smi_keys) if smi_key in failed]
+    return [(key, unpack_mqns(found[smi_key]).tolist()) for (key, _), smi_key in zip(items, smi_keys)
+            if smi_key in found]
+
+
+def compute_mqns(dmim_cursor, mqn_writer, n_workers=None, cache=None):
+    """ compute MQNs for all of the annotations
+        cache - DescriptorCache used to avoid recomputing MQNs (None to compute everything)
+        returns: number of annotations without MQNs """
+    # keep track of the annotations without MQNs
+    errors = []
+    # iterate through all annotations
+    items = dmim_cursor.execute(qry_dmim_ann).fetchall()
+    for ann_id, mqns in cached_mqns(items, cache, n_workers=n_workers, errors=errors):
+        qdata = (ann_id, pack_mqns(mqns))
+        mqn_writer.add(qdata)
+    for ann_id, err in errors:
+        print(err)
+    print(len(errors), 'annotations have no MQNs')
+    return len(errors)
+
+
+def build_stage(dmim_con):
+    """ build stage entry point (see build.py)
+        returns: counts for the build report """
+    dmim_cur = dmim_con.cursor()
+
+    # compute MQNs for all annotations, reusing any that are in the descriptor cache
+    cache = default_cache()
+    with BulkWriter(dmim_con, qry_dmim_mqn, 'add_mqns') as mqn_writer:
+        nomqns = compute_mqns(dmim_cur, mqn_writer, cache=cache)
+    counts = {'mqns': mqn_writer.n_rows, 'no_mqns': nomqns}
+    if cache is not None:
+        counts['cached_mqns'] = cache.hits
+        cache.close()
+    return counts
 
 
 def main(version):
     """ main execution """
     dmim_fname = 'DMIM_v{version}.db'.format(version=version)
 
-    # initialize the database connections
-    dmim_con = connect(dmim_fname)
-    dmim_cur1, dmim_cur2 = dmim_con.cursor(), dmim_con.cursor()
+    # initialize the database connection
+    dmim_con = build_connect(dmim_fname)
 
-    # transfer parent MS spectra from replicate DB to DMIM DB
-    compute_mqns(dmim_cur1, dmim_cur2)
+    build_stage(dmim_con)
 
-    # commit changes and close DB connections
-    dmim_con.commit()
+    # close DB connection
     dmim_con.close()
 
@@ -1,85 +1,103 @@
 """
     Adds MS2 spectra from the plate_N_ms2 tables
+
+    The replicate data DB is attached to the DMIM DB connection and the spectra for each plate are transferred with a
+    single INSERT ... SELECT joining plate_N_ms2 to the dmim table, then the spectra are packed and their fragments
+    are indexed (see ms2_spectra.py)
 """
 
-from sqlite3 import connect
+from bulk_writer import build_connect, BulkWriter
+from ms2_spectra import qry_set_packed, qry_insert_frag, pack_spectra, index_fragments
+
+
+# replicate data DB
+rep_fname = 'replicate_data_assigned_MS2.db'
 
 
 # define queries
-# get data from the DMIM DB
-qry_dmim_plate_n = """
-SELECT 
-    dmim_id, well, name, adduct
+# transfer MS2 data for plate N from the (attached) replicate DB
+qry_transfer_plate_n_ms2 = """
+INSERT INTO dmim_ms2
+    (dmim_id, spectrum, metfrag_score)
+SELECT
+    dmim.dmim_id, spectrum, metfrag_score
 FROM
-    plate_{n}
+    dmim
+    JOIN rep.plate_{n}_ms2 AS ms2
+        ON ms2.cmpd = dmim.name || '_' || dmim.adduct
+        AND ms2.well = dmim.well
+        AND ms2.adduct = dmim.adduct
+WHERE
+    dmim.plate = {n}
+ORDER BY
+    dmim.dmim_id
 ;"""
 
-# get MS2 data from the replicate DB
-qry_rep_plate_n_ms2 = """
-SELECT 
-    spectrum, metfrag_score
+# count entries without spectra and spectra without metfrag scores
+qry_ms2_counts = """
+SELECT
+    (SELECT COUNT(*) FROM dmim WHERE dmim_id NOT IN (SELECT dmim_id FROM dmim_ms2)),
+    COALESCE(SUM(metfrag_score IS NULL AND instr(name, '_met') > 0), 0),
+    COALESCE(SUM(metfrag_score IS NULL AND instr(name, '_met') = 0), 0)
 FROM
-    plate_{n}_ms2
-WHERE 
-    cmpd = ?
-    AND well = ?
-    AND adduct = ?
+    dmim_ms2
+    JOIN dmim
+        ON dmim_ms2.dmim_id = dmim.dmim_id
 ;"""
 
-# insert MS2 for plate N
-qry_dmim_plate_n_ms2 = """
-INSERT INTO plate_{n}_ms2
-    (dmim_id, spectrum, metfrag_score)
-VALUES
-    (?,?,?)
+# get the plates in the DMIM DB
+qry_plates = """
+SELECT DISTINCT
+    plate
+FROM
+    dmim
+ORDER BY
+    plate
 ;"""
 
 
-def transfer_spectra(dmim_cursor1, dmim_cursor2, rep_cursor):
-    """ transfer parent MS2 spectra replicate DB to DMIM DB """
-    # count the number of dmim_ids without annotations
-    noms2 = 0
-    # count null metfrag scores
-    score_null_p, score_null_m = 0, 0
-    # iterate through all plates
-    for n in range(1, 8):
-        for dmim_id, well, name, adduct in dmim_cursor1.execute(qry_dmim_plate_n.format(n=n)).fetchall():
-            matched = False
-            cmpd = '{}_{}'.format(name, adduct)
-            qdata1 = (cmpd, well, adduct)
-            for spectrum, metfrag_score in rep_cursor.execute(qry_rep_plate_n_ms2.format(n=n), qdata1).fetchall():
-                    qdata2 = (dmim_id, spectrum, metfrag_score)
-                    dmim_cursor2.execute(qry_dmim_plate_n_ms2.format(n=n), qdata2)
-                    matched = True
-                    if metfrag_score is None:
-                        if '_met' in name:
-                            score_null_p += 1
-                        else:
-                            score_null_m += 1
-            if not matched:
-                noms2 += 1
-                #print('ERROR! annotation for: {} {} {}'.format(dmim_id, well, met_n))
+def transfer_spectra(dmim_cursor):
+    """ transfer parent MS2 spectra replicate DB (attached as rep) to DMIM DB
+        returns: number of entries without MS2 spectra, parents and metabolites with NULL metfrag_score """
+    # spectra come from the plate_N_ms2 table of the replicate DB
+    for n, in dmim_cursor.execute(qry_plates).fetchall():
+        dmim_cursor.execute(qry_transfer_plate_n_ms2.format(n=n))
+    noms2, score_null_p, score_null_m = dmim_cursor.execute(qry_ms2_counts).fetchall()[0]
     print(noms2, 'have no MS2 spectra')
     print(score_null_p + score_null_m, 'have NULL metfrag_score', '({} parents, {} metabolites)'.format(score_null_p, score_null_m))
+    return noms2, score_null_p, score_null_m
+
+
+def build_stage(dmim_con):
+    """ build stage entry point (see build.py)
+        returns: counts for the build report """
+    dmim_cur = dmim_con.cursor()
+    dmim_cur.execute('ATTACH DATABASE ? AS rep;', (rep_fname,))
+
+    # transfer parent MS spectra from replicate DB to DMIM DB
+    noms2, score_null_p, score_null_m = transfer_spectra(dmim_cur)
+    dmim_con.commit()
+
+    dmim_cur.execute('DETACH DATABASE rep;')
+
+    # pack the spectra and index their fragments
+    with BulkWriter(dmim_con, qry_set_packed, 'add_ms2 (pack)') as pack_writer:
+        pack_spectra(dmim_cur, pack_writer)
+    with BulkWriter(dmim_con, qry_insert_frag, 'add_ms2 (fragment index)') as frag_writer:
+        index_fragments(dmim_cur, frag_writer)
+    return {'no_ms2': noms2, 'null_score_parents': score_null_p, 'null_score_metabolites': score_null_m}
 
 
 def main(version):
     """ main execution """
     dmim_fname = 'DMIM_v{version}.db'.format(version=version)
-    rep_fname = 'replicate_data_assigned_MS2.db'
 
-    # initialize the database connections
-    dmim_con = connect(dmim_fname)
-    dmim_cur1, dmim_cur2 = dmim_con.cursor(), dmim_con.cursor()
-    rep_con = connect(rep_fname)
-    rep_cur = rep_con.cursor()
+    # initialize the database connection
+    dmim_con = build_connect(dmim_fname)
 
-    # transfer parent MS spectra from replicate DB to DMIM DB
-    transfer_spectra(dmim_cur1, dmim_cur2, rep_cur)
+    build_stage(dmim_con)
 
-    # commit changes and close DB connections
-    dmim_con.commit()
+    # close DB connection
     dmim_con.close()
-    rep_con.close()
 
 
@@ -4,12 +4,13 @@
 from matplotlib import pyplot as plt
 from random import random
 from math import pi, sin, cos
+from numpy import array
 
-from add_md3d import load_and_center_xyzmq, mass_dist
+from add_md3d import center_xyzmq, mass_dist
 
 
-def get_mass_dist(str_data):
-    mcxyz, m = load_and_center_xyzmq(str_data)
+def get_mass_dist(values):
+    mcxyz, m = center_xyzmq(values)
     return mass_dist(mcxyz)
 
 
@@ -28,52 +29,52 @@ def plot_mass_dist(mdist, title):
 
 
 def rod():
-    # generate data
-    s = ''
+    # generate data, one row per atom (x, y, z, mass, charge)
+    s = []
     for i in range(1000):
-        s += '{:.3f} {:.3f} {:.3f} {:.3f} {:.3f}\n'.format(float(i), 0., 0., 1., 0.)
-    plot_mass_dist(get_mass_dist(s), 'rod')
+        s.append([float(i), 0., 0., 1., 0.])
+    plot_mass_dist(get_mass_dist(array(s)), 'rod')
 
 
 def ring():
-    # generate data
-    s = ''
+    # generate data, one row per atom (x, y, z, mass, charge)
+    s = []
     for i in range(1000):
         theta = random() * 2. * pi
         x = sin(theta) * 500.
         y = cos(theta) * 500.
-        s += '{:.3f} {:.3f} {:.3f} {:.3f} {:.3f}\n'.format(x, y, 0., 1., 0.)
-    plot_mass_dist(get_mass_dist(s), 'ring')
+        s.append([x, y, 0., 1., 0.])
+    plot_mass_dist(get_mass_dist(array(s)), 'ring')
 
 
 def disc():
-    # generate data
-    s = ''
+    # generate data, one row per atom (x, y, z, mass, charge)
+    s = []
     for r in range(1, 501, 10):
         for i in range(r):
             theta = random() * 2. * pi
             x = sin(theta) * float(r)
             y = cos(theta) * float(r)
-            s += '{:.3f} {:.3f} {:.3f} {:.3f} {:.3f}\n'.format(x, y, 0., 1., 0.)
-    plot_mass_dist(get_mass_dist(s), 'disc')
+            s.append([x, y, 0., 1., 0.])
+    plot_mass_dist(get_mass_dist(array(s)), 'disc')
 
 
 def hollow_sphere():
-    # generate data
-    s = ''
+    # generate data, one row per atom (x, y, z, mass, charge)
+    s = []
     for i in range(1000):
         theta = random() * pi
         phi = random() * 2. * pi
         x = sin(theta) * cos(phi) * 500.
         y = sin(theta) * sin(phi) * 500.
         z = cos(theta) * 500.
-        s += '{:.3f} {:.3f} {:.3f} {:.3f} {:.3f}\n'.format(x, y, z, 1., 0.)
-    plot_mass_dist(get_mass_dist(s), 'hollow sphere')
+        s.append([x, y, z, 1., 0.])
+    plot_mass_dist(get_mass_dist(array(s)), 'hollow sphere')
 
 
 def sphere():
-    # generate data
-    s = ''
+    # generate data, one row per atom (x, y, z, mass, charge)
+    s = []
     for r in range(1, 501, 10):
         for i in range(int(r**2)):
             theta = random() * pi
@@ -81,8 +82,8 @@ def sphere():
             x = sin(theta) * cos(phi) * float(r)
             y = sin(theta) * sin(phi) * float(r)
             z = cos(theta) * float(r)
-            s += '{:.3f} {:.3f} {:.3f} {:.3f} {:.3f}\n'.format(x, y, z, 1., 0.)
-    plot_mass_dist(get_mass_dist(s), 'sphere')
+            s.append([x, y, z, 1., 0.])
+    plot_mass_dist(get_mass_dist(array(s)), 'sphere')
 
 
 
@@ -1,45 +1,125 @@
-#!/usr/local/Cellar/python@3.9/3.9.1_6/bin/python3 
+#!/usr/local/Cellar/python@3.9/3.9.1_6/bin/python3
 """
     Builds DMIM_v?.?.db from individual components
+
+    The build is incremental: each stage records a hash of its inputs in the database (see stage_graph.py) and is
+    skipped when nothing it depends on has changed, so re-running after editing one of the input files only redoes
+    the stages (and rows) downstream of the edit. Use --full to rebuild the database from scratch. Stages that do not
+    depend on each other run in parallel worker processes, use --workers to limit how many.
+
+    A JSON build report with per-stage timing, peak memory and row counts is written next to the database
+    (DMIM_v?.?.build.json), use build_report.py to compare it with the report from a previous build.
+
+    usage:
+        python3 build.py [--full] [--workers N]
 """
 
-from initialize_db import main as init_main
-from add_measurement_data import main as meas_main
-from add_annotations import main as annt_main
-from add_ms2 import main as ms2_main
-from add_mqns import main as mqn_main
-from add_3d import main as a3d_main
-from add_md3d import main as md3d_main
-from filter_metabs_metfrag_score import main as filt_main
+import os
+import sys
+from sqlite3 import connect
+from functools import partial
+from datetime import datetime
+from time import perf_counter, process_time
+
+from initialize_db import main as init_main, SCHEMA_VERSION
+from stage_graph import Stage, run_stages
+from build_report import peak_rss_mb, table_counts, write_report
+from add_measurement_data import build_stage as meas_stage
+from add_annotations import build_stage as annt_stage
+from add_ms2 import build_stage as ms2_stage
+from add_mqns import build_stage as mqn_stage
+from add_3d import build_stage as a3d_stage
+from add_md3d import build_stage as md3d_stage
+from filter_metabs_metfrag_score import build_stage as filt_stage
 from final_table_counts import main as cnt_main
 
 
-def main():
-    """ main build sequence """
-    
-    VERSION = '1.1'
+VERSION = '1.1'
 
-    # initialize database
-    init_main(VERSION)
+# input files
+REP_DB = 'replicate_data_assigned_MS2.db'
+PARENT_JSON = 'parent_data_rmsd.json'
+METAB_JSON = 'metab_data_fixed_rmsd.json'
+
+# MetFrag score threshold for filtering metabolites
+METFRAG_THRESHOLD = 100.
+
+# build stages, in the order they are run
+STAGES = [
     # add in measurement data
-    meas_main(VERSION)
+    Stage('measurement', meas_stage, ['dmim'], 'sync',
+          inputs=[REP_DB]),
     # add annotations
-    annt_main(VERSION)
+    Stage('annotations', annt_stage, ['dmim_ann'], 'sync',
+          inputs=[REP_DB, PARENT_JSON], upstream=['measurement']),
     # add in MS2 spectra
-    ms2_main(VERSION)
-    """
+    Stage('ms2', ms2_stage, ['dmim_ms2', 'dmim_ms2_frag'], 'sync',
+          inputs=[REP_DB], upstream=['measurement']),
     # add in MQNs for all annotated species
-    mqn_main(VERSION)
+    Stage('mqns', mqn_stage, ['dmim_mqn'], 'fill',
+          upstream=['annotations']),
     # add in the 3D structures
-    a3d_main(VERSION)
+    Stage('3d', a3d_stage, ['dmim_3d'], 'sync',
+          inputs=[PARENT_JSON, METAB_JSON], upstream=['annotations']),
     # add MD3Ds for 3D structures
-    md3d_main(VERSION)
+    Stage('md3d', md3d_stage, ['dmim_md3d'], 'fill',
+          upstream=['3d']),
     # filter out metabolites using MetFrag score
-    filt_main(VERSION)
+    Stage('filter', partial(filt_stage, threshold=METFRAG_THRESHOLD),
+          ['dmim_ann', 'dmim_ann_filtered', 'dmim_mqn', 'dmim_3d', 'dmim_md3d'], 'inplace',
+          upstream=['annotations', 'ms2', 'mqns', '3d', 'md3d'], params={'threshold': METFRAG_THRESHOLD}),
+]
+
+
+def needs_init(fname):
+    """ returns True if the database does not exist yet or has an older schema """
+    if not os.path.isfile(fname):
+        return True
+    con = connect(fname)
+    user_version = con.execute('PRAGMA user_version;').fetchall()[0][0]
+    con.close()
+    return user_version != SCHEMA_VERSION
+
+
+def main(full=False, n_workers=None):
+    """ main build sequence """
+    dmim_fname = 'DMIM_v{version}.db'.format(version=VERSION)
+    started = datetime.now().isoformat(timespec='seconds')
+    t0, c0 = perf_counter(), process_time()
+
+    # initialize database
+    if full or needs_init(dmim_fname):
+        init_main(VERSION)
+
+    # run any stages that are out of date
+    stats = run_stages(dmim_fname, STAGES, n_workers=n_workers)
+
     # report the final table counts
-    cnt_main(VERSION)"""
+    cnt_main(VERSION)
 
+    # write the build report
+    con = connect(dmim_fname)
+    report = {
+        'version': VERSION,
+        'schema_version': SCHEMA_VERSION,
+        'started': started,
+        'n_workers': n_workers,
+        'total': {
+            'wall': perf_counter() - t0,
+            # stages that ran in worker processes are not included in the main process' CPU time
+            'cpu': process_time() - c0 + sum([s['cpu'] for s in stats.values() if s['mode'] != 'inplace']),
+            'peak_rss_mb': peak_rss_mb(),
+            'rows_read': sum([s['rows_read'] for s in stats.values()]),
+            'rows_written': sum([s['rows_written'] for s in stats.values()]),
+        },
+        'stages': stats,
+        'tables': table_counts(con.cursor()),
+    }
+    con.close()
+    write_report('DMIM_v{version}.build.json'.format(version=VERSION), report)
 
-if __name__ == '__main__':
-    main()
 
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    n_workers = int(args[args.index('--workers') + 1]) if '--workers' in args else None
+    main(full='--full' in args, n_workers=n_workers)
@@ -0,0 +1,140 @@
+#!/usr/local/Cellar/python@3.9/3.9.1_6/bin/python3
+"""
+    Machine-readable build report for the DMIM database
+
+    Every build stage is instrumented (see stage_graph.py) and the results are written to a JSON report next to the
+    database (DMIM_v{version}.build.json):
+        version, schema_version, started, n_workers - what was built and how
+        total - wall time, CPU time (main process + stage workers) and peak RSS of the whole build
+        stages - per stage: status (ran/skipped), mode, wall time, CPU time, merge time, peak RSS, rows read (fetched
+            from the database by the stage), rows written (by the stage, into its TEMP tables for 'sync'/'fill'
+            stages), rows removed/added when merged into the main tables, and the stage's own counts (e.g. annotations
+            without MQNs, structures without MD3Ds)
+        tables - number of rows in each table after the build
+
+    Peak RSS is the high-water mark of the process that ran the stage (worker processes are reused, so it is the
+    largest of any stage that ran in the same worker up to that point) including any child processes it waited on.
+
+    Two reports can be compared to spot regressions between builds (e.g. DB versions v1.0 vs v1.1), stages whose wall
+    time, CPU time or peak RSS increased by more than the tolerance are flagged
+
+    usage:
+        python3 build_report.py DMIM_v1.0.build.json DMIM_v1.1.build.json [tolerance]
+"""
+
+import sys
+from json import dump, load
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is not reported
+    resource = None
+
+from initialize_db import table_keys
+
+
+# default relative increase that is flagged as a regression when comparing reports
+TOLERANCE = 0.1
+
+# metrics that are compared between reports, with the format used to print them
+compared_metrics = [
+    ('wall', '{:.2f}'),
+    ('cpu', '{:.2f}'),
+    ('merge', '{:.2f}'),
+    ('peak_rss_mb', '{:.1f}'),
+    ('rows_read', '{:d}'),
+    ('rows_written', '{:d}'),
+]
+
+# metrics where an increase beyond the tolerance is a regression
+regression_metrics = ['wall', 'cpu', 'peak_rss_mb']
+
+
+def peak_rss_mb():
+    """ peak resident set size (MB) of this process and any child processes it has waited on, None if it cannot be
+        determined on this platform """
+    if resource is None:
+        return None
+    rss = max([resource.getrusage(who).ru_maxrss for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]])
+    # ru_maxrss is in bytes on macOS and kB everywhere else
+    return rss / 1024. ** (2 if sys.platform == 'darwin' else 1)
+
+
+def table_counts(dmim_cursor):
+    """ number of rows in each table of the DMIM database """
+    return {table: dmim_cursor.execute('SELECT COUNT(*) FROM main.{};'.format(table)).fetchall()[0][0]
+            for table in table_keys}
+
+
+def write_report(fname, report):
+    """ writes a build report to a JSON file """
+    with open(fname, 'w') as f:
+        dump(report, f, indent=4)
+
+
+def load_report(fname):
+    """ loads a build report from a JSON file """
+    with open(fname, 'r') as f:
+        return load(f)
+
+
+def compare_value(old, new, fmt, regression, tolerance):
+    """ formats the change in one metric, returns the formatted change and whether it is a regression """
+    change = '{} -> {}'.format(*['-' if _ is None else fmt.format(_) for _ in [old, new]])
+    if old is None or new is None:
+        return change, False
+    if old > 0:
+        rel = (new - old) / old
+        change += ' ({:+.0%})'.format(rel)
+        return change, regression and rel > tolerance
+    return change, False
+
+
+def compare_reports(old, new, tolerance=TOLERANCE):
+    """ prints the differences between two build reports, stages are only compared if they ran in both builds
+        returns: list of (stage, metric) that regressed by more than tolerance """
+    regressions = []
+    print('comparing build v{} ({}) -> v{} ({})'.format(old['version'], old['started'], new['version'], new['started']))
+    print()
+    stages = list(old['stages']) + [_ for _ in new['stages'] if _ not in old['stages']]
+    for name in stages + ['total']:
+        o = old['total'] if name == 'total' else old['stages'].get(name)
+        n = new['total'] if name == 'total' else new['stages'].get(name)
+        if o is None or n is None:
+            print('{}: only in {} report'.format(name, 'new' if o is None else 'old'))
+            continue
+        if name != 'total' and [o['status'], n['status']] != ['ran', 'ran']:
+            print('{}: {} -> {}'.format(name, o['status'], n['status']))
+            continue
+        print('{}:'.format(name))
+        for metric, fmt in compared_metrics:
+            if metric not in o and metric not in n:
+                continue
+            change, regressed = compare_value(o.get(metric), n.get(metric), fmt, metric in regression_metrics,
+                                              tolerance)
+            if regressed:
+                regressions.append((name, metric))
+            print('    {:14s} {}{}'.format(metric, change, '  <-- regression' if regressed else ''))
+        counts = sorted(set(o.get('counts', {})) | set(n.get('counts', {})))
+        for count in counts:
+            a, b = o.get('counts', {}).get(count), n.get('counts', {}).get(count)
+            if a != b:
+                print('    {:14s} {} -> {}'.format(count, a, b))
+    print('tables:')
+    for table in new['tables']:
+        a, b = old['tables'].get(table), new['tables'][table]
+        print('    {:14s} {} -> {}{}'.format(table, a, b, '' if a == b else '  (changed)'))
+    print()
+    print('{} regression(s) beyond {:.0%}'.format(len(regressions), tolerance))
+    return regressions
+
+
+def main(old_fname, new_fname, tolerance=TOLERANCE):
+    """ main execution """
+    regressions = compare_reports(load_report(old_fname), load_report(new_fname), tolerance=tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:3], *[float(_) for _ in sys.argv[3:4]]))
@@ -0,0 +1,128 @@
+"""
+    Buffered writer used by the build stages to insert rows into the DMIM database
+
+    Rows are accumulated in memory and flushed in chunks using executemany, all within a single explicit
+    transaction that is committed when the writer is closed. Connections opened with build_connect use PRAGMAs
+    that trade durability for speed, which is fine during the build because a failed build is just re-run. They also
+    count the rows fetched through their cursors (rows_read) for the build report, rows written are available from
+    total_changes.
+"""
+
+from sqlite3 import connect, Connection, Cursor
+from time import perf_counter
+
+
+# PRAGMAs applied to database connections used during the build
+build_pragmas = [
+    'PRAGMA journal_mode = MEMORY;',
+    'PRAGMA synchronous = OFF;',
+    'PRAGMA temp_store = MEMORY;',
+    'PRAGMA cache_size = -65536;',
+]
+
+
+class CountingCursor(Cursor):
+    """ cursor that adds the number of rows it fetches to its connection's rows_read """
+
+    def __next__(self):
+        row = super().__next__()
+        self.connection.rows_read += 1
+        return row
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.connection.rows_read += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        self.connection.rows_read += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.connection.rows_read += len(rows)
+        return rows
+
+
+class BuildConnection(Connection):
+    """ connection whose cursors count the rows they fetch """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rows_read = 0
+
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+
+def build_connect(fname, timeout=5.):
+    """ opens a connection to the database with the build-time PRAGMAs applied """
+    con = connect(fname, timeout=timeout, factory=BuildConnection)
+    for pragma in build_pragmas:
+        con.execute(pragma)
+    return con
+
+
+class BulkWriter:
+    """ buffers rows for an INSERT (or DELETE) query and flushes them using executemany """
+
+    def __init__(self, con, qry, label, chunk_size=5000):
+        """
+            con - database connection to write to
+            qry - parameterized query executed for each row
+            label - name used when reporting throughput (e.g. the build stage)
+            chunk_size - number of buffered rows that triggers a flush
+        """
+        self.con = con
+        self.qry = qry
+        self.label = label
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.n_rows = 0
+        self.t_start = perf_counter()
+        self.t_write = 0.
+
+    def add(self, row):
+        """ buffer a single row, flushing if the buffer is full """
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ write all buffered rows in one executemany call """
+        if not self.rows:
+            return
+        t0 = perf_counter()
+        if not self.con.in_transaction:
+            self.con.execute('BEGIN;')
+        self.con.executemany(self.qry, self.rows)
+        self.t_write += perf_counter() - t0
+        self.n_rows += len(self.rows)
+        self.rows = []
+
+    def close(self, report=True):
+        """ flush any remaining rows, commit the transaction and optionally report throughput """
+        self.flush()
+        self.con.commit()
+        if report:
+            self.report()
+
+    def report(self):
+        """ print the number of rows written and rows per second for this writer """
+        t = perf_counter() - self.t_start
+        rate = self.n_rows / t if t > 0 else 0.
+        msg = '{}: {} rows in {:.2f} s ({:.0f} rows/s, {:.2f} s writing)'
+        print(msg.format(self.label, self.n_rows, t, rate, self.t_write))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not commit partial stages
+            self.rows = []
+            self.con.rollback()
@@ -0,0 +1,62 @@
+"""
+    Lookup index over the compound lists from the JSON inputs (parent_data_rmsd.json, metab_data_fixed_rmsd.json)
+
+    Compounds are indexed by name and by (name, SMILES, adduct), so matching database rows against the JSON data takes
+    one dict lookup per row instead of a scan through the whole list. When several compounds share a key the first one
+    (in the order the lists were given) wins, the same as the linear scans this replaces. Keys that are looked up but
+    not found are kept so they can be reported.
+"""
+
+from json import load as jload
+
+
+class CmpdIndex:
+    """ compounds from one or more JSON compound lists, indexed by name and by (name, SMILES, adduct) """
+
+    def __init__(self, *cmpd_lists):
+        """
+            cmpd_lists - lists of compounds (dicts with 'name', 'SMILES', 'adduct' and optionally 'structures')
+        """
+        self.by_name = {}
+        self.by_key = {}
+        for cmpds in cmpd_lists:
+            for cmpd in cmpds:
+                self.by_name.setdefault(cmpd['name'], cmpd)
+                # only compounds that actually have 3D structures are matched on the full key
+                if cmpd.get('structures'):
+                    self.by_key.setdefault((cmpd['name'], cmpd.get('SMILES'), cmpd.get('adduct')), cmpd)
+        self.unmatched_names = []
+        self.unmatched_keys = []
+
+    @classmethod
+    def from_json(cls, *fnames):
+        """ builds an index from JSON files, each containing a list of compounds """
+        cmpd_lists = []
+        for fname in fnames:
+            with open(fname, 'r') as j:
+                cmpd_lists.append(jload(j))
+        return cls(*cmpd_lists)
+
+    def get_name(self, name):
+        """ returns the first compound with a name, or None (the name is recorded as unmatched) """
+        cmpd = self.by_name.get(name)
+        if cmpd is None:
+            self.unmatched_names.append(name)
+        return cmpd
+
+    def get_structures(self, name, smi, adduct):
+        """ returns the 3D structures of the first compound matching (name, SMILES, adduct) that has any, or an empty
+            list (the key is recorded as unmatched) """
+        cmpd = self.by_key.get((name, smi, adduct))
+        if cmpd is None:
+            self.unmatched_keys.append((name, smi, adduct))
+            return []
+        return cmpd['structures']
+
+    def report(self, label, n_show=5):
+        """ prints the number of lookups that were not matched along with a few examples """
+        for what, unmatched in [('names', self.unmatched_names), ('(name, SMILES, adduct) keys', self.unmatched_keys)]:
+            if unmatched:
+                examples = ', '.join([str(_) for _ in unmatched[:n_show]])
+                more = ', ...' if len(unmatched) > n_show else ''
+                print('{}: {} unmatched {} ({}{})'.format(label, len(unmatched), what, examples, more))
@@ -0,0 +1,252 @@
+"""
+    Persistent on-disk cache of computed descriptors, shared across DB builds and prediction runs
+
+    MQNs and MD3Ds only depend on the structure they are computed from, and most SMILES/3D structures are the same
+    between DB versions (and between prediction runs), so computed descriptors are stored in a small SQLite database
+    (separate from any DMIM DB) and looked up before computing anything:
+
+        * MQNs are keyed on a hash of the SMILES and of the canonical SMILES (see add_mqns.cached_mqns)
+        * MD3Ds are keyed on a hash of the parsed coordinates/masses (see add_md3d.cached_md3ds)
+
+    Every entry also records the definition of the descriptors it holds (e.g. the RDKit version for MQNs, the RMD bins
+    for MD3Ds), entries with a different definition are never returned, so changing how descriptors are computed
+    (and bumping the definition) invalidates the old entries without having to clear the cache. The total size of the
+    cached values is bounded (max_mb), the least recently used entries are evicted once it is exceeded. The total is
+    kept as a running count (only summed over the table when the cache is opened and when entries are evicted), and
+    lookups only mark entries as used in memory, the marks are written along with the next put (or every
+    TOUCH_FLUSH_SIZE marks, or on close), so neither lookups nor puts scan or commit anything they do not need to.
+
+    The cache is at ~/.cache/dmim/descriptors.db by default, the DMIM_DESCRIPTOR_CACHE environment variable can be set
+    to use a different file, or to an empty string to disable the cache entirely.
+"""
+
+import os
+from hashlib import sha1
+from sqlite3 import connect
+from time import time
+
+
+# default cache location and size bound
+DEFAULT_CACHE_FNAME = os.path.join('~', '.cache', 'dmim', 'descriptors.db')
+DEFAULT_MAX_MB = 256.
+
+# environment variable used to override the cache location (empty string to disable)
+CACHE_ENV_VAR = 'DMIM_DESCRIPTOR_CACHE'
+
+# maximum number of keys per lookup query (below SQLite's host parameter limit)
+LOOKUP_CHUNK_SIZE = 500
+
+# number of pending "last used" marks that are written out without waiting for a put or close
+TOUCH_FLUSH_SIZE = 10000
+
+
+# define queries
+# cache table, value is the packed descriptors
+qry_cache_schema = """
+CREATE TABLE IF NOT EXISTS descriptor_cache (
+    -- descriptor kind (e.g. mqn, md3d)
+    kind TEXT NOT NULL,
+    -- content hash of the structure the descriptors were computed from
+    key TEXT NOT NULL,
+    -- definition of the descriptors (changes whenever the way they are computed changes)
+    definition TEXT NOT NULL,
+    -- packed descriptors
+    value BLOB NOT NULL,
+    -- last time the entry was used (for LRU eviction)
+    last_used REAL NOT NULL,
+    PRIMARY KEY (kind, key, definition)
+) WITHOUT ROWID
+;"""
+
+qry_cache_last_used_index = """
+CREATE INDEX IF NOT EXISTS descriptor_cache_last_used_idx ON descriptor_cache (last_used)
+;"""
+
+# look up cached values
+qry_lookup = """
+SELECT
+    key, value
+FROM
+    descriptor_cache
+WHERE
+    kind = ?
+    AND definition = ?
+    AND key IN ({params})
+;"""
+
+# get the sizes of cached values (to keep the running total when they are replaced)
+qry_sizes = """
+SELECT
+    key, length(value)
+FROM
+    descriptor_cache
+WHERE
+    kind = ?
+    AND definition = ?
+    AND key IN ({params})
+;"""
+
+# mark entries as used
+qry_touch = """
+UPDATE
+    descriptor_cache
+SET
+    last_used = ?
+WHERE
+    kind = ?
+    AND definition = ?
+    AND key = ?
+;"""
+
+# add (or replace) entries
+qry_store = """
+INSERT OR REPLACE INTO descriptor_cache
+    (kind, key, definition, value, last_used)
+VALUES
+    (?,?,?,?,?)
+;"""
+
+# total size of the cached values
+qry_total_size = "SELECT COALESCE(SUM(length(value)), 0) FROM descriptor_cache;"
+
+# entries from least to most recently used
+qry_lru = """
+SELECT
+    kind, key, definition, length(value)
+FROM
+    descriptor_cache
+ORDER BY
+    last_used
+;"""
+
+# remove entries
+qry_evict = """
+DELETE FROM
+    descriptor_cache
+WHERE
+    kind = ?
+    AND key = ?
+    AND definition = ?
+;"""
+
+
+def content_key(*parts):
+    """ hash of the content a descriptor is computed from, parts are str or bytes """
+    h = sha1()
+    for part in parts:
+        h.update(part.encode() if isinstance(part, str) else bytes(part))
+        # separator so that ('ab', 'c') and ('a', 'bc') do not collide
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+class DescriptorCache:
+    """ persistent cache of packed descriptors, keyed on (kind, content hash, definition) """
+
+    def __init__(self, fname=DEFAULT_CACHE_FNAME, max_mb=DEFAULT_MAX_MB, timeout=30.):
+        """
+            fname - cache file (created if it does not exist)
+            max_mb - bound on the total size of the cached values (MB), least recently used entries are evicted
+            timeout - seconds to wait for the cache to be unlocked (it may be shared by concurrent build stages)
+        """
+        self.fname = os.path.expanduser(fname)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        d = os.path.dirname(self.fname)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.con = connect(self.fname, timeout=timeout)
+        self.con.execute(qry_cache_schema)
+        self.con.execute(qry_cache_last_used_index)
+        self.con.commit()
+        self.total_bytes = self.con.execute(qry_total_size).fetchall()[0][0]
+        # (kind, definition, key) -> last used time, for hits that have not been written yet
+        self._touched = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, qry, kind, definition, keys):
+        """ runs a lookup query (qry_lookup or qry_sizes) for keys in chunks
+            returns: dict of key -> result """
+        found = {}
+        for i in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            chunk = keys[i:i + LOOKUP_CHUNK_SIZE]
+            found.update(self.con.execute(qry.format(params=','.join('?' * len(chunk))),
+                                          (kind, definition, *chunk)).fetchall())
+        return found
+
+    def _flush_touched(self):
+        """ writes the pending last used times (does not commit) """
+        if self._touched:
+            self.con.executemany(qry_touch, [(now, kind, definition, key)
+                                             for (kind, definition, key), now in self._touched.items()])
+            self._touched = {}
+
+    def get_many(self, kind, definition, keys):
+        """
+            looks up cached values, hits are marked as used (hits and misses count every key, including repeats)
+            returns: dict of key -> value for the keys that are in the cache
+        """
+        keys = list(keys)
+        found = self._lookup(qry_lookup, kind, definition, list(dict.fromkeys(keys)))
+        now = time()
+        for key in found:
+            self._touched[(kind, definition, key)] = now
+        if len(self._touched) >= TOUCH_FLUSH_SIZE:
+            self._flush_touched()
+            self.con.commit()
+        n_found = len([key for key in keys if key in found])
+        self.hits += n_found
+        self.misses += len(keys) - n_found
+        return found
+
+    def put_many(self, kind, definition, items):
+        """ adds (key, value) pairs to the cache (along with any pending last used times), then evicts entries if it
+            has grown past max_bytes """
+        now = time()
+        # the last value for a repeated key is the one that is kept
+        items = dict(items)
+        # values that are replaced no longer count towards the total
+        replaced = self._lookup(qry_sizes, kind, definition, list(items))
+        self._flush_touched()
+        self.con.executemany(qry_store, [(kind, key, definition, value, now) for key, value in items.items()])
+        self.con.commit()
+        self.total_bytes += sum(len(value) for value in items.values()) - sum(replaced.values())
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ removes least recently used entries until the cache is within 90% of max_bytes, the total is recomputed
+            first since other processes may share the cache
+            returns: number of entries removed """
+        self._flush_touched()
+        total = self.con.execute(qry_total_size).fetchall()[0][0]
+        if total <= self.max_bytes:
+            self.total_bytes = total
+            self.con.commit()
+            return 0
+        target = 0.9 * self.max_bytes
+        evicted = []
+        for kind, key, definition, size in self.con.execute(qry_lru):
+            if total <= target:
+                break
+            evicted.append((kind, key, definition))
+            total -= size
+        self.con.executemany(qry_evict, evicted)
+        self.con.commit()
+        self.total_bytes = total
+        return len(evicted)
+
+    def close(self):
+        """ writes the pending last used times and closes the cache """
+        self._flush_touched()
+        self.con.commit()
+        self.con.close()
+
+
+def default_cache(max_mb=DEFAULT_MAX_MB):
+    """ opens the default descriptor cache (see CACHE_ENV_VAR)
+        returns: DescriptorCache or None if the cache is disabled """
+    fname = os.environ.get(CACHE_ENV_VAR, DEFAULT_CACHE_FNAME)
+    if not fname:
+        return None
+    return DescriptorCache(fname, max_mb=max_mb)
@@ -0,0 +1,283 @@
+#!/usr/local/Cellar/python@3.9/3.9.1_6/bin/python3
+"""
+    Exports the DMIM database in a columnar format, one file per plate
+
+    Rows are streamed from the database in chunks and written as they are read, plates are exported in parallel
+    (one worker process per plate). Supported formats:
+        parquet - Apache Parquet (requires pyarrow)
+        arrow - Arrow IPC file, can be memory-mapped with pyarrow.memory_map (requires pyarrow)
+        npz - NumPy .npz archive, one array per column (used as a fallback when pyarrow is not available)
+        csv - gzip-compressed CSV
+
+    Each row is an annotation with its measurement data. MQNs, MD3Ds and MS2 spectra can be included:
+        MQNs - one uint16 column per MQN (mqn_c, mqn_f, ...), only annotations that have MQNs are exported
+        MD3Ds - one column per descriptor plus str_id, one row per 3D structure (as in DmimData qry_combined), only
+            annotations that have 3D structures are exported
+        spectra - MS2 m/z (float32) and intensity (uint32) as lists (parquet/arrow), concatenated arrays with row
+            offsets (npz: spectrum_offsets, spectrum_mz, spectrum_intensity) or "mz intensity;..." text (csv), rows
+            without a spectrum have an empty one
+
+    usage:
+        python3 export_db.py DMIM_v1.1.db export_dir [parquet|arrow|npz|csv] [--mqns] [--md3ds] [--spectra]
+"""
+
+import os
+import sys
+import csv
+import gzip
+from concurrent.futures import ProcessPoolExecutor
+from sqlite3 import connect
+
+from numpy import array, frombuffer, concatenate, cumsum, savez, float32, uint32, int64
+
+from ms2_spectra import unpack_spectrum
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# MQN names, in the order they are stored (see add_mqns.py)
+mqn_names = [
+    'c', 'f', 'cl', 'br', 'i', 's', 'p', 'an', 'cn', 'ao', 'co', 'hac', 'hbam', 'hba', 'hbdm', 'hbd', 'neg', 'pos',
+    'asb', 'adb', 'atb', 'csb', 'cdb', 'ctb', 'rbc', 'asv', 'adv', 'atv', 'aqv', 'cdv', 'ctv', 'cqv', 'r3', 'r4',
+    'r5', 'r6', 'r7', 'r8', 'r9', 'rg10', 'afr', 'bfr'
+]
+
+# MD3D names
+md3d_names = ['pmi1', 'pmi2', 'pmi3', 'rmd02', 'rmd24', 'rmd46', 'rmd68', 'rmd8p']
+
+# measurement/annotation columns, always exported
+base_columns = [
+    'dmim_id', 'plate', 'well', 'ann_id', 'annotation', 'adduct', 'smi', 'met_n', 'mz', 'ccs_avg', 'ccs_rsd',
+    'ccs_r1', 'ccs_r2', 'ccs_r3'
+]
+
+# file extension for each format
+extensions = {
+    'parquet': 'parquet',
+    'arrow': 'arrow',
+    'npz': 'npz',
+    'csv': 'csv.gz',
+}
+
+
+# define queries
+# base query for the export, the optional parts are filled in depending on what is included
+qry_export = """
+SELECT
+    dmim.dmim_id, plate, well, dmim_ann.ann_id, annotation, adduct, smi, met_n, mz, ccs_avg, ccs_rsd,
+    ccs_r1, ccs_r2, ccs_r3{cols}
+FROM
+    dmim
+    JOIN dmim_ann
+        ON dmim.dmim_id = dmim_ann.dmim_id{joins}
+WHERE
+    plate = ?
+ORDER BY
+    dmim_ann.ann_id{order}
+;"""
+
+# get the plates in the DMIM DB
+qry_plates = """
+SELECT DISTINCT
+    plate
+FROM
+    dmim
+ORDER BY
+    plate
+;"""
+
+
+def build_query(mqns, md3ds, spectra):
+    """ fills in the export query with the columns and joins for the optional parts """
+    cols, joins, order = '', '', ''
+    if mqns:
+        cols += ', mqns'
+        joins += '\n    JOIN dmim_mqn\n        ON dmim_ann.ann_id = dmim_mqn.ann_id'
+    if md3ds:
+        cols += ', dmim_3d.str_id, ' + ', '.join(md3d_names)
+        joins += '\n    JOIN dmim_3d\n        ON dmim_ann.ann_id = dmim_3d.ann_id'
+        joins += '\n    JOIN dmim_md3d\n        ON dmim_3d.str_id = dmim_md3d.str_id'
+        order = ', dmim_3d.str_id'
+    if spectra:
+        cols += ', spectrum_mz, spectrum_intensity, metfrag_score'
+        joins += '\n    LEFT JOIN dmim_ms2\n        ON dmim.dmim_id = dmim_ms2.dmim_id'
+    return qry_export.format(cols=cols, joins=joins, order=order)
+
+
+def spectrum_arrays(mz_blob, intensity_blob):
+    """ unpacks an MS2 spectrum into m/z (float32) and intensity (uint32) arrays, empty arrays if there is none """
+    if mz_blob is None:
+        return array([], dtype=float32), array([], dtype=uint32)
+    return unpack_spectrum(mz_blob, intensity_blob)
+
+
+def chunk_to_columns(rows, mqns, md3ds, spectra):
+    """ converts a chunk of rows from the export query into columns
+        returns: dict of column name: numpy.ndarray, list of (m/z, intensity) arrays (or None if no spectra) """
+    cols = list(zip(*rows))
+    columns = {}
+    for name, values in zip(base_columns, cols):
+        columns[name] = array(values)
+    i = len(base_columns)
+    if mqns:
+        mqn = frombuffer(b''.join(cols[i]), dtype='<u2').reshape(len(rows), len(mqn_names))
+        for j, name in enumerate(mqn_names):
+            columns['mqn_' + name] = mqn[:, j]
+        i += 1
+    if md3ds:
+        columns['str_id'] = array(cols[i])
+        for j, name in enumerate(md3d_names):
+            columns[name] = array(cols[i + 1 + j], dtype=float)
+        i += 1 + len(md3d_names)
+    specs = None
+    if spectra:
+        specs = [spectrum_arrays(m, s) for m, s in zip(cols[i], cols[i + 1])]
+        columns['metfrag_score'] = array([float('nan') if _ is None else _ for _ in cols[i + 2]], dtype=float)
+    return columns, specs
+
+
+class ArrowWriter:
+    """ writes chunks of columns to a Parquet or Arrow IPC file """
+
+    def __init__(self, fname, fmt):
+        self.fname = fname
+        self.fmt = fmt
+        self.writer = None
+
+    def write(self, columns, specs):
+        arrays = {name: pa.array(values) for name, values in columns.items()}
+        if specs is not None:
+            offsets = pa.array(concatenate([[0], cumsum([len(m) for m, _ in specs])]).astype('int32'))
+            mz = concatenate([m for m, _ in specs] + [array([], dtype=float32)])
+            intensity = concatenate([i for _, i in specs] + [array([], dtype=uint32)])
+            arrays['spectrum_mz'] = pa.ListArray.from_arrays(offsets, pa.array(mz))
+            arrays['spectrum_intensity'] = pa.ListArray.from_arrays(offsets, pa.array(intensity))
+        table = pa.table(arrays)
+        if self.writer is None:
+            if self.fmt == 'parquet':
+                self.writer = pq.ParquetWriter(self.fname, table.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.fname, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class NpzWriter:
+    """ accumulates chunks of columns and writes them to a .npz file when closed """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.chunks = {}
+        self.specs = []
+
+    def write(self, columns, specs):
+        for name, values in columns.items():
+            self.chunks.setdefault(name, []).append(values)
+        if specs is not None:
+            self.specs += specs
+
+    def close(self):
+        arrays = {name: concatenate(values) for name, values in self.chunks.items()}
+        if self.specs:
+            arrays['spectrum_offsets'] = concatenate([[0], cumsum([len(m) for m, _ in self.specs])]).astype(int64)
+            arrays['spectrum_mz'] = concatenate([m for m, _ in self.specs])
+            arrays['spectrum_intensity'] = concatenate([i for _, i in self.specs])
+        savez(self.fname, **arrays)
+
+
+class CsvWriter:
+    """ writes chunks of columns to a gzip-compressed CSV file """
+
+    def __init__(self, fname):
+        self.f = gzip.open(fname, 'wt', newline='')
+        self.writer = csv.writer(self.f)
+        self.header = False
+
+    def write(self, columns, specs):
+        names = list(columns.keys())
+        values = [columns[name].tolist() for name in names]
+        if specs is not None:
+            names.append('spectrum')
+            values.append([';'.join(['{:.4f} {:d}'.format(a, b) for a, b in zip(m.tolist(), i.tolist())])
+                           for m, i in specs])
+        if not self.header:
+            self.writer.writerow(names)
+            self.header = True
+        self.writer.writerows(zip(*values))
+
+    def close(self):
+        self.f.close()
+
+
+def get_writer(fname, fmt):
+    """ returns a writer for the requested format """
+    if fmt in ['parquet', 'arrow']:
+        return ArrowWriter(fname, fmt)
+    if fmt == 'npz':
+        return NpzWriter(fname)
+    if fmt == 'csv':
+        return CsvWriter(fname)
+    raise ValueError('get_writer: format "{}" not recognized'.format(fmt))
+
+
+def export_plate(dmim_fname, plate, fname, fmt, mqns=False, md3ds=False, spectra=False, chunk_size=10000):
+    """ streams all of the rows for one plate from the database into an export file, chunk_size rows at a time
+        returns: number of rows exported """
+    con = connect(dmim_fname)
+    cur = con.cursor()
+    writer = get_writer(fname, fmt)
+    n_rows = 0
+    cur.execute(build_query(mqns, md3ds, spectra), (plate,))
+    rows = cur.fetchmany(chunk_size)
+    while rows:
+        writer.write(*chunk_to_columns(rows, mqns, md3ds, spectra))
+        n_rows += len(rows)
+        rows = cur.fetchmany(chunk_size)
+    writer.close()
+    con.close()
+    return n_rows
+
+
+def export_db(dmim_fname, out_dir, fmt='parquet', mqns=False, md3ds=False, spectra=False, chunk_size=10000,
+              n_workers=None):
+    """ exports the database to out_dir, one file per plate (plate_N.ext), plates are exported in parallel
+        returns: list of (plate, file name, number of rows) """
+    if fmt in ['parquet', 'arrow'] and pa is None:
+        print('export_db: pyarrow is not available, exporting as npz instead of {}'.format(fmt))
+        fmt = 'npz'
+    if fmt not in extensions:
+        raise ValueError('export_db: format "{}" not recognized'.format(fmt))
+    os.makedirs(out_dir, exist_ok=True)
+    con = connect(dmim_fname)
+    plates = [_[0] for _ in con.execute(qry_plates).fetchall()]
+    con.close()
+    fnames = [os.path.join(out_dir, 'plate_{}.{}'.format(n, extensions[fmt])) for n in plates]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(export_plate, dmim_fname, n, fname, fmt, mqns=mqns, md3ds=md3ds, spectra=spectra,
+                               chunk_size=chunk_size)
+                   for n, fname in zip(plates, fnames)]
+        results = [(n, fname, future.result()) for n, fname, future in zip(plates, fnames, futures)]
+    for n, fname, n_rows in results:
+        print('plate {}: {} rows -> {}'.format(n, n_rows, fname))
+    return results
+
+
+def main():
+    """ main execution """
+    args = [_ for _ in sys.argv[1:] if not _.startswith('--')]
+    flags = [_ for _ in sys.argv[1:] if _.startswith('--')]
+    dmim_fname, out_dir = args[:2]
+    fmt = args[2] if len(args) > 2 else 'parquet'
+    export_db(dmim_fname, out_dir, fmt=fmt, mqns='--mqns' in flags, md3ds='--md3ds' in flags,
+              spectra='--spectra' in flags)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,13 @@ from sqlite3 import connect
 
 qry = """
 SELECT
-    plate_{n}.dmim_id, well, annotation, adduct, smi, met_n, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3
+    dmim.dmim_id, plate, well, annotation, adduct, smi, met_n, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3
 FROM
-    plate_{n}
-    JOIN plate_{n}_id
-        ON  plate_{n}.dmim_id = plate_{n}_id.dmim_id
+    dmim
+    JOIN dmim_ann
+        ON  dmim.dmim_id = dmim_ann.dmim_id
+ORDER BY
+    plate, ann_id
 ;"""
 
 
@@ -20,12 +22,11 @@ def main():
     cur = con.cursor()
     with open('DMIM_export.csv', 'w') as f:
         f.write('dmim_id,plate_id,annotation,adduct,smi,met_n,mz,ccs_avg,ccs_rsd,ccs_r1,ccs_r2,ccs_r3\n')
-        # iterate through all 7 plates and get the data
-        for n in range(1, 8):
-            for dmim_id, well, annotation, adduct, smi, met_n, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3 in cur.execute(qry.format(n=n)):
-                plate_id = 'p{}{}'.format(n, well)
-                s = '"{}","{}","{}","{}","{}",{},{:.4f},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f}\n'
-                f.write(s.format(dmim_id, plate_id, annotation, adduct, smi, met_n, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3))
+        # get the data from all plates
+        for dmim_id, n, well, annotation, adduct, smi, met_n, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3 in cur.execute(qry):
+            plate_id = 'p{}{}'.format(n, well)
+            s = '"{}","{}","{}","{}","{}",{},{:.4f},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f}\n'
+            f.write(s.format(dmim_id, plate_id, annotation, adduct, smi, met_n, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3))
     # close database connection
     con.close()
 
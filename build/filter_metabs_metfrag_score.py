@@ -1,23 +1,38 @@
 """
     Filters out any metabolite data where the MetFrag Score is below a threshold
+
+    Removed annotations are moved to the dmim_ann_filtered table rather than just deleted, an incremental build
+    compares the recomputed annotations against both tables (see stage_graph.sync_table) so that annotations that were
+    already filtered out are not added back (and filtered out again) every time the annotations stage runs.
+    The annotations to remove are collected into a TEMP table and everything that depends on them is removed with one
+    set-based DELETE per table. The threshold is a parameter so that sweep_thresholds can quickly apply the filter at
+    many thresholds, each to a fresh in-memory copy of an (unfiltered) database.
+
+    usage (threshold sweep):
+        python3 filter_metabs_metfrag_score.py DMIM_v1.1.db 10 50 100 200
 """
 
+import sys
 from sqlite3 import connect
 from numpy import array, savetxt
 
+
+# default MetFrag score threshold
+METFRAG_THRESHOLD = 100.
+
 # define queries
 # get pre-filter metfrag scores
-qry_scores_n = """
+qry_scores = """
 SELECT 
     metfrag_score
 FROM
-    plate_{n}_ms2
+    dmim_ms2
 JOIN 
-    plate_{n}
-    ON plate_{n}_ms2.dmim_id = plate_{n}.dmim_id
+    dmim
+    ON dmim_ms2.dmim_id = dmim.dmim_id
 JOIN
-    plate_{n}_id
-    ON plate_{n}.dmim_id = plate_{n}_id.dmim_id
+    dmim_ann
+    ON dmim.dmim_id = dmim_ann.dmim_id
 WHERE
     -- only metabolites
     met_n > 0
@@ -25,143 +40,197 @@ WHERE
     AND notes = 'Manual' 
     -- metfrag score cutoff of 10 determined by parent rank test
     AND metfrag_score IS NOT NULL
+ORDER BY
+    dmim.dmim_id
 ;"""
 
-# get dmim_ids to remove from the DMIM DB
-qry_dmim_ids_n = """
-SELECT 
-    plate_{n}.dmim_id
+# dmim_ids of metabolites that have a 'Manual' annotation and a missing or low MetFrag score (annotations that were
+# already filtered out count, so that new annotations for the same dmim_id are filtered out as well)
+qry_filter_dmim_ids = """
+        SELECT
+            dmim.dmim_id
+        FROM
+            dmim
+        JOIN 
+            dmim_ms2
+            ON dmim.dmim_id = dmim_ms2.dmim_id
+        JOIN
+            (
+                SELECT dmim_id, notes FROM dmim_ann
+                UNION ALL
+                SELECT dmim_id, notes FROM dmim_ann_filtered
+            ) AS ann
+            ON dmim.dmim_id = ann.dmim_id
+        WHERE
+            -- only metabolites
+            met_n > 0
+            -- only filter out 'Manual' identifications
+            AND notes = 'Manual' 
+            -- metfrag score cutoff
+            AND (
+                metfrag_score IS NULL 
+                OR metfrag_score < ?
+            )
+"""
+
+# collect the ann_ids to remove: all annotations for the dmim_ids selected by qry_filter_dmim_ids
+qry_filter_ann_ids = """
+CREATE TEMP TABLE filter_ann_ids AS
+SELECT
+    ann_id
 FROM
-    plate_{n}
-JOIN 
-    plate_{n}_ms2
-    ON plate_{n}.dmim_id = plate_{n}_ms2.dmim_id
-JOIN
-    plate_{n}_id
-    ON plate_{n}.dmim_id = plate_{n}_id.dmim_id
+    dmim_ann
 WHERE
-    -- only metabolites
-    met_n > 0
-    -- only filter out 'Manual' identifications
-    AND notes = 'Manual' 
-    -- metfrag score cutoff of 10 determined by parent rank test
-    AND (
-        metfrag_score IS NULL 
-        OR metfrag_score < 100
-    )
+    dmim_id IN (""" + qry_filter_dmim_ids + """    )
 ;"""
 
-# get ann_ids associated with the dmim_ids to remove
-qry_dmim_annids_n = """
-SELECT 
-    ann_id
+# count the annotations that were filtered out previously but would be kept at the current threshold (these are only
+# restored by a full rebuild since their descriptors have been removed)
+qry_count_unfiltered = """
+SELECT
+    COUNT(*)
 FROM
-    plate_{n}_id
+    dmim_ann_filtered
 WHERE
-    dmim_id = ?
+    dmim_id NOT IN (""" + qry_filter_dmim_ids + """    )
 ;"""
 
-# get str_ids associated with the ann_ids to remove
-qry_dmim_strids_n = """
-SELECT 
-    str_id
+# count the str_ids that will be removed along with the ann_ids
+qry_count_str_ids = """
+SELECT
+    COUNT(*)
 FROM
-    plate_{n}_3d
+    dmim_3d
 WHERE
-    ann_id = ?
+    ann_id IN (SELECT ann_id FROM temp.filter_ann_ids)
 ;"""
 
-# drop from plate_n and plate_n_ms2 tables using dmim_id
-qry_drop_dmim_id = [
+# drop everything associated with the collected ann_ids, dependent tables first (dmim and dmim_ms2 are kept), the
+# annotations themselves are moved to dmim_ann_filtered
+qry_drop_ann_ids = [
     """
     DELETE FROM
-        plate_{n}
+        dmim_md3d
     WHERE
-        dmim_id = ?
+        str_id IN (SELECT str_id FROM dmim_3d WHERE ann_id IN (SELECT ann_id FROM temp.filter_ann_ids))
     ;""",
     """
-    DELETE FROM 
-        plate_{n}_ms2
+    DELETE FROM
+        dmim_3d
     WHERE
-        dmim_id = ?
-    ;"""
-]
-
-# drop from plate_n_id, plate_n_mqn, and plate_n_3d using ann_id
-qry_drop_ann_id = [
+        ann_id IN (SELECT ann_id FROM temp.filter_ann_ids)
+    ;""",
     """
     DELETE FROM
-        plate_{n}_id
+        dmim_mqn
     WHERE
-        ann_id = ?
+        ann_id IN (SELECT ann_id FROM temp.filter_ann_ids)
     ;""",
-    """DELETE FROM
-        plate_{n}_mqn
+    """
+    INSERT INTO
+        dmim_ann_filtered
+    SELECT
+        *
+    FROM
+        dmim_ann
     WHERE
-        ann_id = ?
+        ann_id IN (SELECT ann_id FROM temp.filter_ann_ids)
     ;""",
-    """DELETE FROM
-        plate_{n}_3d
+    """
+    DELETE FROM
+        dmim_ann
     WHERE
-        ann_id = ?
-    ;"""
+        ann_id IN (SELECT ann_id FROM temp.filter_ann_ids)
+    ;""",
 ]
 
-# drop from plate_n_md3d using str_id
-qry_drop_str_id = """
-DELETE FROM
-    plate_{n}_md3d
-WHERE
-    str_id = ?
+# count the entries remaining in each of the filtered tables
+qry_counts = """
+SELECT
+    (SELECT COUNT(*) FROM dmim_ann),
+    (SELECT COUNT(*) FROM dmim_mqn),
+    (SELECT COUNT(*) FROM dmim_3d),
+    (SELECT COUNT(*) FROM dmim_md3d)
 ;"""
 
 
-def filter_metab_metfrag(dmim_cursor1, dmim_cursor2, dmim_cursor3):
-    """ removes all metabolite data for compounds that have bad MS2 scores from MetFrag """
+def filter_metab_metfrag(dmim_cursor, threshold=METFRAG_THRESHOLD, dump_scores=True):
+    """ removes all metabolite data for compounds that have bad MS2 scores from MetFrag
+        returns: number of ann_ids removed, number of str_ids removed """
     # dump the pre-filtering metfrag scores
-    scores = []
-    for n in range(1, 8):
-        for score in dmim_cursor1.execute(qry_scores_n.format(n=n)).fetchall():
+    if dump_scores:
+        scores = []
+        for score in dmim_cursor.execute(qry_scores).fetchall():
             scores.append(score)
-    savetxt('DMIM_metfrag_scores_prefilter.txt', array(scores))
-
-    # count all the metabolites to remove
-    dmim_rem, ann_rem, str_rem = [], [], []
-    # iterate through all plates
-    for n in range(1, 8):
-        for dmim_id in dmim_cursor1.execute(qry_dmim_ids_n.format(n=n)).fetchall():
-            dmim_rem.append(dmim_id)
-            for ann_id in dmim_cursor2.execute(qry_dmim_annids_n.format(n=n), dmim_id).fetchall():
-                ann_rem.append(ann_id)
-                for str_id in dmim_cursor3.execute(qry_dmim_strids_n.format(n=n), ann_id).fetchall():
-                    str_rem.append(str_id)
-    #print(len(dmim_rem), 'dmim_ids to remove by MS2 score')
-    print(len(ann_rem), 'ann_ids to remove by MS2 score')
-    print(len(str_rem), 'str_ids to remove by MS2 score')
-    # drop the selected dmim_ids and ann_ids
-    for n in range(1, 8):
-        """
-        for dmim_id in dmim_rem:
-            for qry in qry_drop_dmim_id:
-                dmim_cursor1.execute(qry.format(n=n), dmim_id)"""
-        for ann_id in ann_rem:
-            for qry in qry_drop_ann_id:
-                dmim_cursor1.execute(qry.format(n=n), ann_id)
-        for str_id in str_rem:
-            dmim_cursor1.execute(qry_drop_str_id.format(n=n), str_id)
-
-
-def main(version):
+        savetxt('DMIM_metfrag_scores_prefilter.txt', array(scores))
+
+    # collect all the metabolites to remove
+    dmim_cursor.execute(qry_filter_ann_ids, (threshold,))
+    n_ann = dmim_cursor.execute('SELECT COUNT(*) FROM temp.filter_ann_ids;').fetchall()[0][0]
+    n_str = dmim_cursor.execute(qry_count_str_ids).fetchall()[0][0]
+    print(n_ann, 'ann_ids to remove by MS2 score')
+    print(n_str, 'str_ids to remove by MS2 score')
+    n_unf = dmim_cursor.execute(qry_count_unfiltered, (threshold,)).fetchall()[0][0]
+    if n_unf:
+        msg = 'WARNING: {} previously filtered ann_ids pass the MS2 score filter now, rebuild with --full to restore them'
+        print(msg.format(n_unf))
+    # drop the selected ann_ids
+    for qry in qry_drop_ann_ids:
+        dmim_cursor.execute(qry)
+    dmim_cursor.execute('DROP TABLE temp.filter_ann_ids;')
+    return n_ann, n_str
+
+
+def sweep_thresholds(dmim_fname, thresholds):
+    """ applies the filter at each threshold to a fresh in-memory copy of the database (which should not have been
+        filtered already, or only at a lower threshold)
+        returns: list of (threshold, ann_ids removed, str_ids removed, remaining dmim_ann, dmim_mqn, dmim_3d,
+                 dmim_md3d entries) """
+    # copy the database into memory once, then copy that for each threshold
+    src_con = connect(dmim_fname)
+    mem_con = connect(':memory:')
+    src_con.backup(mem_con)
+    src_con.close()
+    results = []
+    for threshold in thresholds:
+        con = connect(':memory:')
+        mem_con.backup(con)
+        cur = con.cursor()
+        n_ann, n_str = filter_metab_metfrag(cur, threshold=threshold, dump_scores=False)
+        results.append((threshold, n_ann, n_str, *cur.execute(qry_counts).fetchall()[0]))
+        con.close()
+    mem_con.close()
+    return results
+
+
+def build_stage(dmim_con, threshold=METFRAG_THRESHOLD):
+    """ build stage entry point (see build.py)
+        returns: counts for the build report """
+    dmim_cur = dmim_con.cursor()
+
+    # filter out metabolites using MetFrag score
+    n_ann, n_str = filter_metab_metfrag(dmim_cur, threshold=threshold)
+
+    dmim_con.commit()
+    return {'ann_ids_removed': n_ann, 'str_ids_removed': n_str}
+
+
+def main(version, threshold=METFRAG_THRESHOLD):
     """ main execution """
     dmim_fname = 'DMIM_v{version}.db'.format(version=version)
 
-    # initialize the database connections
+    # initialize the database connection
     dmim_con = connect(dmim_fname)
-    dmim_cur1, dmim_cur2, dmim_cur3 = dmim_con.cursor(), dmim_con.cursor(), dmim_con.cursor()
 
-    # transfer parent MS spectra from replicate DB to DMIM DB
-    filter_metab_metfrag(dmim_cur1, dmim_cur2, dmim_cur3)
+    build_stage(dmim_con, threshold=threshold)
 
-    # commit changes and close DB connections
-    dmim_con.commit()
+    # close DB connection
     dmim_con.close()
+
+
+if __name__ == '__main__':
+    results = sweep_thresholds(sys.argv[1], [float(_) for _ in sys.argv[2:]])
+    print()
+    print('threshold  ann_rem  str_rem  dmim_ann  dmim_mqn   dmim_3d dmim_md3d')
+    for result in results:
+        print('{:9.1f} {:8d} {:8d} {:9d} {:9d} {:9d} {:9d}'.format(*result))
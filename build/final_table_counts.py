@@ -1,126 +1,159 @@
 """
-    Prints final counts in all of the tables of the DMIM database 
+    Prints final counts in all of the tables of the DMIM database
 """
 
 from sqlite3 import connect
 
 
 # define queries
-# count entries in plate_n tables
-qry_dmim_plate_n = """
-SELECT 
-    COUNT(*)
+# count entries in the dmim table, grouped by plate
+qry_dmim = """
+SELECT
+    plate,
+    COUNT(*),
+    SUM(adduct = "[M+H]+"),
+    SUM(adduct = "[M+Na]+"),
+    SUM(adduct = "[M+K]+"),
+    SUM(adduct = "[M+H-H2O]+"),
+    SUM(adduct = "[M]+"),
+    SUM(met_n = 0),
+    SUM(met_n > 0)
 FROM
-    plate_{n}
-{where}
+    dmim
+GROUP BY
+    plate
+ORDER BY
+    plate
 ;"""
 
-# count entries in plate_n_id tables
-qry_dmim_plate_n_id = """
-SELECT 
-    COUNT(*)
+# count entries in the dmim_ann table, grouped by plate
+qry_dmim_ann = """
+SELECT
+    plate,
+    COUNT(*),
+    SUM(met_n = 0),
+    SUM(met_n > 0)
 FROM
-    plate_{n}_id
+    dmim_ann
 JOIN
-    plate_{n} 
-    ON plate_{n}_id.dmim_id = plate_{n}.dmim_id
-{where}
+    dmim
+    ON dmim_ann.dmim_id = dmim.dmim_id
+GROUP BY
+    plate
+ORDER BY
+    plate
 ;"""
 
-# count entries in plate_n_ms2 tables
-qry_dmim_plate_n_ms2 = """
-SELECT 
+# count entries in the dmim_ms2 table, grouped by plate
+qry_dmim_ms2 = """
+SELECT
+    plate,
     COUNT(*)
 FROM
-    plate_{n}_ms2
-{where}
+    dmim_ms2
+JOIN
+    dmim
+    ON dmim_ms2.dmim_id = dmim.dmim_id
+GROUP BY
+    plate
+ORDER BY
+    plate
 ;"""
 
-# count entries in plate_n_mqn tables
-qry_dmim_plate_n_mqn = """
-SELECT 
+# count entries in the dmim_mqn table, grouped by plate
+qry_dmim_mqn = """
+SELECT
+    plate,
     COUNT(*)
 FROM
-    plate_{n}_mqn
-{where}
+    dmim_mqn
+JOIN
+    dmim_ann
+    ON dmim_mqn.ann_id = dmim_ann.ann_id
+JOIN
+    dmim
+    ON dmim_ann.dmim_id = dmim.dmim_id
+GROUP BY
+    plate
+ORDER BY
+    plate
 ;"""
 
-# count entries in plate_n_3d tables
-qry_dmim_plate_n_3d = """
-SELECT 
-    COUNT(*)
-FROM 
-    plate_{n}_3d 
-    JOIN 
-        plate_{n}_id 
-        ON plate_{n}_3d.ann_id = plate_{n}_id.ann_id 
-    JOIN plate_{n}
-        ON plate_{n}_id.dmim_id = plate_{n}.dmim_id
-{where}
+# count entries in the dmim_3d table, grouped by plate
+qry_dmim_3d = """
+SELECT
+    plate,
+    COUNT(*),
+    SUM(met_n = 0),
+    SUM(met_n > 0),
+    SUM(adduct = "[M+H]+"),
+    SUM(adduct = "[M+Na]+"),
+    SUM(adduct = "[M+K]+")
+FROM
+    dmim_3d
+    JOIN
+        dmim_ann
+        ON dmim_3d.ann_id = dmim_ann.ann_id
+    JOIN dmim
+        ON dmim_ann.dmim_id = dmim.dmim_id
+GROUP BY
+    plate
+ORDER BY
+    plate
 ;"""
 
-
-# count entries in plate_n_md3d tables
-qry_dmim_plate_n_md3d = """
-SELECT 
+# count entries in the dmim_md3d table, grouped by plate
+qry_dmim_md3d = """
+SELECT
+    plate,
     COUNT(*)
 FROM
-    plate_{n}_md3d
-{where}
+    dmim_md3d
+    JOIN
+        dmim_3d
+        ON dmim_md3d.str_id = dmim_3d.str_id
+    JOIN
+        dmim_ann
+        ON dmim_3d.ann_id = dmim_ann.ann_id
+    JOIN dmim
+        ON dmim_ann.dmim_id = dmim.dmim_id
+GROUP BY
+    plate
+ORDER BY
+    plate
 ;"""
 
 
 def plate_n_counts(dmim_cursor):
-    """ count entries in the plate_n tables """
+    """ count entries in the dmim table """
     print('plate_N\nplate       N    [M+H]+ [M+Na]+ [M+K]+ [M+H-H2O]+ [M]+ parents metabolites')
     msg = 'plate_{} {:6d} {:6d} {:6d}  {:6d}  {:6d}  {:6d}    {:6d}   {:6d}'
     totals = [0, 0, 0, 0, 0, 0, 0, 0]
-    for n in range(1, 8):
-        n_all = int(dmim_cursor.execute(qry_dmim_plate_n.format(n=n, where='')).fetchall()[0][0])
-        n_h = int(dmim_cursor.execute(qry_dmim_plate_n.format(n=n, where='WHERE adduct = "[M+H]+"')).fetchall()[0][0])
-        n_na = int(dmim_cursor.execute(qry_dmim_plate_n.format(n=n, where='WHERE adduct = "[M+Na]+"')).fetchall()[0][0])
-        n_k = int(dmim_cursor.execute(qry_dmim_plate_n.format(n=n, where='WHERE adduct = "[M+K]+"')).fetchall()[0][0])
-        n_h2o = int(dmim_cursor.execute(qry_dmim_plate_n.format(n=n, where='WHERE adduct = "[M+H-H2O]+"')).fetchall()[0][0])
-        n_m = int(dmim_cursor.execute(qry_dmim_plate_n.format(n=n, where='WHERE adduct = "[M]+"')).fetchall()[0][0])
-        n_par = int(dmim_cursor.execute(qry_dmim_plate_n.format(n=n, where='WHERE met_n = 0')).fetchall()[0][0])
-        n_met = int(dmim_cursor.execute(qry_dmim_plate_n.format(n=n, where='WHERE met_n > 0')).fetchall()[0][0])
-        print(msg.format(n, n_all, n_h, n_na, n_k, n_h2o, n_m, n_par, n_met))
-        totals[0] += n_all
-        totals[1] += n_h
-        totals[2] += n_na
-        totals[3] += n_k
-        totals[4] += n_h2o
-        totals[5] += n_m
-        totals[6] += n_par
-        totals[7] += n_met
+    for n, *counts in dmim_cursor.execute(qry_dmim).fetchall():
+        print(msg.format(n, *counts))
+        totals = [t + c for t, c in zip(totals, counts)]
     print('  total {:6d} {:6d} {:6d}  {:6d}  {:6d}  {:6d}    {:6d}   {:6d}'.format(*totals))
     print()
 
 
 def plate_n_id_counts(dmim_cursor):
-    """ count the entries in the annotation tables """
+    """ count the entries in the annotation table """
     print('plate_N_id\nplate       N    parents metabolites')
     msg = 'plate_{} {:6d}    {:6d}   {:6d}'
     totals = [0, 0, 0]
-    for n in range(1, 8):
-        n_all = int(dmim_cursor.execute(qry_dmim_plate_n_id.format(n=n, where='')).fetchall()[0][0])
-        n_par = int(dmim_cursor.execute(qry_dmim_plate_n_id.format(n=n, where='WHERE met_n = 0')).fetchall()[0][0])
-        n_met = int(dmim_cursor.execute(qry_dmim_plate_n_id.format(n=n, where='WHERE met_n > 0')).fetchall()[0][0])
-        totals[0] += n_all
-        totals[1] += n_par
-        totals[2] += n_met
-        print(msg.format(n, n_all, n_par, n_met))
+    for n, *counts in dmim_cursor.execute(qry_dmim_ann).fetchall():
+        totals = [t + c for t, c in zip(totals, counts)]
+        print(msg.format(n, *counts))
     print('  total {:6d}    {:6d}   {:6d}'.format(*totals))
     print()
 
 
 def plate_n_ms2_counts(dmim_cursor):
-    """ count the entries in the annotation tables """
+    """ count the entries in the MS2 table """
     print('plate_N_ms2\nplate       N')
     msg = 'plate_{} {:6d}'
     total = 0
-    for n in range(1, 8):
-        n_all = int(dmim_cursor.execute(qry_dmim_plate_n_ms2.format(n=n, where='')).fetchall()[0][0])
+    for n, n_all in dmim_cursor.execute(qry_dmim_ms2).fetchall():
         total += n_all
         print(msg.format(n, n_all))
     print('  total {:6d} '.format(total))
@@ -128,12 +161,11 @@ def plate_n_ms2_counts(dmim_cursor):
 
 
 def plate_n_mqn_counts(dmim_cursor):
-    """ count the entries in the annotation tables """
+    """ count the entries in the MQN table """
     print('plate_N_mqn\nplate       N')
     msg = 'plate_{} {:6d}'
     total = 0
-    for n in range(1, 8):
-        n_all = int(dmim_cursor.execute(qry_dmim_plate_n_mqn.format(n=n, where='')).fetchall()[0][0])
+    for n, n_all in dmim_cursor.execute(qry_dmim_mqn).fetchall():
         total += n_all
         print(msg.format(n, n_all))
     print('  total {:6d} '.format(total))
@@ -141,35 +173,23 @@ def plate_n_mqn_counts(dmim_cursor):
 
 
 def plate_n_3d_counts(dmim_cursor):
-    """ count the entries in the annotation tables """
+    """ count the entries in the 3D structure table """
     print('plate_N_3d\nplate       N    parents metabolites [M+H]+ [M+Na]+ [M+K]+')
     msg = 'plate_{} {:6d}    {:6d}   {:6d}    {:6d}   {:6d}  {:6d}'
     totals = [0, 0, 0, 0, 0, 0]
-    for n in range(1, 8):
-        n_all = int(dmim_cursor.execute(qry_dmim_plate_n_3d.format(n=n, where='')).fetchall()[0][0])
-        n_par = int(dmim_cursor.execute(qry_dmim_plate_n_3d.format(n=n, where='WHERE met_n = 0')).fetchall()[0][0])
-        n_met = int(dmim_cursor.execute(qry_dmim_plate_n_3d.format(n=n, where='WHERE met_n > 0')).fetchall()[0][0])
-        n_h = int(dmim_cursor.execute(qry_dmim_plate_n_3d.format(n=n, where='WHERE adduct = "[M+H]+"')).fetchall()[0][0])
-        n_na = int(dmim_cursor.execute(qry_dmim_plate_n_3d.format(n=n, where='WHERE adduct = "[M+Na]+"')).fetchall()[0][0])
-        n_k = int(dmim_cursor.execute(qry_dmim_plate_n_3d.format(n=n, where='WHERE adduct = "[M+K]+"')).fetchall()[0][0])
-        totals[0] += n_all
-        totals[1] += n_par
-        totals[2] += n_met
-        totals[3] += n_h
-        totals[4] += n_na
-        totals[5] += n_k
-        print(msg.format(n, n_all, n_par, n_met, n_h, n_na, n_k))
+    for n, *counts in dmim_cursor.execute(qry_dmim_3d).fetchall():
+        totals = [t + c for t, c in zip(totals, counts)]
+        print(msg.format(n, *counts))
     print('  total {:6d}    {:6d}   {:6d}    {:6d}   {:6d}  {:6d}'.format(*totals))
     print()
 
 
 def plate_n_md3d_counts(dmim_cursor):
-    """ count the entries in the annotation tables """
+    """ count the entries in the MD3D table """
     print('plate_N_md3d\nplate       N')
     msg = 'plate_{} {:6d}'
     total = 0
-    for n in range(1, 8):
-        n_all = int(dmim_cursor.execute(qry_dmim_plate_n_md3d.format(n=n, where='')).fetchall()[0][0])
+    for n, n_all in dmim_cursor.execute(qry_dmim_md3d).fetchall():
         total += n_all
         print(msg.format(n, n_all))
     print('  total {:6d} '.format(total))
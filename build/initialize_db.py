@@ -1,21 +1,31 @@
 """
     Initializes a new database with empty tables
+
+    All plates share a single set of tables (dmim, dmim_ann, dmim_ms2, dmim_ms2_frag, dmim_mqn, dmim_3d, dmim_md3d),
+    the plate number is stored as a column of the main dmim table. Older DMIM_v1.x databases with one family of tables
+    per plate (plate_1 ... plate_7) can be converted using migrate_db.py
 """
 
 import os
 from sqlite3 import connect
 
 
-# define the table schemas: plate_n, plate_n_id, plate_n_ms2, plate_n_mqn, plate_n_3d
-# main tables, contains measurement data
-plate_n_schema = """
-CREATE TABLE plate_{n} (
+# schema version, stored in the database using PRAGMA user_version
+SCHEMA_VERSION = 7
+
+
+# define the table schemas: dmim, dmim_ann, dmim_ms2, dmim_ms2_frag, dmim_mqn, dmim_3d, dmim_md3d
+# main table, contains measurement data
+dmim_schema = """
+CREATE TABLE dmim (
     -- global unique identifier
-    dmim_id TEXT UNIQUE NOT NULL,
+    dmim_id TEXT PRIMARY KEY NOT NULL,
+    -- plate number
+    plate INT NOT NULL,
     -- well location on plate
     well TEXT NOT NULL,
     -- analyte name
-    name TEXT NOT NULL, 
+    name TEXT NOT NULL,
     -- metabolite number (0 for parent compounds)
     met_n INT NOT NULL,
     -- MS adduct
@@ -31,15 +41,15 @@ CREATE TABLE plate_{n} (
 )
 ;"""
 
-# identification tables, contains metadata corresponding to annotations
-plate_n_id_schema = """
-CREATE TABLE plate_{n}_id (
+# identification table, contains metadata corresponding to annotations
+dmim_ann_schema = """
+CREATE TABLE dmim_ann (
     -- global identifier, can have multiple annotations for a single ID (not unique)
-    dmim_id TEXT NOT NULL,
+    dmim_id TEXT NOT NULL REFERENCES dmim(dmim_id),
     -- annotation identifier, unique
-    ann_id INT UNIQUE NOT NULL,
+    ann_id INTEGER PRIMARY KEY NOT NULL,
     -- annotation
-    annotation TEXT NOT NULL, 
+    annotation TEXT NOT NULL,
     -- SMILES structure
     smi TEXT NOT NULL,
     -- optional notes
@@ -47,45 +57,82 @@ CREATE TABLE plate_{n}_id (
 )
 ;"""
 
-# MS2 tables, fragmentation spectra and metfrag score
-plate_n_ms2_schema = """
-CREATE TABLE plate_{n}_ms2 (
+# annotations removed by the MetFrag score filter (see filter_metabs_metfrag_score.py), same columns as dmim_ann, kept
+# so that an incremental build does not add them back every time the annotations are synced
+dmim_ann_filtered_schema = """
+CREATE TABLE dmim_ann_filtered (
+    dmim_id TEXT NOT NULL REFERENCES dmim(dmim_id),
+    ann_id INTEGER PRIMARY KEY NOT NULL,
+    annotation TEXT NOT NULL,
+    smi TEXT NOT NULL,
+    notes TEXT
+)
+;"""
+
+# MS2 table, fragmentation spectra and metfrag score
+dmim_ms2_schema = """
+CREATE TABLE dmim_ms2 (
     -- global identifier, only one spectrum for a single ID (unique)
-    dmim_id TEXT UNIQUE NOT NULL,
+    dmim_id TEXT UNIQUE NOT NULL REFERENCES dmim(dmim_id),
     -- MS2 spectrum
-    spectrum TEXT NOT NULL, 
+    spectrum TEXT NOT NULL,
     -- metfrag score, optional only some spectra have these
-    metfrag_score REAL
+    metfrag_score REAL,
+    -- number of peaks in the spectrum
+    n_peaks INT,
+    -- base peak m/z and intensity
+    base_mz REAL,
+    base_intensity INT,
+    -- MS2 spectrum, packed float32 m/z and uint32 intensity of each peak (see ms2_spectra.py)
+    spectrum_mz BLOB,
+    spectrum_intensity BLOB
 )
 ;"""
 
+# MS2 fragment index, binned fragment m/z for each spectrum
+dmim_ms2_frag_schema = """
+CREATE TABLE dmim_ms2_frag (
+    -- fragment m/z bin (see ms2_spectra.mz_to_bin)
+    mz_bin INT NOT NULL,
+    -- global identifier of the spectrum
+    dmim_id TEXT NOT NULL REFERENCES dmim_ms2(dmim_id),
+    -- highest intensity of the peaks in the bin
+    intensity INT NOT NULL,
+    PRIMARY KEY (mz_bin, dmim_id)
+) WITHOUT ROWID
+;"""
+
 # MQN table, MQNs computed for all annotations
-plate_n_mqn_schema = """
-CREATE TABLE plate_{n}_mqn (
+dmim_mqn_schema = """
+CREATE TABLE dmim_mqn (
     -- annotation identifier, only one set of MQNs per annotation (unique)
-    ann_id INT UNIQUE NOT NULL,
-    -- MQNs
-    mqns TEXT NOT NULL
+    ann_id INTEGER PRIMARY KEY NOT NULL REFERENCES dmim_ann(ann_id),
+    -- MQNs, packed as 42 little-endian uint16 (see add_mqns.pack_mqns)
+    mqns BLOB NOT NULL
 )
 ;"""
 
 # 3d structure table
-plate_n_3d_schema = """
-CREATE TABLE plate_{n}_3d (
+dmim_3d_schema = """
+CREATE TABLE dmim_3d (
     -- annotation identifier, often more than 1 structure per annotation (not unique)
-    ann_id INT NOT NULL,
+    ann_id INT NOT NULL REFERENCES dmim_ann(ann_id),
     -- structure identifier (unique)
-    str_id INT UNIQUE NOT NULL,
+    str_id INTEGER PRIMARY KEY NOT NULL,
     -- 3D structure, xyzmq format (text)
-    structure TEXT NOT NULL
+    structure TEXT NOT NULL,
+    -- number of atoms in the structure
+    n_atoms INT,
+    -- 3D structure, packed float64 x, y, z, m, q for each atom (see xyzmq.py)
+    xyzmq BLOB
 )
 ;"""
 
 # 3d molecular descriptor table
-plate_n_md3d_schema = """
-CREATE TABLE plate_{n}_md3d (
+dmim_md3d_schema = """
+CREATE TABLE dmim_md3d (
     -- structure identifier, only 1 set of descriptors per annotation (unique)
-    str_id INT UNIQUE NOT NULL,
+    str_id INTEGER PRIMARY KEY NOT NULL REFERENCES dmim_3d(str_id),
     -- principal moments of inertia
     pmi1 REAL NOT NULL,
     pmi2 REAL NOT NULL,
@@ -99,17 +146,60 @@ CREATE TABLE plate_{n}_md3d (
 )
 ;"""
 
+# indexes on the columns used for joins/selection that are not already primary keys or unique
+dmim_indexes = [
+    "CREATE INDEX dmim_plate_idx ON dmim (plate, well);",
+    "CREATE INDEX dmim_ann_dmim_id_idx ON dmim_ann (dmim_id);",
+    "CREATE INDEX dmim_3d_ann_id_idx ON dmim_3d (ann_id);",
+    "CREATE INDEX dmim_ms2_frag_dmim_id_idx ON dmim_ms2_frag (dmim_id);",
+]
+
+
+# schema of each table, in the order the tables are created
+table_schemas = {
+    'dmim': dmim_schema,
+    'dmim_ann': dmim_ann_schema,
+    'dmim_ann_filtered': dmim_ann_filtered_schema,
+    'dmim_ms2': dmim_ms2_schema,
+    'dmim_ms2_frag': dmim_ms2_frag_schema,
+    'dmim_mqn': dmim_mqn_schema,
+    'dmim_3d': dmim_3d_schema,
+    'dmim_md3d': dmim_md3d_schema,
+}
+
+# key column of each table
+table_keys = {
+    'dmim': 'dmim_id',
+    'dmim_ann': 'ann_id',
+    'dmim_ann_filtered': 'ann_id',
+    'dmim_ms2': 'dmim_id',
+    'dmim_ms2_frag': 'dmim_id',
+    'dmim_mqn': 'ann_id',
+    'dmim_3d': 'str_id',
+    'dmim_md3d': 'str_id',
+}
+
+# (table, column) pairs that reference the key column of each table
+table_children = {
+    'dmim': [('dmim_ann', 'dmim_id'), ('dmim_ann_filtered', 'dmim_id'), ('dmim_ms2', 'dmim_id')],
+    'dmim_ms2': [('dmim_ms2_frag', 'dmim_id')],
+    'dmim_ann': [('dmim_mqn', 'ann_id'), ('dmim_3d', 'ann_id')],
+    'dmim_3d': [('dmim_md3d', 'str_id')],
+}
+
+# tables with rows that are removed by a later build stage, and the table the removed rows are moved to
+table_filtered = {
+    'dmim_ann': 'dmim_ann_filtered',
+}
+
 
 def create_tables(cursor):
-    """ creates all of the database tables """
-    # iterate through all plates
-    for n in range(1, 8):
-        cursor.execute(plate_n_schema.format(n=n))
-        cursor.execute(plate_n_id_schema.format(n=n))
-        cursor.execute(plate_n_ms2_schema.format(n=n))
-        cursor.execute(plate_n_mqn_schema.format(n=n))
-        cursor.execute(plate_n_3d_schema.format(n=n))
-        cursor.execute(plate_n_md3d_schema.format(n=n))
+    """ creates all of the database tables and indexes """
+    for schema in table_schemas.values():
+        cursor.execute(schema)
+    for qry in dmim_indexes:
+        cursor.execute(qry)
+    cursor.execute('PRAGMA user_version = {};'.format(SCHEMA_VERSION))
 
 
 def main(version):
@@ -131,4 +221,3 @@ def main(version):
     con.commit()
     con.close()
 
-
@@ -0,0 +1,178 @@
+#!/usr/local/Cellar/python@3.9/3.9.1_6/bin/python3
+"""
+    Converts a DMIM_v1.x database with one family of tables per plate (plate_N, plate_N_id, plate_N_ms2,
+    plate_N_mqn, plate_N_3d, plate_N_md3d) into the unified schema defined in initialize_db.py
+
+    usage:
+        python3 migrate_db.py DMIM_v1.0.db DMIM_v1.0_unified.db
+"""
+
+import os
+import re
+import sys
+from sqlite3 import connect
+
+from initialize_db import create_tables
+from bulk_writer import BulkWriter
+from pack_3d import qry_set_packed, pack_structures
+from upgrade_db import qry_set_mqns, pack_text_mqns
+from ms2_spectra import qry_set_packed as qry_set_packed_ms2, qry_insert_frag, pack_spectra, index_fragments
+
+
+# define queries
+# find all of the plate_N tables in the old database
+qry_old_plates = """
+SELECT
+    name
+FROM
+    old.sqlite_master
+WHERE
+    type = 'table'
+    AND name LIKE 'plate_%'
+;"""
+
+# copy measurement data from plate_N
+qry_copy_plate_n = """
+INSERT INTO dmim
+    (dmim_id, plate, well, name, met_n, adduct, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3)
+SELECT
+    dmim_id, {n}, well, name, met_n, adduct, mz, ccs_avg, ccs_rsd, ccs_r1, ccs_r2, ccs_r3
+FROM
+    old.plate_{n}
+ORDER BY
+    dmim_id
+;"""
+
+# copy annotations from plate_N_id
+qry_copy_plate_n_id = """
+INSERT INTO dmim_ann
+    (dmim_id, ann_id, annotation, smi, notes)
+SELECT
+    dmim_id, ann_id, annotation, smi, notes
+FROM
+    old.plate_{n}_id
+;"""
+
+# copy MS2 spectra from plate_N_ms2
+qry_copy_plate_n_ms2 = """
+INSERT INTO dmim_ms2
+    (dmim_id, spectrum, metfrag_score)
+SELECT
+    dmim_id, spectrum, metfrag_score
+FROM
+    old.plate_{n}_ms2
+;"""
+
+# copy MQNs from plate_N_mqn
+qry_copy_plate_n_mqn = """
+INSERT INTO dmim_mqn
+    (ann_id, mqns)
+SELECT
+    ann_id, mqns
+FROM
+    old.plate_{n}_mqn
+;"""
+
+# copy 3D structures from plate_N_3d
+qry_copy_plate_n_3d = """
+INSERT INTO dmim_3d
+    (ann_id, str_id, structure)
+SELECT
+    ann_id, str_id, structure
+FROM
+    old.plate_{n}_3d
+;"""
+
+# copy MD3Ds from plate_N_md3d
+qry_copy_plate_n_md3d = """
+INSERT INTO dmim_md3d
+    (str_id, pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p)
+SELECT
+    str_id, pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p
+FROM
+    old.plate_{n}_md3d
+;"""
+
+# count entries in a table
+qry_count = """
+SELECT
+    COUNT(*)
+FROM
+    {table}
+;"""
+
+# define regex patterns
+plate_n_pat = re.compile(r'^plate_([0-9]+)$')
+
+
+def old_plate_numbers(dmim_cursor):
+    """ returns a sorted list of the plate numbers present in the old database """
+    plates = []
+    for name, in dmim_cursor.execute(qry_old_plates).fetchall():
+        mat = plate_n_pat.match(name)
+        if mat is not None:
+            plates.append(int(mat.group(1)))
+    return sorted(plates)
+
+
+def migrate_tables(dmim_cursor):
+    """ copy all of the data from the per-plate tables of the old database into the unified tables """
+    plates = old_plate_numbers(dmim_cursor)
+    if not plates:
+        raise RuntimeError('migrate_tables: no plate_N tables found in old database')
+    copy_qrys = [
+        ('dmim', 'plate_{n}', qry_copy_plate_n),
+        ('dmim_ann', 'plate_{n}_id', qry_copy_plate_n_id),
+        ('dmim_ms2', 'plate_{n}_ms2', qry_copy_plate_n_ms2),
+        ('dmim_mqn', 'plate_{n}_mqn', qry_copy_plate_n_mqn),
+        ('dmim_3d', 'plate_{n}_3d', qry_copy_plate_n_3d),
+        ('dmim_md3d', 'plate_{n}_md3d', qry_copy_plate_n_md3d),
+    ]
+    for new_table, old_table, qry in copy_qrys:
+        n_old = 0
+        for n in plates:
+            dmim_cursor.execute(qry.format(n=n))
+            n_old += dmim_cursor.execute(qry_count.format(table='old.' + old_table.format(n=n))).fetchall()[0][0]
+        n_new = dmim_cursor.execute(qry_count.format(table=new_table)).fetchall()[0][0]
+        if n_new != n_old:
+            msg = 'migrate_tables: {} has {} entries but old tables had {}'.format(new_table, n_new, n_old)
+            raise RuntimeError(msg)
+        print('{:10s} {:6d} entries'.format(new_table, n_new))
+    print('migrated {} plates'.format(len(plates)))
+
+
+def main(old_fname, new_fname):
+    """ main execution """
+    if not os.path.isfile(old_fname):
+        raise FileNotFoundError(old_fname)
+
+    # check if the new database exists already and remove it if it does
+    if os.path.isfile(new_fname):
+        os.remove(new_fname)
+
+    # initialize the database connection, attach the old database
+    con = connect(new_fname)
+    cur = con.cursor()
+    cur.execute('ATTACH DATABASE ? AS old;', (old_fname,))
+
+    # create the tables then copy everything over
+    create_tables(cur)
+    migrate_tables(cur)
+    with BulkWriter(con, qry_set_packed, 'migrate_db (pack 3D structures)') as pack_writer:
+        pack_structures(cur, pack_writer)
+    with BulkWriter(con, qry_set_mqns, 'migrate_db (pack MQNs)') as mqn_writer:
+        pack_text_mqns(cur, mqn_writer)
+    with BulkWriter(con, qry_set_packed_ms2, 'migrate_db (pack MS2 spectra)') as pack_writer:
+        pack_spectra(cur, pack_writer)
+    with BulkWriter(con, qry_insert_frag, 'migrate_db (MS2 fragment index)') as frag_writer:
+        index_fragments(cur, frag_writer)
+
+    # commit changes and close DB connection
+    con.commit()
+    cur.execute('DETACH DATABASE old;')
+    con.close()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
+
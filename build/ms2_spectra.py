@@ -0,0 +1,162 @@
+"""
+    Packed binary storage and fragment index for MS2 spectra
+
+    The spectrum column of dmim_ms2 stores each spectrum as text (one peak per line: m/z, intensity), which has to be
+    parsed every time it is read. The same data are also stored packed, m/z as a float32 BLOB (spectrum_mz column)
+    and intensities as a uint32 BLOB (spectrum_intensity column), along with the number of peaks and the base peak
+    (n_peaks, base_mz and base_intensity columns). The packed arrays can be read back using numpy.frombuffer without
+    any parsing or copying.
+
+    Fragments are also indexed in the dmim_ms2_frag table: the m/z of every peak is binned (FRAG_BIN_WIDTH) and one
+    row is stored per spectrum and bin (with the highest intensity in that bin), keyed on (mz_bin, dmim_id) so that
+    finding all of the spectra with a fragment at a given m/z is a range scan of the index (see find_fragment).
+"""
+
+from numpy import fromstring, frombuffer, zeros, rint, unique, maximum
+
+
+# packed spectrum dtypes, explicitly little-endian so the BLOBs are portable
+mz_dtype = '<f4'
+intensity_dtype = '<u4'
+
+# width of the m/z bins (Da) used for the fragment index
+FRAG_BIN_WIDTH = 0.01
+
+
+# define queries
+# get spectra that have not been packed yet
+qry_unpacked = """
+SELECT
+    dmim_id, spectrum
+FROM
+    dmim_ms2
+WHERE
+    spectrum_mz IS NULL
+ORDER BY
+    dmim_id
+;"""
+
+# set packed spectrum
+qry_set_packed = """
+UPDATE
+    dmim_ms2
+SET
+    n_peaks = ?,
+    base_mz = ?,
+    base_intensity = ?,
+    spectrum_mz = ?,
+    spectrum_intensity = ?
+WHERE
+    dmim_id = ?
+;"""
+
+# get packed spectra that have not been indexed yet
+qry_unindexed = """
+SELECT
+    dmim_id, spectrum_mz, spectrum_intensity
+FROM
+    dmim_ms2
+WHERE
+    dmim_id NOT IN (SELECT dmim_id FROM dmim_ms2_frag)
+ORDER BY
+    dmim_id
+;"""
+
+# insert fragment index entries
+qry_insert_frag = """
+INSERT INTO dmim_ms2_frag
+    (mz_bin, dmim_id, intensity)
+VALUES
+    (?,?,?)
+;"""
+
+# find spectra with a fragment in a range of m/z bins
+qry_find_fragment = """
+SELECT
+    dmim_id, MAX(intensity)
+FROM
+    dmim_ms2_frag
+WHERE
+    mz_bin BETWEEN ? AND ?
+    AND intensity >= ?
+GROUP BY
+    dmim_id
+ORDER BY
+    dmim_id
+;"""
+
+
+def spectrum_to_arrays(spectrum):
+    """
+        parses a spectrum in text format (one "mz intensity" peak per line) without the overhead of nested list
+        comprehensions
+        returns: m/z (float32) and intensity (uint32) arrays, with shape (n_peaks,)
+    """
+    values = fromstring(spectrum, sep=' ')
+    if values.size % 2 != 0:
+        raise ValueError('spectrum_to_arrays: spectrum does not have 2 columns (mz, intensity)')
+    values = values.reshape(-1, 2)
+    return values[:, 0].astype(mz_dtype), values[:, 1].astype(intensity_dtype)
+
+
+def pack_spectrum(spectrum):
+    """
+        packs a spectrum in text format into float32 m/z and uint32 intensity BLOBs
+        returns: number of peaks, base peak m/z, base peak intensity, packed m/z (bytes), packed intensity (bytes)
+            (base peak m/z and intensity are None for empty spectra)
+    """
+    mz, intensity = spectrum_to_arrays(spectrum)
+    if len(mz) == 0:
+        return 0, None, None, b'', b''
+    i = intensity.argmax()
+    return len(mz), float(mz[i]), int(intensity[i]), mz.tobytes(), intensity.tobytes()
+
+
+def unpack_spectrum(mz_blob, intensity_blob):
+    """
+        unpacks a spectrum packed with pack_spectrum, the returned arrays are read-only views of the BLOBs (no copy)
+        returns: m/z (float32) and intensity (uint32) arrays, with shape (n_peaks,)
+    """
+    return frombuffer(mz_blob, dtype=mz_dtype), frombuffer(intensity_blob, dtype=intensity_dtype)
+
+
+def mz_to_bin(mz, bin_width=FRAG_BIN_WIDTH):
+    """ m/z bin(s) for the fragment index, bin b covers m/z from (b - 0.5) * bin_width to (b + 0.5) * bin_width """
+    return rint(mz / bin_width).astype(int)
+
+
+def bin_fragments(mz, intensity, bin_width=FRAG_BIN_WIDTH):
+    """
+        bins the peaks of a spectrum for the fragment index
+        returns: m/z bins and the highest intensity of the peaks in each bin
+    """
+    bins = mz_to_bin(mz.astype(float), bin_width=bin_width)
+    ubins, idx = unique(bins, return_inverse=True)
+    max_intensity = zeros(len(ubins), dtype=int)
+    maximum.at(max_intensity, idx, intensity.astype(int))
+    return ubins, max_intensity
+
+
+def pack_spectra(dmim_cursor, pack_writer):
+    """ packs all of the spectra that have not been packed yet """
+    for dmim_id, spectrum in dmim_cursor.execute(qry_unpacked).fetchall():
+        pack_writer.add((*pack_spectrum(spectrum), dmim_id))
+
+
+def index_fragments(dmim_cursor, frag_writer, bin_width=FRAG_BIN_WIDTH):
+    """ adds the fragments of all of the packed spectra that have not been indexed yet to the fragment index """
+    for dmim_id, mz_blob, intensity_blob in dmim_cursor.execute(qry_unindexed).fetchall():
+        if mz_blob is None:
+            continue
+        for mz_bin, intensity in zip(*bin_fragments(*unpack_spectrum(mz_blob, intensity_blob), bin_width=bin_width)):
+            frag_writer.add((int(mz_bin), dmim_id, int(intensity)))
+
+
+def find_fragment(dmim_cursor, mz, tol, min_intensity=0, bin_width=FRAG_BIN_WIDTH):
+    """
+        finds all of the spectra that have a fragment at mz +/- tol, the match is resolved to the nearest bin (so
+        fragments up to bin_width / 2 beyond the tolerance window may also match)
+        returns: list of (dmim_id, highest intensity of the matching fragments)
+    """
+    lo, hi = mz_to_bin(mz - tol, bin_width=bin_width), mz_to_bin(mz + tol, bin_width=bin_width)
+    return dmim_cursor.execute(qry_find_fragment, (int(lo), int(hi), min_intensity)).fetchall()
@@ -0,0 +1,82 @@
+#!/usr/local/Cellar/python@3.9/3.9.1_6/bin/python3
+"""
+    Fills in the packed 3D structures (n_atoms and xyzmq columns of dmim_3d, see xyzmq.py) for an existing database,
+    adding the columns first if the database predates them (use upgrade_db.py to bring an older database all the way
+    up to the current schema version)
+
+    usage:
+        python3 pack_3d.py DMIM_v1.1.db
+"""
+
+import os
+import sys
+
+from bulk_writer import build_connect, BulkWriter
+from xyzmq import pack_xyzmq
+
+
+# define queries
+# add the packed structure columns
+qry_add_cols = [
+    "ALTER TABLE dmim_3d ADD COLUMN n_atoms INT;",
+    "ALTER TABLE dmim_3d ADD COLUMN xyzmq BLOB;",
+]
+
+# get structures that have not been packed yet
+qry_unpacked = """
+SELECT
+    str_id, structure
+FROM
+    dmim_3d
+WHERE
+    xyzmq IS NULL
+ORDER BY
+    str_id
+;"""
+
+# set packed structure
+qry_set_packed = """
+UPDATE
+    dmim_3d
+SET
+    n_atoms = ?,
+    xyzmq = ?
+WHERE
+    str_id = ?
+;"""
+
+
+def add_packed_columns(dmim_cursor):
+    """ adds the n_atoms and xyzmq columns to dmim_3d if they are not there already """
+    cols = [_[1] for _ in dmim_cursor.execute('PRAGMA table_info(dmim_3d);').fetchall()]
+    if 'xyzmq' not in cols:
+        for qry in qry_add_cols:
+            dmim_cursor.execute(qry)
+
+
+def pack_structures(dmim_cursor, pack_writer):
+    """ packs all of the structures that have not been packed yet """
+    for str_id, structure in dmim_cursor.execute(qry_unpacked).fetchall():
+        pack_writer.add((*pack_xyzmq(structure), str_id))
+
+
+def main(fname):
+    """ main execution """
+    if not os.path.isfile(fname):
+        raise FileNotFoundError(fname)
+
+    # initialize the database connection
+    dmim_con = build_connect(fname)
+    dmim_cur = dmim_con.cursor()
+
+    add_packed_columns(dmim_cur)
+    with BulkWriter(dmim_con, qry_set_packed, 'pack_3d') as pack_writer:
+        pack_structures(dmim_cur, pack_writer)
+
+    # commit changes and close DB connection
+    dmim_con.commit()
+    dmim_con.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
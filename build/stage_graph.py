@@ -0,0 +1,410 @@
+"""
+    Dependency-tracked build stages for the DMIM database
+
+    Every stage records a hash of its inputs (input files and the output hashes of its upstream stages) in the
+    build_state table. When the build is re-run only stages whose input hash has changed are executed:
+        'sync' stages recompute all of their rows into TEMP tables that shadow the main tables, then only the rows
+            that changed are merged into the main tables (rows that were removed or changed are deleted from the main
+            tables along with all of the rows that depend on them)
+        'fill' stages only compute rows that are missing from their tables, which after a 'sync' of an upstream
+            stage are exactly the rows downstream of whatever changed
+        'inplace' stages operate directly on the main tables
+
+    Stages form a DAG through their upstream stages. 'sync' and 'fill' stages run in worker processes as soon as all
+    of their upstream stages are finished, so independent stages (e.g. MQNs and 3D structures) run at the same time.
+    Each worker writes the new contents of its tables into its own staging database which is then merged into the main
+    database by the main process, one stage at a time and in the order the stages are listed. 'inplace' stages run in
+    the main process once no other stage is running.
+
+    Every stage is instrumented (wall and CPU time, peak RSS, rows read and written, the stage's own counts), the
+    results are returned by run_stages and written to the build report (see build_report.py).
+"""
+
+import os
+import re
+from hashlib import sha1
+from json import dumps
+from time import perf_counter, process_time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from initialize_db import table_schemas, table_keys, table_children, table_filtered
+from bulk_writer import build_connect
+from build_report import peak_rss_mb
+
+
+# how long (s) a connection waits on a lock held by another process, workers can hold read locks on the main
+# database for as long as their stage runs
+BUSY_TIMEOUT = 3600.
+
+
+# define queries
+# table with the recorded state of each build stage
+qry_create_build_state = """
+CREATE TABLE IF NOT EXISTS build_state (
+    -- stage name
+    stage TEXT PRIMARY KEY NOT NULL,
+    -- hash of the stage inputs (input files + upstream stage outputs + parameters)
+    input_hash TEXT NOT NULL,
+    -- hash of the contents of the tables written by the stage
+    output_hash TEXT NOT NULL
+)
+;"""
+
+# cache of input file hashes, only recomputed when file size or modification time change
+qry_create_build_inputs = """
+CREATE TABLE IF NOT EXISTS build_inputs (
+    fname TEXT PRIMARY KEY NOT NULL,
+    size INT NOT NULL,
+    mtime INT NOT NULL,
+    hash TEXT NOT NULL
+)
+;"""
+
+# get the recorded state for a stage
+qry_get_state = """
+SELECT
+    input_hash, output_hash
+FROM
+    build_state
+WHERE
+    stage = ?
+;"""
+
+# record the state for a stage
+qry_set_state = """
+INSERT OR REPLACE INTO build_state
+    (stage, input_hash, output_hash)
+VALUES
+    (?,?,?)
+;"""
+
+# get a cached file hash
+qry_get_file_hash = """
+SELECT
+    hash
+FROM
+    build_inputs
+WHERE
+    fname = ?
+    AND size = ?
+    AND mtime = ?
+;"""
+
+# record a file hash
+qry_set_file_hash = """
+INSERT OR REPLACE INTO build_inputs
+    (fname, size, mtime, hash)
+VALUES
+    (?,?,?,?)
+;"""
+
+
+class Stage:
+    """ a single build stage and its dependencies """
+
+    def __init__(self, name, func, tables, mode, inputs=(), upstream=(), params=None):
+        """
+            name - stage name
+            func - stage entry point, called with the DMIM database connection
+            tables - tables written by the stage
+            mode - 'sync', 'fill' or 'inplace' (see module docstring)
+            inputs - input files
+            upstream - names of stages this one depends on
+            params - any parameters that affect the stage output (must be JSON serializable)
+        """
+        if mode not in ['sync', 'fill', 'inplace']:
+            raise ValueError('Stage: mode "{}" invalid'.format(mode))
+        self.name = name
+        self.func = func
+        self.tables = list(tables)
+        self.mode = mode
+        self.inputs = list(inputs)
+        self.upstream = list(upstream)
+        self.params = params
+
+
+class ReuseIds:
+    """ assigns integer IDs, reusing the existing ID for rows whose content has not changed """
+
+    def __init__(self, existing):
+        """
+            existing - list of (content, id) for the rows that are already in the database
+        """
+        self.existing = {}
+        self.next_id = 1
+        for content, id_ in sorted(existing, key=lambda _: _[1]):
+            self.existing.setdefault(content, []).append(id_)
+            self.next_id = id_ + 1
+
+    def get(self, content):
+        """ returns the ID to use for a row with the given content """
+        ids = self.existing.get(content)
+        if ids:
+            return ids.pop(0)
+        id_ = self.next_id
+        self.next_id += 1
+        return id_
+
+
+def file_hash(dmim_cursor, fname):
+    """ returns the SHA1 of a file's contents, cached on file size and modification time """
+    st = os.stat(fname)
+    cached = dmim_cursor.execute(qry_get_file_hash, (fname, st.st_size, st.st_mtime_ns)).fetchall()
+    if cached:
+        return cached[0][0]
+    h = sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    dmim_cursor.execute(qry_set_file_hash, (fname, st.st_size, st.st_mtime_ns, h.hexdigest()))
+    return h.hexdigest()
+
+
+def table_hash(dmim_cursor, table):
+    """ returns the SHA1 of the contents of a table """
+    h = sha1()
+    qry = 'SELECT * FROM main.{t} ORDER BY {k};'.format(t=table, k=table_keys[table])
+    for row in dmim_cursor.execute(qry):
+        h.update(repr(row).encode())
+    return h.hexdigest()
+
+
+def delete_rows(dmim_cursor, table, keys):
+    """ deletes rows from a table by key, along with all rows in other tables that depend on them """
+    if not keys:
+        return
+    dmim_cursor.execute('CREATE TEMP TABLE del_keys (k);')
+    dmim_cursor.executemany('INSERT INTO temp.del_keys VALUES (?);', [(k,) for k in keys])
+    child_keys = {}
+    for child, col in table_children.get(table, []):
+        qry = 'SELECT {k} FROM main.{c} WHERE {col} IN (SELECT k FROM temp.del_keys);'
+        qry = qry.format(k=table_keys[child], c=child, col=col)
+        child_keys[child] = [_[0] for _ in dmim_cursor.execute(qry).fetchall()]
+    qry = 'DELETE FROM main.{t} WHERE {k} IN (SELECT k FROM temp.del_keys);'
+    dmim_cursor.execute(qry.format(t=table, k=table_keys[table]))
+    dmim_cursor.execute('DROP TABLE temp.del_keys;')
+    for child, ckeys in child_keys.items():
+        delete_rows(dmim_cursor, child, ckeys)
+
+
+def sync_table(dmim_cursor, table, src='temp'):
+    """ merges the new contents of a table (table with the same name in the src schema) into the main table, rows
+        that were moved out of the table by a later stage (see table_filtered) count as already being in it
+        returns: number of rows deleted, number of rows inserted """
+    key = table_keys[table]
+    filtered = table_filtered.get(table)
+    main = 'main.{}'.format(table)
+    if filtered is not None:
+        main = '(SELECT * FROM main.{} UNION ALL SELECT * FROM main.{})'.format(table, filtered)
+    # rows in the main table that are not exactly reproduced in the new contents
+    qry = 'SELECT {k} FROM (SELECT * FROM {m} EXCEPT SELECT * FROM {s}.{t});'
+    stale = [_[0] for _ in dmim_cursor.execute(qry.format(k=key, m=main, t=table, s=src)).fetchall()]
+    delete_rows(dmim_cursor, table, stale)
+    if filtered is not None:
+        delete_rows(dmim_cursor, filtered, stale)
+    # then any rows that are new or changed
+    qry = 'INSERT INTO main.{t} SELECT * FROM {s}.{t} EXCEPT SELECT * FROM {m} ORDER BY {k};'
+    n_ins = dmim_cursor.execute(qry.format(k=key, m=main, t=table, s=src)).rowcount
+    return len(stale), n_ins
+
+
+def input_hash(dmim_cursor, stage, output_hashes):
+    """ computes the hash of all of the inputs for a stage """
+    state = {
+        'inputs': {fname: file_hash(dmim_cursor, fname) for fname in stage.inputs},
+        'upstream': {name: output_hashes[name] for name in stage.upstream},
+        'params': stage.params,
+    }
+    return sha1(dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+def output_hash(dmim_cursor, stage):
+    """ computes the hash of the contents of all of the tables written by a stage """
+    return sha1(''.join([table_hash(dmim_cursor, table) for table in stage.tables]).encode()).hexdigest()
+
+
+def staging_fname(dmim_fname, stage):
+    """ name of the staging database a worker writes a stage's output to """
+    return '{}.{}.staging'.format(dmim_fname, stage.name)
+
+
+def run_instrumented(dmim_con, stage):
+    """ runs a stage's function on a connection opened with build_connect
+        returns: stage stats {wall, cpu, peak_rss_mb, rows_read, rows_written, counts} """
+    t0, c0 = perf_counter(), process_time()
+    r0, w0 = dmim_con.rows_read, dmim_con.total_changes
+    counts = stage.func(dmim_con)
+    dmim_con.commit()
+    return {
+        'wall': perf_counter() - t0,
+        'cpu': process_time() - c0,
+        'peak_rss_mb': peak_rss_mb(),
+        'rows_read': dmim_con.rows_read - r0,
+        'rows_written': dmim_con.total_changes - w0,
+        'counts': counts or {},
+    }
+
+
+def shadow_schema(table):
+    """ schema of a TEMP table that shadows one of the main tables, with the same columns and constraints (PRIMARY
+        KEY, UNIQUE, NOT NULL) so that a stage writing rows that violate them fails in its worker rather than when it
+        is merged, references to other tables are dropped since they would refer to the TEMP schema
+        returns: CREATE TEMP TABLE query """
+    schema = table_schemas[table].replace('CREATE TABLE', 'CREATE TEMP TABLE', 1)
+    return re.sub(r'\s+REFERENCES \w+\(\w+\)', '', schema)
+
+
+def stage_worker(dmim_fname, stage):
+    """ runs a 'sync' or 'fill' stage in a worker process and writes the new contents of its tables into a staging
+        database, the main database is only read from
+        returns: stage stats (see run_instrumented), the wall and CPU time include setting up and dumping the
+                 tables """
+    t0, c0 = perf_counter(), process_time()
+    dmim_con = build_connect(dmim_fname, timeout=BUSY_TIMEOUT)
+    cur = dmim_con.cursor()
+    # shadow the stage's tables with TEMP tables so the stage writes its new contents there, 'sync' stages start
+    # from empty tables and 'fill' stages start from a copy of the current contents
+    for table in stage.tables:
+        cur.execute(shadow_schema(table))
+        if stage.mode == 'fill':
+            cur.execute('INSERT INTO temp.{t} SELECT * FROM main.{t};'.format(t=table))
+    stats = run_instrumented(dmim_con, stage)
+    # dump the new contents into the staging database
+    fname = staging_fname(dmim_fname, stage)
+    if os.path.isfile(fname):
+        os.remove(fname)
+    cur.execute('ATTACH DATABASE ? AS staging;', (fname,))
+    for table in stage.tables:
+        cur.execute('CREATE TABLE staging.{t} AS SELECT * FROM temp.{t};'.format(t=table))
+    dmim_con.commit()
+    cur.execute('DETACH DATABASE staging;')
+    dmim_con.close()
+    stats['wall'], stats['cpu'] = perf_counter() - t0, process_time() - c0
+    return stats
+
+
+def merge_stage(dmim_con, dmim_fname, stage):
+    """ merges the output of a stage from its staging database into the main database, then removes the staging
+        database
+        returns: total number of rows removed/changed, total number of rows added """
+    cur = dmim_con.cursor()
+    fname = staging_fname(dmim_fname, stage)
+    cur.execute('ATTACH DATABASE ? AS staging;', (fname,))
+    n_del_all, n_ins_all = 0, 0
+    for table in stage.tables:
+        n_del, n_ins = sync_table(cur, table, src='staging')
+        print('{}: {} rows removed/changed, {} rows added'.format(table, n_del, n_ins))
+        n_del_all += n_del
+        n_ins_all += n_ins
+    dmim_con.commit()
+    cur.execute('DETACH DATABASE staging;')
+    os.remove(fname)
+    return n_del_all, n_ins_all
+
+
+def check_stages(stages):
+    """ makes sure stage names are unique and every stage is listed after all of its upstream stages """
+    names = []
+    for stage in stages:
+        if stage.name in names:
+            raise ValueError('check_stages: duplicate stage name "{}"'.format(stage.name))
+        for name in stage.upstream:
+            if name not in names:
+                msg = 'check_stages: upstream stage "{}" of "{}" is not listed before it'
+                raise ValueError(msg.format(name, stage.name))
+        names.append(stage.name)
+
+
+def timing_report(stats, t_total):
+    """ prints the per-stage timing report """
+    print()
+    print('stage          status     wall (s)    cpu (s)  merge (s)   rss (MB)  rows read  rows written')
+    msg = '{:14s} {:8s} {:10.2f} {:10.2f} {:10.2f} {:>10s} {:10d} {:13d}'
+    for name, s in stats.items():
+        rss = '-' if s['peak_rss_mb'] is None else '{:.1f}'.format(s['peak_rss_mb'])
+        print(msg.format(name, s['status'], s['wall'], s['cpu'], s['merge'], rss, s['rows_read'], s['rows_written']))
+    print('total build time: {:.2f} s'.format(t_total))
+    print()
+
+
+def skipped_stats(stage, status):
+    """ stage stats for a stage that did not run """
+    return {
+        'status': status,
+        'mode': stage.mode,
+        'wall': 0.,
+        'cpu': 0.,
+        'merge': 0.,
+        'peak_rss_mb': None,
+        'rows_read': 0,
+        'rows_written': 0,
+        'rows_removed': 0,
+        'rows_added': 0,
+        'counts': {},
+    }
+
+
+def run_stages(dmim_fname, stages, n_workers=None):
+    """ runs all stages that are out of date, each stage starts as soon as all of its upstream stages are done
+        n_workers - max number of worker processes (None to use the number of CPUs)
+        returns: per-stage stats {name: {status, mode, wall, cpu, merge, peak_rss_mb, rows_read, rows_written,
+                 rows_removed, rows_added, counts}} """
+    check_stages(stages)
+    t_build = perf_counter()
+    dmim_con = build_connect(dmim_fname, timeout=BUSY_TIMEOUT)
+    cur = dmim_con.cursor()
+    cur.execute(qry_create_build_state)
+    cur.execute(qry_create_build_inputs)
+    dmim_con.commit()
+    order = {stage.name: i for i, stage in enumerate(stages)}
+    output_hashes, stats = {}, {stage.name: skipped_stats(stage, 'pending') for stage in stages}
+    pending, running = list(stages), {}
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        while pending or running:
+            # start (or skip) every stage whose upstream stages are all done
+            started = True
+            while started:
+                started = False
+                for stage in pending:
+                    if not all([name in output_hashes for name in stage.upstream]):
+                        continue
+                    if stage.mode == 'inplace' and running:
+                        # 'inplace' stages modify the main tables directly so they wait for everything else
+                        continue
+                    pending.remove(stage)
+                    started = True
+                    ihash = input_hash(cur, stage, output_hashes)
+                    state = cur.execute(qry_get_state, (stage.name,)).fetchall()
+                    dmim_con.commit()
+                    if state and state[0][0] == ihash:
+                        print('{}: up to date'.format(stage.name))
+                        output_hashes[stage.name] = state[0][1]
+                        stats[stage.name] = skipped_stats(stage, 'skipped')
+                    elif stage.mode == 'inplace':
+                        print('{}: running'.format(stage.name))
+                        s = run_instrumented(dmim_con, stage)
+                        output_hashes[stage.name] = output_hash(cur, stage)
+                        cur.execute(qry_set_state, (stage.name, ihash, output_hashes[stage.name]))
+                        dmim_con.commit()
+                        stats[stage.name] = dict(skipped_stats(stage, 'ran'), **s)
+                    else:
+                        print('{}: running'.format(stage.name))
+                        running[pool.submit(stage_worker, dmim_fname, stage)] = (stage, ihash)
+                    break
+            if not running:
+                continue
+            # merge finished stages in the order they are listed so the merge is deterministic
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: order[running[f][0].name]):
+                stage, ihash = running.pop(future)
+                s = future.result()
+                t0 = perf_counter()
+                n_del, n_ins = merge_stage(dmim_con, dmim_fname, stage)
+                output_hashes[stage.name] = output_hash(cur, stage)
+                cur.execute(qry_set_state, (stage.name, ihash, output_hashes[stage.name]))
+                dmim_con.commit()
+                stats[stage.name] = dict(skipped_stats(stage, 'ran'), **s, merge=perf_counter() - t0,
+                                         rows_removed=n_del, rows_added=n_ins)
+    dmim_con.close()
+    timing_report(stats, perf_counter() - t_build)
+    return stats
@@ -0,0 +1,156 @@
+#!/usr/local/Cellar/python@3.9/3.9.1_6/bin/python3
+"""
+    Upgrades a DMIM database with the unified schema (user_version 2 or later) to the current schema version defined
+    in initialize_db.py, in place (databases with one family of tables per plate need migrate_db.py instead)
+
+        2 -> 3: adds the packed 3D structure columns to dmim_3d (see pack_3d.py)
+        3 -> 4: MQNs are stored as packed uint16 BLOBs instead of space-separated text
+        4 -> 5: adds the packed MS2 spectrum columns to dmim_ms2 and the dmim_ms2_frag fragment index (see
+            ms2_spectra.py)
+        5 -> 6: adds the dmim_ann_filtered table (see filter_metabs_metfrag_score.py), it starts out empty so the
+            annotations that were already filtered out are added back and filtered again the next time the
+            annotations stage runs
+        6 -> 7: 3D structures are packed as float64 instead of float32 (see xyzmq.py), the MD3Ds are recomputed
+            from the repacked structures
+
+    usage:
+        python3 upgrade_db.py DMIM_v1.1.db
+"""
+
+import os
+import sys
+
+from initialize_db import SCHEMA_VERSION, dmim_mqn_schema, dmim_ms2_frag_schema, dmim_ann_filtered_schema
+from bulk_writer import build_connect, BulkWriter
+from pack_3d import add_packed_columns, qry_set_packed, pack_structures
+from add_mqns import pack_mqns
+from add_md3d import qry_dmim_md3d, add_md3d
+from ms2_spectra import qry_set_packed as qry_set_packed_ms2, qry_insert_frag, pack_spectra, index_fragments
+
+
+# define queries
+# get MQNs that are still stored as text
+qry_text_mqns = """
+SELECT
+    ann_id, mqns
+FROM
+    dmim_mqn
+WHERE
+    typeof(mqns) = 'text'
+ORDER BY
+    ann_id
+;"""
+
+# add the packed MS2 spectrum columns
+qry_add_ms2_cols = [
+    "ALTER TABLE dmim_ms2 ADD COLUMN n_peaks INT;",
+    "ALTER TABLE dmim_ms2 ADD COLUMN base_mz REAL;",
+    "ALTER TABLE dmim_ms2 ADD COLUMN base_intensity INT;",
+    "ALTER TABLE dmim_ms2 ADD COLUMN spectrum_mz BLOB;",
+    "ALTER TABLE dmim_ms2 ADD COLUMN spectrum_intensity BLOB;",
+]
+
+# index on the fragment index dmim_id column
+qry_ms2_frag_index = "CREATE INDEX dmim_ms2_frag_dmim_id_idx ON dmim_ms2_frag (dmim_id);"
+
+# set packed MQNs
+qry_set_mqns = """
+UPDATE
+    dmim_mqn
+SET
+    mqns = ?
+WHERE
+    ann_id = ?
+;"""
+
+
+def pack_text_mqns(dmim_cursor, mqn_writer):
+    """ packs any MQNs that are still stored as text """
+    for ann_id, mqns in dmim_cursor.execute(qry_text_mqns).fetchall():
+        mqn_writer.add((pack_mqns([int(_) for _ in mqns.split()]), ann_id))
+
+
+def upgrade_2_3(dmim_con):
+    """ adds and fills the packed 3D structure columns """
+    add_packed_columns(dmim_con.cursor())
+    with BulkWriter(dmim_con, qry_set_packed, 'upgrade_db (2 -> 3)') as pack_writer:
+        pack_structures(dmim_con.cursor(), pack_writer)
+
+
+def upgrade_3_4(dmim_con):
+    """ recreates dmim_mqn with a BLOB mqns column and packs the MQNs """
+    cur = dmim_con.cursor()
+    cur.execute('ALTER TABLE dmim_mqn RENAME TO dmim_mqn_text;')
+    cur.execute(dmim_mqn_schema)
+    cur.execute('INSERT INTO dmim_mqn (ann_id, mqns) SELECT ann_id, mqns FROM dmim_mqn_text;')
+    cur.execute('DROP TABLE dmim_mqn_text;')
+    with BulkWriter(dmim_con, qry_set_mqns, 'upgrade_db (3 -> 4)') as mqn_writer:
+        pack_text_mqns(cur, mqn_writer)
+
+
+def upgrade_4_5(dmim_con):
+    """ adds and fills the packed MS2 spectrum columns and the fragment index """
+    cur = dmim_con.cursor()
+    for qry in qry_add_ms2_cols:
+        cur.execute(qry)
+    cur.execute(dmim_ms2_frag_schema)
+    cur.execute(qry_ms2_frag_index)
+    with BulkWriter(dmim_con, qry_set_packed_ms2, 'upgrade_db (4 -> 5)') as pack_writer:
+        pack_spectra(cur, pack_writer)
+    with BulkWriter(dmim_con, qry_insert_frag, 'upgrade_db (4 -> 5, fragment index)') as frag_writer:
+        index_fragments(cur, frag_writer)
+
+
+def upgrade_5_6(dmim_con):
+    """ adds the table of annotations removed by the MetFrag score filter """
+    dmim_con.cursor().execute(dmim_ann_filtered_schema)
+
+
+def upgrade_6_7(dmim_con):
+    """ repacks the 3D structures as float64 and recomputes the MD3Ds (which may have been computed from the float32
+        structures) """
+    cur = dmim_con.cursor()
+    cur.execute('UPDATE dmim_3d SET n_atoms = NULL, xyzmq = NULL;')
+    with BulkWriter(dmim_con, qry_set_packed, 'upgrade_db (6 -> 7)') as pack_writer:
+        pack_structures(cur, pack_writer)
+    cur.execute('DELETE FROM dmim_md3d;')
+    with BulkWriter(dmim_con, qry_dmim_md3d, 'upgrade_db (6 -> 7, MD3Ds)') as md3d_writer:
+        add_md3d(cur, md3d_writer)
+
+
+# upgrade functions, by starting schema version
+upgrades = {
+    2: upgrade_2_3,
+    3: upgrade_3_4,
+    4: upgrade_4_5,
+    5: upgrade_5_6,
+    6: upgrade_6_7,
+}
+
+
+def main(fname):
+    """ main execution """
+    if not os.path.isfile(fname):
+        raise FileNotFoundError(fname)
+
+    # initialize the database connection
+    dmim_con = build_connect(fname)
+    dmim_cur = dmim_con.cursor()
+
+    version = dmim_cur.execute('PRAGMA user_version;').fetchall()[0][0]
+    if version not in upgrades and version != SCHEMA_VERSION:
+        msg = 'main: unable to upgrade {} from schema version {} (use migrate_db.py for per-plate databases)'
+        raise RuntimeError(msg.format(fname, version))
+    while version < SCHEMA_VERSION:
+        upgrades[version](dmim_con)
+        version += 1
+        dmim_cur.execute('PRAGMA user_version = {};'.format(version))
+        dmim_con.commit()
+        print('upgraded {} to schema version {}'.format(fname, version))
+
+    # close DB connection
+    dmim_con.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,79 @@
+"""
+    Packed binary storage for 3D structures
+
+    The structure column of dmim_3d stores each structure as xyzmq text (one atom per line: x, y, z, mass, charge),
+    which has to be parsed every time it is read. The same data are also stored in the xyzmq column as a packed
+    float64 BLOB along with the number of atoms (n_atoms column), these can be read back as an (n_atoms, 5) array
+    using numpy.frombuffer without any parsing or copying. iter_structure_arrays reads structures as arrays, from the
+    packed column when it is filled and from the text otherwise. The packed values are exactly the values parsed from
+    the text (float64), so descriptors computed from either one (and their descriptor cache keys) are the same.
+"""
+
+from numpy import fromstring, frombuffer
+
+
+# packed structure dtype, explicitly little-endian so the BLOBs are portable
+xyzmq_dtype = '<f8'
+
+
+# define queries
+# get packed structures (falling back to the text structures for any that are not packed)
+qry_dmim_3d_packed = """
+SELECT
+    str_id, n_atoms, xyzmq, structure
+FROM
+    dmim_3d
+ORDER BY
+    str_id
+;"""
+
+
+def xyzmq_to_array(structure):
+    """
+        parses a structure in xyzmq format (text) without the overhead of loadtxt
+        returns: array with shape (n_atoms, 5), columns are x, y, z, mass, charge
+    """
+    values = fromstring(structure, sep=' ')
+    if values.size == 0 or values.size % 5 != 0:
+        raise ValueError('xyzmq_to_array: structure does not have 5 columns (x, y, z, m, q)')
+    return values.reshape(-1, 5)
+
+
+def pack_xyzmq(structure):
+    """
+        packs a structure in xyzmq format (text) into a float32 BLOB
+        returns: number of atoms, packed structure (bytes)
+    """
+    values = xyzmq_to_array(structure)
+    return len(values), values.astype(xyzmq_dtype).tobytes()
+
+
+def unpack_xyzmq(blob, n_atoms):
+    """
+        unpacks a structure packed with pack_xyzmq, the returned array is a read-only view of blob (no copy)
+        returns: float64 array with shape (n_atoms, 5), columns are x, y, z, mass, charge
+    """
+    return frombuffer(blob, dtype=xyzmq_dtype).reshape(n_atoms, 5)
+
+
+def iter_structure_arrays(dmim_cursor, qry=qry_dmim_3d_packed, errors=None):
+    """
+        yields (str_id, structure array) for all of the structures in the dmim_3d table, using the packed structures
+        when they are available, all of the rows are fetched first so the caller can write to the database while
+        iterating
+        qry - query selecting str_id, n_atoms, xyzmq, structure (e.g. to only select some of the structures)
+        errors - list that (str_id, exception) is appended to for any text structure that cannot be parsed, which is
+                 then skipped (None to raise the exception)
+    """
+    for str_id, n_atoms, blob, structure in dmim_cursor.execute(qry).fetchall():
+        if blob is not None:
+            yield str_id, unpack_xyzmq(blob, n_atoms)
+            continue
+        try:
+            values = xyzmq_to_array(structure)
+        except ValueError as e:
+            if errors is None:
+                raise
+            errors.append((str_id, e))
+            continue
+        yield str_id, values
@@ -5,6 +5,7 @@ import re
 import pickle
 import os
 from glob import glob
+from itertools import takewhile
 
 from dmim_analysis.util import remove_counter_ions
 from dhrmasslynxapi.reader import MassLynxReader
@@ -46,13 +47,8 @@ def find_cmpd_pickle(name, plate_date, sub_commas=True):
 
 # returns a string containing the mass spectrum in plain-text format
 def spectrum_as_txt(m, i, m_max):
-    s = ''
     f = '{:.4f} {:d}\n'
-    for m_, i_ in zip(m, i):
-        if m_ > m_max:
-            break
-        s += f.format(m_, int(i_))
-    return s
+    return ''.join([f.format(m_, int(i_)) for m_, i_ in takewhile(lambda _: _[0] <= m_max, zip(m, i))])
 
 
 # iterate through all 7 plates
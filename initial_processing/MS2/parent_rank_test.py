@@ -1,7 +1,7 @@
 #
 
 from sqlite3 import connect
-from numpy import array
+from numpy import fromstring
 import re
 
 from metfrag2 import fragmenter_rank
@@ -28,7 +28,7 @@ def main():
                     'inchi_key': inchi_key
                 }
                 # make mass spectrum into arrays
-                m, i = array([[float(_a) for _a in _b.split(' ')] for _b in spectrum.split('\n')[:-1]]).T
+                m, i = fromstring(spectrum, sep=' ').reshape(-1, 2).T
                 # compute score
                 rank = fragmenter_rank(m, i, 1000, md)
                 print(rank)
@@ -0,0 +1,398 @@
+#!/Library/Frameworks/Python.framework/Versions/3.8/bin/python3
+"""
+    Persistent CCS prediction service
+
+    Keeps the CCS model bundles (see model_bundle.py) loaded and serves predictions over HTTP, on localhost or on a
+    Unix socket, so that featurizing and predicting a set of compounds does not have to go through separate scripts
+    and intermediate files. Requests from concurrent clients are put on a queue and a single worker thread
+    collects them into micro-batches (up to max_batch structures, waiting at most max_wait_ms for more to arrive),
+    computes the descriptors for the whole batch at once (through the descriptor cache, see
+    build/descriptor_cache.py) and runs one vectorized prediction per model.
+
+    endpoints:
+        POST /predict -- {"smiles": [...], "structures": [...], "models": [...]}
+                         structures (optional) are 3D structures in xyzmq format (text) or null, one per SMILES,
+                         models using MD3Ds predict null for entries without a structure, models (optional) defaults
+                         to all of the loaded models
+                         returns {"ccs": {model: [CCS or null, ...]}, "errors": {"index": "message"}}, entries
+                         that fail (bad SMILES, unusable structures) only get an error, a request that is not in this
+                         form (e.g. smiles is not a list of strings) is rejected with a 400
+        GET /metrics  -- request/structure counts, batch sizes, throughput and latency percentiles
+        GET /models   -- feature names and metadata of the loaded models
+
+    usage:
+        ccs_server.py [--port PORT] [--unix SOCKET] [--models DIR] [--max-batch N] [--max-wait-ms T]
+"""
+
+import os
+import sys
+import json
+import socket
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Lock, Thread
+from time import perf_counter
+
+from numpy import full, nan, isnan, isfinite, array, percentile
+from rdkit import Chem
+
+from DmimData.data import MQN_NAMES, MD3D_NAMES
+from build.add_mqns import cached_mqns
+from build.add_md3d import cached_md3ds, parse_xyzmq
+from build.descriptor_cache import default_cache
+from model_bundle import CCSModel
+
+
+# models served by default (bundles saved by train_mqn_md3d_svr.py)
+MODEL_LABELS = ['mqn', 'md3d', 'comb', 'cust']
+
+# column of each feature in the descriptors computed for a batch (MQNs then MD3Ds, as in the 'combined' feature set)
+FEATURE_COLUMNS = {name: i for i, name in enumerate(MQN_NAMES + MD3D_NAMES)}
+
+# defaults for the command line options
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH = 1024
+DEFAULT_MAX_WAIT_MS = 5.
+
+# number of recent requests used for the latency percentiles, and window for the recent throughput (seconds)
+LATENCY_WINDOW = 1000
+THROUGHPUT_WINDOW = 60.
+
+
+def load_models(model_dir, labels=MODEL_LABELS):
+    """ loads the model bundles {label}_ccs_model_seed420.pickle that exist in model_dir
+        returns: dict(label -> CCSModel) """
+    models = {}
+    for label in labels:
+        fname = os.path.join(model_dir, '{}_ccs_model_seed420.pickle'.format(label))
+        if os.path.isfile(fname):
+            model = CCSModel.load(fname)
+            unknown = [name for name in model.feature_names if name not in FEATURE_COLUMNS]
+            if unknown:
+                msg = 'load_models: model {} uses features that can not be computed from structures: {}'
+                raise ValueError(msg.format(label, ', '.join(unknown)))
+            models[label] = model
+    if not models:
+        raise ValueError('load_models: no model bundles found in {}'.format(model_dir))
+    return models
+
+
+def check_structure(xyz, m):
+    """ makes sure MD3Ds can be computed for a structure (at least 2 atoms, finite coordinates and masses, total mass
+        > 0), raises a ValueError if they can not """
+    if len(m) < 2:
+        raise ValueError('structure has {} atom(s), at least 2 are needed'.format(len(m)))
+    if not (isfinite(xyz).all() and isfinite(m).all()):
+        raise ValueError('structure has non-finite coordinates or masses')
+    if m.sum() <= 0.:
+        raise ValueError('structure has a total mass of {}'.format(m.sum()))
+
+
+def compute_features(smis, structures, cache):
+    """ computes the MQNs and MD3Ds for a batch, entries that fail (or have no structure) are left as NaN
+        returns: array with shape (n, 50) (columns given by FEATURE_COLUMNS), dict(index -> error message) """
+    n_mqn = len(MQN_NAMES)
+    X = full((len(smis), n_mqn + len(MD3D_NAMES)), nan)
+    errors = []
+    # the batches are small, so the MQNs are computed in this process rather than starting a pool of workers
+    for i, mqns in cached_mqns(enumerate(smis), cache, n_workers=1, errors=errors):
+        X[i, :n_mqn] = mqns
+    # SMILES that RDKit cannot parse get a clear error instead of whatever computing MQNs on None raised, only the
+    # failed ones are parsed here so cache hits still do not need to be parsed at all
+    errors = {i: 'invalid SMILES' if Chem.MolFromSmiles(smis[i]) is None else 'unable to compute MQNs: {}'.format(err)
+              for i, err in errors}
+    idx, xyz, m = [], [], []
+    for i, structure in enumerate(structures):
+        if structure is None:
+            continue
+        try:
+            _xyz, _m = parse_xyzmq(structure)
+        except Exception as e:
+            errors[i] = 'unable to parse structure: {}'.format(e)
+            continue
+        try:
+            check_structure(_xyz, _m)
+        except ValueError as e:
+            errors[i] = 'invalid structure: {}'.format(e)
+            continue
+        idx.append(i)
+        xyz.append(_xyz)
+        m.append(_m)
+    if idx:
+        try:
+            X[idx, n_mqn:] = cached_md3ds(xyz, m, cache)
+        except Exception:
+            # fall back to one structure at a time so only the one(s) that fail are left out
+            for i, _xyz, _m in zip(idx, xyz, m):
+                try:
+                    X[i, n_mqn:] = cached_md3ds([_xyz], [_m], cache)[0]
+                except Exception as e:
+                    errors[i] = 'unable to compute MD3Ds: {}'.format(e)
+    return X, errors
+
+
+class ServiceMetrics:
+    """ thread-safe counters and timings for the /metrics endpoint """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start = perf_counter()
+        self.requests = 0
+        self.failed_requests = 0
+        self.structures = 0
+        self.batches = 0
+        self.featurize_s = 0.
+        self.predict_s = 0.
+        self.max_batch_seen = 0
+        # latency of each recent request (seconds), (time, number of structures) of each recent batch
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.recent = deque()
+
+    def record_batch(self, n_structures, featurize_s, predict_s):
+        """ records a processed batch """
+        now = perf_counter()
+        with self.lock:
+            self.batches += 1
+            self.structures += n_structures
+            self.featurize_s += featurize_s
+            self.predict_s += predict_s
+            self.max_batch_seen = max(self.max_batch_seen, n_structures)
+            self.recent.append((now, n_structures))
+            while self.recent and self.recent[0][0] < now - THROUGHPUT_WINDOW:
+                self.recent.popleft()
+
+    def record_request(self, latency, failed=False):
+        """ records a finished request """
+        with self.lock:
+            self.requests += 1
+            self.failed_requests += failed
+            self.latencies.append(latency)
+
+    def snapshot(self):
+        """ current metrics
+            returns: dict """
+        now = perf_counter()
+        with self.lock:
+            uptime = now - self.start
+            recent = sum([n for t, n in self.recent if t >= now - THROUGHPUT_WINDOW])
+            lat = array(self.latencies) * 1000.
+            return {
+                'uptime_s': uptime,
+                'requests': self.requests,
+                'failed_requests': self.failed_requests,
+                'structures': self.structures,
+                'batches': self.batches,
+                'mean_batch_size': self.structures / self.batches if self.batches else 0.,
+                'max_batch_size': self.max_batch_seen,
+                'structures_per_s': self.structures / uptime if uptime > 0 else 0.,
+                'recent_structures_per_s': recent / min(uptime, THROUGHPUT_WINDOW) if uptime > 0 else 0.,
+                'featurize_s': self.featurize_s,
+                'predict_s': self.predict_s,
+                'latency_ms': {
+                    'p50': float(percentile(lat, 50)) if len(lat) else None,
+                    'p90': float(percentile(lat, 90)) if len(lat) else None,
+                    'p99': float(percentile(lat, 99)) if len(lat) else None,
+                    'max': float(lat.max()) if len(lat) else None,
+                },
+            }
+
+
+class Batcher:
+    """ collects prediction requests from any number of threads into micro-batches that are featurized and
+        predicted together by one worker thread (see module docstring) """
+
+    def __init__(self, models, max_batch=DEFAULT_MAX_BATCH, max_wait_ms=DEFAULT_MAX_WAIT_MS, metrics=None):
+        """
+            models - dict(label -> CCSModel)
+            max_batch - maximum number of structures in a batch (a single larger request is processed on its own)
+            max_wait_ms - maximum time to wait for more requests before processing a batch
+            metrics - ServiceMetrics instance (None to create a new one)
+        """
+        self.models = models
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.metrics = metrics if metrics is not None else ServiceMetrics()
+        self.queue = Queue()
+        self.worker = Thread(target=self._run, name='ccs-batcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, smis, structures=None, labels=None):
+        """ queues a request, structures (xyzmq text or None for each SMILES) are needed for models using MD3Ds
+            returns: Future with the result, dict(label -> list of CCS or None), dict(index -> error message) """
+        # anything else that is iterable (e.g. a single SMILES string or a dict) would be taken apart silently
+        if not isinstance(smis, list) or not all(isinstance(smi, str) for smi in smis):
+            raise ValueError('Batcher: SMILES structures must be a list of strings')
+        if structures is None:
+            structures = [None for _ in smis]
+        elif not isinstance(structures, list) or not all(isinstance(_, str) or _ is None for _ in structures):
+            raise ValueError('Batcher: 3D structures must be a list of strings (or null)')
+        if labels is not None and (not isinstance(labels, list) or not all(isinstance(_, str) for _ in labels)):
+            raise ValueError('Batcher: models must be a list of strings')
+        if len(structures) != len(smis):
+            msg = 'Batcher: got {} SMILES structures but {} 3D structures'
+            raise ValueError(msg.format(len(smis), len(structures)))
+        labels = list(self.models) if labels is None else list(labels)
+        unknown = [label for label in labels if label not in self.models]
+        if unknown:
+            raise ValueError('Batcher: unknown model(s): {}'.format(', '.join(unknown)))
+        future = Future()
+        self.queue.put((smis, structures, labels, future))
+        return future
+
+    def _run(self):
+        """ worker thread, the descriptor cache is opened here since SQLite connections are tied to one thread """
+        cache = default_cache()
+        while True:
+            batch = [self.queue.get()]
+            n = len(batch[0][0])
+            deadline = perf_counter() + self.max_wait
+            while n < self.max_batch:
+                try:
+                    request = self.queue.get(timeout=max(deadline - perf_counter(), 0.))
+                except Empty:
+                    break
+                batch.append(request)
+                n += len(request[0])
+            try:
+                self._process(batch, cache)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch, cache):
+        """ featurizes all of the structures in a batch at once, then runs one prediction per model """
+        t0 = perf_counter()
+        smis = [smi for request in batch for smi in request[0]]
+        structures = [structure for request in batch for structure in request[1]]
+        X, errors = compute_features(smis, structures, cache)
+        t1 = perf_counter()
+        # offset of each request in the batch
+        offsets = [0]
+        for request in batch:
+            offsets.append(offsets[-1] + len(request[0]))
+        predictions = {}
+        for label in {label for request in batch for label in request[2]}:
+            model = self.models[label]
+            X_model = X[:, [FEATURE_COLUMNS[name] for name in model.feature_names]]
+            valid = ~isnan(X_model).any(axis=1)
+            y = full(len(smis), nan)
+            if valid.any():
+                y[valid] = model.predict(X_model[valid])
+            predictions[label] = y
+        t2 = perf_counter()
+        self.metrics.record_batch(len(smis), t1 - t0, t2 - t1)
+        for (_, _, labels, future), i, j in zip(batch, offsets[:-1], offsets[1:]):
+            ccs = {label: [None if isnan(v) else float(v) for v in predictions[label][i:j]] for label in labels}
+            future.set_result((ccs, {k - i: err for k, err in errors.items() if i <= k < j}))
+
+
+class CCSRequestHandler(BaseHTTPRequestHandler):
+    """ HTTP interface to a Batcher (server.batcher), see module docstring for the endpoints """
+
+    # keep connections open between requests
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # client_address is empty for Unix sockets
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # one line per request is too much at thousands of requests per second, see /metrics instead
+        pass
+
+    def _reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200, self.server.batcher.metrics.snapshot())
+        elif self.path == '/models':
+            self._reply(200, {label: {'feature_names': model.feature_names, 'metadata': model.metadata}
+                              for label, model in self.server.batcher.models.items()})
+        else:
+            self._reply(404, {'error': 'unknown endpoint {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'unknown endpoint {}'.format(self.path)})
+            return
+        t0 = perf_counter()
+        try:
+            content = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            future = self.server.batcher.submit(content['smiles'], structures=content.get('structures'),
+                                                labels=content.get('models'))
+            ccs, errors = future.result()
+        except (ValueError, KeyError, TypeError) as e:
+            self.server.batcher.metrics.record_request(perf_counter() - t0, failed=True)
+            self._reply(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.server.batcher.metrics.record_request(perf_counter() - t0, failed=True)
+            self._reply(500, {'error': str(e)})
+            return
+        self.server.batcher.metrics.record_request(perf_counter() - t0)
+        self._reply(200, {'ccs': ccs, 'errors': {str(k): v for k, v in errors.items()}})
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """ HTTP server on a Unix socket, one thread per connection """
+
+    daemon_threads = True
+
+    def server_bind(self):
+        # remove a socket left over from a previous run
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def make_server(batcher, port=DEFAULT_PORT, unix_socket=None):
+    """ creates an HTTP server for a Batcher, on localhost:port or on a Unix socket (if unix_socket is set)
+        returns: server (call serve_forever() to start it) """
+    if unix_socket is not None:
+        server = ThreadingUnixHTTPServer(unix_socket, CCSRequestHandler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), CCSRequestHandler)
+        # small responses, do not wait to fill packets
+        server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    server.batcher = batcher
+    return server
+
+
+def main():
+    """ main execution """
+    args = sys.argv[1:]
+    port = int(args[args.index('--port') + 1]) if '--port' in args else DEFAULT_PORT
+    unix_socket = args[args.index('--unix') + 1] if '--unix' in args else None
+    model_dir = args[args.index('--models') + 1] if '--models' in args else '.'
+    max_batch = int(args[args.index('--max-batch') + 1]) if '--max-batch' in args else DEFAULT_MAX_BATCH
+    max_wait_ms = float(args[args.index('--max-wait-ms') + 1]) if '--max-wait-ms' in args else DEFAULT_MAX_WAIT_MS
+    models = load_models(model_dir)
+    server = make_server(Batcher(models, max_batch=max_batch, max_wait_ms=max_wait_ms), port=port,
+                         unix_socket=unix_socket)
+    print('serving models {} on {}'.format(', '.join(models), unix_socket or 'http://127.0.0.1:{}'.format(port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
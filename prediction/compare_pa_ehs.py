@@ -21,24 +21,25 @@ rcParams['font.size'] = 8
 # define a query to get structure ids
 qry = """
 SELECT
-    plate_{n}_3d.str_id, pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p, ccs_avg, annotation, adduct, met_n, mz
+    dmim_3d.str_id, pmi1, pmi2, pmi3, rmd02, rmd24, rmd46, rmd68, rmd8p, ccs_avg, annotation, adduct, met_n, mz
 FROM
-    plate_{n}_md3d
-    JOIN plate_{n}_3d
-        ON plate_{n}_md3d.str_id = plate_{n}_3d.str_id
-    JOIN plate_{n}_id
-        ON plate_{n}_3d.ann_id = plate_{n}_id.ann_id
-    JOIN plate_{n}
-        ON plate_{n}_id.dmim_id = plate_{n}.dmim_id
+    dmim_md3d
+    JOIN dmim_3d
+        ON dmim_md3d.str_id = dmim_3d.str_id
+    JOIN dmim_ann
+        ON dmim_3d.ann_id = dmim_ann.ann_id
+    JOIN dmim
+        ON dmim_ann.dmim_id = dmim.dmim_id
+ORDER BY
+    plate, dmim_md3d.str_id
 ;"""
 
 
 def get_indices(cursor, str_id):
     """ fetch the indices of structures with PA/EHS CCS values """
     str_ids = []
-    for n in range(1, 8):
-        for sid, *_ in cursor.execute(qry.format(n=n)):
-            str_ids.append(int(sid))
+    for sid, *_ in cursor.execute(qry):
+        str_ids.append(int(sid))
     idx = []
     for i in range(len(str_ids)):
         if str_ids[i] in str_id:
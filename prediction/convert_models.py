@@ -0,0 +1,92 @@
+#!/Library/Frameworks/Python.framework/Versions/3.8/bin/python3
+"""
+    Builds model bundles (see model_bundle.py) from the separately pickled SVRs and scalers
+
+    Models trained before train_mqn_md3d_svr.py saved model bundles only have {label}_svr_seed420.pickle and
+    {label}_scaler_seed420.pickle. When the scaler pickle exists and has the same number of features as the SVR the
+    bundle is built from the two pickles and the DB is not needed. Otherwise (no scaler was saved for comb, and the cust
+    scaler pickle is actually the one fit on the MQNs) the scaler is refit on the same training set the SVR was trained
+    on, which needs the DB, and the scaler pickle is rewritten along with the bundle. Labels whose SVR pickle is
+    missing, or that need the DB when it is not available, are skipped.
+
+    usage:
+        python3 convert_models.py [label ...]
+"""
+
+import os
+import sys
+from datetime import datetime
+from pickle import load
+
+from DmimData.data import DMD, feature_names
+from model_bundle import CCSModel
+from train_mqn_md3d_svr import SEED, CUSTOM_MQNS, CUSTOM_MD3DS, save_model
+
+
+# DB the models were trained on
+DB_FNAME = 'DMIM_v1.0.db'
+
+# feature set of each model: label -> (features, custom_mqns, custom_md3ds), as passed to DMD.featurize(...)
+MODEL_FEATURES = {
+    'mqn': ('mqn', None, None),
+    'md3d': ('md3d', None, None),
+    'comb': ('combined', None, None),
+    'cust': ('custom', CUSTOM_MQNS, CUSTOM_MD3DS),
+}
+
+
+def load_pickle(fname):
+    """ loads a pickle file (None if it does not exist) """
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'rb') as pf:
+        return load(pf)
+
+
+def convert_model(label):
+    """ builds {label}_ccs_model_seed420.pickle from the SVR and scaler pickles (refitting the scaler if needed)
+        returns: True if the bundle was saved """
+    svr_fname = '{}_svr_seed420.pickle'.format(label)
+    scaler_fname = '{}_scaler_seed420.pickle'.format(label)
+    svr = load_pickle(svr_fname)
+    if svr is None:
+        print('{}: {} not found, skipped'.format(label, svr_fname))
+        return False
+    features, custom_mqns, custom_md3ds = MODEL_FEATURES[label]
+    names = feature_names(features, custom_mqns=custom_mqns, custom_md3ds=custom_md3ds)
+    if len(names) != svr.n_features_in_:
+        msg = 'convert_model: {} SVR has {} features, the {} feature set has {}'
+        raise ValueError(msg.format(label, svr.n_features_in_, features, len(names)))
+    scaler = load_pickle(scaler_fname)
+    if scaler is not None and scaler.n_features_in_ == svr.n_features_in_:
+        metadata = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'seed': SEED,
+            'features': features,
+            'converted_from': [svr_fname, scaler_fname],
+        }
+        CCSModel(names, scaler.mean_, scaler.scale_, svr, metadata=metadata).save(
+            '{}_ccs_model_seed420.pickle'.format(label))
+        print('{}: bundle built from {} and {}'.format(label, svr_fname, scaler_fname))
+        return True
+    # the scaler has to be refit on the training set
+    if not os.path.isfile(DB_FNAME):
+        print('{}: no usable scaler in {} and {} not found, skipped'.format(label, scaler_fname, DB_FNAME))
+        return False
+    data = DMD(DB_FNAME, SEED)
+    data.featurize(features, custom_mqns=custom_mqns, custom_md3ds=custom_md3ds)
+    data.train_test_split()
+    data.center_and_scale()
+    save_model(data, svr, label)
+    print('{}: scaler refit on the training set, bundle and {} saved'.format(label, scaler_fname))
+    return True
+
+
+def main():
+    """ main execution sequence """
+    for label in sys.argv[1:] or list(MODEL_FEATURES):
+        convert_model(label)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+    Parallel feature elimination
+
+    Fits a model on many subsets of the columns of one feature matrix and reports the RMSE of each fit. The centered/
+    scaled features are written once to a read-only memory-mapped .npy file (see DmimData/shared_arrays.py) that every
+    worker process maps, and each fit just takes the columns it needs, so the DB is never re-queried and the scaling is
+    not redone (StandardScaler works column by column, so a subset of the scaled columns is the same as scaling the
+    subset). Fits run in a process pool and results are yielded as they finish. Every result is also appended to a
+    checkpoint file (JSON lines, one {"features": [...], "rmse": ...} record per fit), subsets that are already in the
+    checkpoint are not refit, so an interrupted run picks up where it stopped and a finished run can be re-read (e.g.
+    to regenerate a plot) without fitting anything. The first line of a checkpoint file is a {"header": {...}} record
+    describing how the fits were done (search mode, parameter grid, training data, ...), a file whose header does not
+    match the current run is moved aside (to fname + '.old') rather than reused.
+
+    Two strategies:
+        ranked_elimination -- given a ranking of the features, removes the least important remaining feature at each
+                              step, the steps are independent so all of them run in parallel
+        recursive_elimination -- backward elimination, at each step every remaining feature is tried for removal (in
+                                 parallel) and the one whose removal gives the lowest RMSE is dropped
+"""
+
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from numpy import load
+
+from DmimData.shared_arrays import shared_array
+from metrics import rmse
+
+
+# features, labels and fit function in each worker process (set by _init_worker)
+_worker = {}
+
+
+def _init_worker(X_file, y_file, fit):
+    """ maps the shared arrays in a worker process """
+    _worker['X'] = load(X_file, mmap_mode='r')
+    _worker['y'] = load(y_file, mmap_mode='r')
+    _worker['fit'] = fit
+
+
+def _fit_columns(features, columns):
+    """ fits a model on a subset of the columns and computes the RMSE of its predictions on the same data
+        returns: features, RMSE """
+    X, y = _worker['X'].take(columns, axis=1), _worker['y']
+    model = _worker['fit'](X, y)
+    return features, rmse(y, model.predict(X))
+
+
+class Checkpoint:
+    """ RMSE of every feature subset that has been fit, kept in memory and appended to a JSON lines file """
+
+    def __init__(self, fname=None, header=None):
+        """
+            fname - checkpoint file, previous results are loaded if it exists (None to only keep results in memory)
+            header - dict (JSON serializable) describing the fits, results are only loaded from a file with the same
+                     header
+        """
+        self.fname = fname
+        # compare headers the way they are read back from the file (e.g. tuples become lists)
+        self.header = json.loads(json.dumps(header if header is not None else {}))
+        self.results = {}
+        if fname is not None and os.path.isfile(fname):
+            if self._read_header() == self.header:
+                self._load()
+            else:
+                print('Checkpoint: header of {} does not match, moved to {}'.format(fname, fname + '.old'))
+                os.replace(fname, fname + '.old')
+
+    def _read_header(self):
+        """ header record of the checkpoint file (None if it does not have one) """
+        with open(self.fname, 'r') as f:
+            try:
+                return json.loads(f.readline()).get('header')
+            except (ValueError, AttributeError):
+                return None
+
+    def _load(self):
+        """ loads the results from the checkpoint file """
+        with open(self.fname, 'r') as f:
+            # skip the header
+            line = f.readline()
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # last line is incomplete if the previous run was killed while writing it
+                    continue
+                self.results[frozenset(rec['features'])] = rec['rmse']
+        if not line.endswith('\n'):
+            # start new results on their own line after an incomplete one
+            with open(self.fname, 'a') as f:
+                f.write('\n')
+
+    def get(self, features):
+        """ RMSE of a previous fit on features (in any order), None if it has not been fit """
+        return self.results.get(frozenset(features))
+
+    def add(self, features, rmse_):
+        """ records the RMSE of a fit on features """
+        self.results[frozenset(features)] = rmse_
+        if self.fname is not None:
+            new_file = not os.path.isfile(self.fname)
+            with open(self.fname, 'a') as f:
+                if new_file:
+                    f.write(json.dumps({'header': self.header}) + '\n')
+                f.write(json.dumps({'features': [str(name) for name in features], 'rmse': float(rmse_)}) + '\n')
+
+
+class EliminationPool:
+    """ process pool with shared features/labels for fitting subsets of the features (see module docstring) """
+
+    def __init__(self, X, y, feature_names, fit, checkpoint=None, n_workers=None):
+        """
+            X, y - features and labels
+            feature_names - name of each column of X
+            fit - function that takes X, y and returns a fitted model (must be picklable, i.e. defined at module
+                  level, and should run single-threaded since the fits already run in parallel)
+            checkpoint - Checkpoint instance or file name (None to not keep results between runs), pass a Checkpoint
+                         with a header so results from a different setup are not reused
+            n_workers - number of worker processes (None for the number of CPUs)
+        """
+        self.X, self.y = X, y
+        self.columns = {name: i for i, name in enumerate(feature_names)}
+        self.fit = fit
+        self.checkpoint = checkpoint if isinstance(checkpoint, Checkpoint) else Checkpoint(checkpoint)
+        self.n_workers = n_workers
+        self._executor = None
+
+    def _start(self):
+        """ shares the arrays and starts the worker processes (only done once something needs to be fit) """
+        if self._executor is None:
+            X_file = shared_array(self.X, 'X_elim').filename
+            y_file = shared_array(self.y, 'y_elim').filename
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                                 initargs=(X_file, y_file, self.fit))
+
+    def fit_subsets(self, subsets):
+        """ fits each subset of features (lists of names), previous results are taken from the checkpoint
+            yields: (features, RMSE) for each subset as its fit finishes (in any order) """
+        todo = []
+        for features in subsets:
+            rmse_ = self.checkpoint.get(features)
+            if rmse_ is None:
+                todo.append(features)
+            else:
+                yield features, rmse_
+        if todo:
+            self._start()
+            futures = [self._executor.submit(_fit_columns, features, [self.columns[f] for f in features])
+                       for features in todo]
+            for future in as_completed(futures):
+                features, rmse_ = future.result()
+                self.checkpoint.add(features, rmse_)
+                yield features, rmse_
+
+    def close(self):
+        """ shuts down the worker processes """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def ranked_elimination(pool, ranking):
+    """ fits on every prefix of ranking (most to least important), i.e. the least important remaining feature is
+        removed at each step, all of the steps are fit in parallel
+        yields: (features, RMSE) for each step as its fit finishes (in any order) """
+    ranking = list(ranking)
+    yield from pool.fit_subsets([ranking[:k] for k in range(len(ranking), 0, -1)])
+
+
+def recursive_elimination(pool, features):
+    """ backward elimination starting from features, at each step every remaining feature is tried for removal and
+        the one whose removal gives the lowest RMSE is dropped (ties go to the feature listed last)
+        yields: (features, RMSE) for the starting set and then the set kept after each step, in order """
+    features = list(features)
+    yield from pool.fit_subsets([features])
+    while len(features) > 1:
+        results = {}
+        for kept, rmse_ in pool.fit_subsets([[f for f in features if f != r] for r in features]):
+            results[frozenset(kept)] = rmse_
+        best = None
+        for r in features[::-1]:
+            kept = [f for f in features if f != r]
+            if best is None or results[frozenset(kept)] < best[1]:
+                best = (kept, results[frozenset(kept)])
+        features = best[0]
+        yield best
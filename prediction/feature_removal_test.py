@@ -3,88 +3,97 @@
 
 """
 
+import os
+from functools import partial
 from matplotlib import pyplot as plt, rcParams
 from numpy import argsort, array, loadtxt, abs
 from pickle import load as pload
-from sklearn.model_selection import GridSearchCV
 from sklearn.svm import SVR
 
-from DmimData.data import DMD
-from metrics import rmse
+from DmimData.data import DMD, MQN_NAMES, MD3D_NAMES
+from param_search import search, log_grid
+from feature_elimination import Checkpoint, EliminationPool, ranked_elimination, recursive_elimination
 
 
 # define a global pRNG seed
 SEED = 420
 
+# hyperparameter search mode, 'grid' (exhaustive, coarse grid) or 'halving' (successive halving, finer grid)
+SEARCH_MODE = 'grid'
+
 # set the global fontsize on plots
 rcParams['font.size'] = 8
 
+# names of the features in the 'combined' feature set, in column order
+COMB_FEATURES = MQN_NAMES + MD3D_NAMES
 
-def train_svr(X, y):
-    """ trains an SVR using X and y data, returns the trained model instance """
-    pg = {'C': [10., 100., 1000.]}
-    gs = GridSearchCV(SVR(cache_size=2048, tol=5e-3, kernel='rbf', gamma='scale'), param_grid=pg, n_jobs=-1, cv=3, scoring='neg_mean_squared_error', )
-    gs.fit(X, y)
-    return gs.best_estimator_
 
+def svr_param_grid(mode=SEARCH_MODE):
+    """ SVR hyperparameters searched with each search mode """
+    if mode == 'halving':
+        return {'C': log_grid(1., 1e4, 9), 'epsilon': log_grid(0.1, 1., 3)}
+    return {'C': [10., 100., 1000.]}
 
-def separate_features_into_lists(features):
-    """ makes separate lists of MQN features and MD3D features """
-    mqn = []
-    md3d = []
-    for feature in features:
-        if feature in ['pmi1', 'pmi2', 'pmi3', 'rmd02', 'rmd24', 'rmd46', 'rmd68', 'rmd8p']:
-            md3d.append(feature)
-        else:
-            mqn.append(feature)
-    return mqn, md3d
+
+def train_svr(X, y, mode=SEARCH_MODE, n_jobs=-1):
+    """ trains an SVR using X and y data, returns the trained model instance """
+    gs = search(SVR(cache_size=2048, tol=5e-3, kernel='rbf', gamma='scale'), svr_param_grid(mode), X, y, mode=mode,
+                cv=3, n_jobs=n_jobs, random_state=SEED)
+    return gs.best_estimator_
 
 
-def gen_rmse_data(features):
-    """ sequentially removes features in order of increasing feature importance """
-    rmses = []
-    data = DMD('DMIM_v1.0.db', SEED)
+def gen_rmse_data(features, mode='ranked', checkpoint=None):
+    """ removes features one at a time, in order of increasing feature importance ('ranked', features are ordered
+        from most to least important) or by recursive elimination ('recursive'), and fits an SVR on the remaining
+        features at each step, the fits run in parallel and are saved to checkpoint (see feature_elimination.py)
+        returns: features in reverse order of removal, RMSE using the first 1, 2, ... of them """
+    db_fname = 'DMIM_v1.0.db'
+    data = DMD(db_fname, SEED)
     data.featurize('combined')
     data.train_test_split()
     data.center_and_scale()
-    rmses.append(rmse(data.y_train_, train_svr(data.X_train_ss_, data.y_train_).predict(data.X_train_ss_)))
-
-    while len(features) > 1:
-        features = features[:-1]
-        print(' '.join([_ for _ in features]))
-        data = DMD('DMIM_v1.0.db', SEED)
-        mqns, md3ds = separate_features_into_lists(features)
-        data.featurize('custom', custom_mqns=mqns, custom_md3ds=md3ds)
-        data.train_test_split()
-        data.center_and_scale()
-        rmses.append(rmse(data.y_train_, train_svr(data.X_train_ss_, data.y_train_).predict(data.X_train_ss_)))
-
-    return array(rmses)[::-1]
-
-
-
-def report_comb_feat_imp(feat_imp, label):
+    # results in the checkpoint are only reused if they were fit the same way on the same training data
+    header = {
+        'search_mode': SEARCH_MODE,
+        'param_grid': svr_param_grid(SEARCH_MODE),
+        'db': os.path.abspath(db_fname),
+        'db_mtime': os.path.getmtime(db_fname),
+        'seed': SEED,
+        'n_train': data.n_train_,
+    }
+    # each fit runs in its own worker process, so the CV within each fit is not parallelized
+    with EliminationPool(data.X_train_ss_, data.y_train_, COMB_FEATURES, partial(train_svr, n_jobs=1),
+                         checkpoint=Checkpoint(checkpoint, header=header)) as pool:
+        if mode == 'recursive':
+            steps = recursive_elimination(pool, features)
+        else:
+            steps = ranked_elimination(pool, features)
+        rmses = {}
+        for kept, rmse in steps:
+            print('{:.3f}'.format(rmse), ' '.join(kept))
+            rmses[len(kept)] = (kept, rmse)
+
+    if mode == 'recursive':
+        # the last feature remaining, then the features in reverse order of removal
+        order = list(rmses[1][0])
+        for k in range(2, len(features) + 1):
+            order += [f for f in rmses[k][0] if f not in order]
+    else:
+        order = list(features)
+    return order, array([rmses[k][1] for k in range(1, len(features) + 1)])
+
+
+def report_comb_feat_imp(feat_imp, label, mode='ranked'):
     """ print feature importances in order of descending absolute magnitude, make a plot """
     idx = argsort(feat_imp)[::-1]
-    labels = array([
-        'c', 'f', 'cl', 'br',
-        'i', 's', 'p', 'an',
-        'cn', 'ao', 'co', 'hac',
-        'hbam', 'hba', 'hbdm',
-        'hbd', 'neg', 'pos',
-        'asb', 'adb', 'atb', 'csb',
-        'cdb', 'ctb', 'rbc',
-        'asv', 'adv', 'atv', 'aqv',
-        'cdv', 'ctv', 'cqv', 'r3',
-        'r4', 'r5', 'r6', 'r7',
-        'r8', 'r9', 'rg10', 
-        'afr', 'bfr' 
-    ] + ['pmi1', 'pmi2', 'pmi3', 'rmd02', 'rmd24', 'rmd46', 'rmd68', 'rmd8p'])
+    labels = array(COMB_FEATURES)
     #print('feature importance')
     #print(labels[idx])
 
-    # make the RMSE data by sequentially removing features from the end of the list 
-    rmse = gen_rmse_data(labels[idx])
+    # make the RMSE data by sequentially removing features from the end of the list (or by recursive elimination),
+    # rerunning with the same checkpoint file only refits the steps that are missing from it
+    order, rmse = gen_rmse_data(labels[idx], mode=mode, checkpoint='DMIM_COMB_{}_seq_feat_rem.jsonl'.format(label))
+    idx = array([COMB_FEATURES.index(f) for f in order])
     #rmse = [10 for _ in range(10)] + [1 for _ in range(40)]  # dummy RMSE data
 
     # plot the loadings
@@ -0,0 +1 @@
+../model_bundle.py
\ No newline at end of file
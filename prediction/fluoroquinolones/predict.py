@@ -5,12 +5,45 @@
 
 from pickle import load as pload
 from numpy import loadtxt, savetxt
+import os
 import sys
 
 from DmimData.data import DMD
+from model_bundle import CCSModel
 #from helpers import featurize
 
 
+# directory with the model bundles saved by train_mqn_md3d_svr.py (or convert_models.py)
+MODEL_DIR = '..'
+
+# DB the legacy models were trained on (used to refit their scalers when there is no bundle)
+DB_FNAME = 'DMIM_v1.0.db'
+
+# models to predict with: (label, file label, feature set, custom MQNs, custom MD3Ds)
+MODELS = [
+    ('cust', 'CUST', 'custom', ['hac', 'c', 'adb', 'asv', 'ctv', 'hbam', 'hbd'], ['pmi1', 'pmi2', 'pmi3', 'rmd02']),
+    ('mqn', 'MQN', 'mqn', None, None),
+    ('md3d', 'MD3D', 'md3d', None, None),
+    ('comb', 'COMB', 'combined', None, None),
+]
+
+
+def legacy_predict(label, features, custom_mqns, custom_md3ds, X):
+    """ predicts with {label}_svr_seed420.pickle, refitting its scaler on the training set from the DB (the way
+        predictions were made before there were model bundles)
+        returns: predicted CCS, or None if the SVR pickle or the DB is missing """
+    svr_fname = '{}_svr_seed420.pickle'.format(label)
+    if not os.path.isfile(svr_fname) or not os.path.isfile(DB_FNAME):
+        return None
+    data = DMD(DB_FNAME, 420)
+    data.featurize(features, custom_mqns=custom_mqns, custom_md3ds=custom_md3ds)
+    data.train_test_split()
+    data.center_and_scale()
+    with open(svr_fname, 'rb') as pf:
+        svr = pload(pf)
+    return svr.predict(data.SScaler_.transform(X))
+
+
 def main():
     """ main execution sequence """
     """
@@ -26,49 +59,23 @@ def main():
 
     cmpd = sys.argv[1]
 
-
-    X = loadtxt('{}_X_CUST.txt'.format(cmpd))
-    cust = DMD('DMIM_v1.0.db', 420)
-    cust.featurize('custom', custom_mqns=['hac', 'c', 'adb', 'asv', 'ctv', 'hbam', 'hbd'], custom_md3ds=['pmi1', 'pmi2', 'pmi3', 'rmd02'])
-    cust.train_test_split()
-    cust.center_and_scale()
-    X_ss = cust.SScaler_.transform(X)
-    with open('cust_svr_seed420.pickle', 'rb') as pf:
-        svr = pload(pf)
-    savetxt('{}_y_CUST.txt'.format(cmpd), svr.predict(X_ss))
-
-
-    X = loadtxt('{}_X_MQN.txt'.format(cmpd))
-    mqn = DMD('DMIM_v1.0.db', 420)
-    mqn.featurize('mqn')
-    mqn.train_test_split()
-    mqn.center_and_scale()
-    X_ss = mqn.SScaler_.transform(X)
-    with open('mqn_svr_seed420.pickle', 'rb') as pf:
-        svr = pload(pf)
-    savetxt('{}_y_MQN.txt'.format(cmpd), svr.predict(X_ss))
-
-
-    X = loadtxt('{}_X_MD3D.txt'.format(cmpd))
-    md3d = DMD('DMIM_v1.0.db', 420)
-    md3d.featurize('md3d')
-    md3d.train_test_split()
-    md3d.center_and_scale()
-    X_ss = md3d.SScaler_.transform(X)
-    with open('md3d_svr_seed420.pickle', 'rb') as pf:
-        svr = pload(pf)
-    savetxt('{}_y_MD3D.txt'.format(cmpd), svr.predict(X_ss))
-
-
-    X = loadtxt('{}_X_COMB.txt'.format(cmpd))
-    comb = DMD('DMIM_v1.0.db', 420)
-    comb.featurize('combined')
-    comb.train_test_split()
-    comb.center_and_scale()
-    X_ss = comb.SScaler_.transform(X)
-    with open('comb_svr_seed420.pickle', 'rb') as pf:
-        svr = pload(pf)
-    savetxt('{}_y_COMB.txt'.format(cmpd), svr.predict(X_ss))
+    # the model bundles contain the scalers fit on the training sets, so the DB is not needed, models that do not
+    # have a bundle yet (see train_mqn_md3d_svr.py and convert_models.py) fall back to the legacy SVR pickles
+    missing = []
+    for label, fl, features, custom_mqns, custom_md3ds in MODELS:
+        X = loadtxt('{}_X_{}.txt'.format(cmpd, fl), ndmin=2)
+        fname = os.path.join(MODEL_DIR, '{}_ccs_model_seed420.pickle'.format(label))
+        if os.path.isfile(fname):
+            y = CCSModel.load(fname).predict(X)
+        else:
+            y = legacy_predict(label, features, custom_mqns, custom_md3ds, X)
+        if y is None:
+            missing.append(fl)
+            continue
+        savetxt('{}_y_{}.txt'.format(cmpd, fl), y)
+    if missing:
+        msg = 'no {} model: needs a bundle in {} or the legacy SVR pickle and {}'
+        sys.exit(msg.format(', '.join(missing), MODEL_DIR, DB_FNAME))
 
 
 if __name__ == '__main__':
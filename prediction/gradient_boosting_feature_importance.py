@@ -5,27 +5,32 @@
 
 from time import time
 from sklearn.ensemble import GradientBoostingRegressor
-from sklearn.model_selection import GridSearchCV
 from matplotlib import pyplot as plt, rcParams
 from numpy import argsort, array, log10, mean, std, savetxt
 
 from DmimData.data import DMD
 from metrics import rmse
+from param_search import search
 
 
 # define a global pRNG seed
 SEED = 420
 
+# hyperparameter search mode, 'grid' (exhaustive, coarse grid) or 'halving' (successive halving, finer grid)
+SEARCH_MODE = 'grid'
+
 # set the global fontsize on plots
 rcParams['font.size'] = 8
 
 
-def trial(X, y, seed):
+def trial(X, y, seed, mode=SEARCH_MODE):
     """ trains an SVR, returns the RMSE """
-    pg = {'n_estimators': [10, 30,100], 'max_depth': [2, 3, 4]}
+    if mode == 'halving':
+        pg = {'n_estimators': [10, 30, 100, 300], 'max_depth': [2, 3, 4, 5, 6], 'learning_rate': [0.03, 0.1, 0.3]}
+    else:
+        pg = {'n_estimators': [10, 30,100], 'max_depth': [2, 3, 4]}
     est = GradientBoostingRegressor(random_state=seed, tol=1e-2, max_features='auto')
-    gs = GridSearchCV(est, param_grid=pg, cv=3, n_jobs=-1, scoring='neg_mean_squared_error')
-    gs.fit(X, y)
+    gs = search(est, pg, X, y, mode=mode, cv=3, n_jobs=-1, random_state=seed)
     #print(gs.best_params_)
     return rmse(y, gs.best_estimator_.predict(X)), gs.best_estimator_.feature_importances_
 
@@ -87,6 +92,7 @@ def complete_feature_importance_trials(n_trials):
         data.featurize('combined')
         data.train_test_split()
         data.center_and_scale()
+        data.share_arrays()  # shared with the GridSearchCV workers
         rmse, feat_imp = trial(data.X_train_ss_, data.y_train_, seed)
         print('\tRMSE: {:.3f}'.format(rmse))
         print('\t{:.2f} seconds'.format(time() - t_start))
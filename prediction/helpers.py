@@ -4,17 +4,28 @@
 
 from numpy import array, concatenate
 
-from build.add_mqns import smi_to_mqn
-from build.add_md3d import compute_3d_descriptors
+from build.add_mqns import cached_mqns
+from build.add_md3d import compute_3d_descriptors_batch
+from build.descriptor_cache import default_cache
 
 
-def featurize(smis, structures, custom_mqns, custom_md3ds):
+def featurize(smis, structures, custom_mqns, custom_md3ds, n_workers=None, cache='default'):
     """ computes features the same way as in DmimData.data.DMD with the 'custom' kwarg
         smis is a list of SMILES structures
-        structures is a list of 3D structures (xyzmq format, text) """
+        structures is a list of 3D structures (xyzmq format, text)
+        n_workers is the number of processes used to compute MQNs (None to use the number of CPUs)
+        cache is the DescriptorCache used to avoid recomputing descriptors ('default' to use the default cache, see
+        build/descriptor_cache.py, None to compute everything) """
+    if cache == 'default':
+        cache = default_cache()
     # generate the complete set of descriptors first
-    mqns = array([smi_to_mqn(smi) for smi in smis])
-    md3ds = array([compute_3d_descriptors(structure) for structure in structures])
+    errors = []
+    mqns = array([mqn for _, mqn in cached_mqns(enumerate(smis), cache, n_workers=n_workers, errors=errors)])
+    if errors:
+        i, err = errors[0]
+        msg = 'featurize: unable to compute MQNs for {} SMILES structure(s), first was {} ({})'
+        raise ValueError(msg.format(len(errors), smis[i], err))
+    md3ds = compute_3d_descriptors_batch(structures, cache=cache)
     X = concatenate([mqns, md3ds], axis=1)
     mq2i = {
         'c': 0, 'f': 1, 'cl': 2, 'br': 3, 
@@ -0,0 +1,117 @@
+"""
+    Hyperparameter search for RBF SVRs using precomputed kernels
+
+    GridSearchCV refits an SVR from scratch for every combination of parameters and CV fold, and libsvm recomputes
+    the RBF kernel for each fit even though it only depends on gamma (and the fold). RBFGridSearchCV computes the
+    Gram matrices of each fold once per gamma (in blocks of rows) and fits every other combination of parameters
+    (C, epsilon, ...) with kernel='precomputed' on them, the (fold, gamma) pairs are run in parallel. The CV splits,
+    scoring (negative MSE), parameter order and tie breaking are the same as GridSearchCV, and the best estimator is
+    refit on all of the data as a regular RBF SVR, so it can be used as a drop-in replacement. The CV scores agree
+    with GridSearchCV to within the tolerance of the libsvm solver (tol), so the same parameters are selected unless
+    two of them score within that tolerance of each other.
+"""
+
+from joblib import Parallel, delayed
+from numpy import asarray, empty, exp, maximum, argmax, mean, std, einsum
+from sklearn.base import clone
+from sklearn.metrics import mean_squared_error
+from sklearn.model_selection import ParameterGrid, check_cv
+
+
+def rbf_gram(X, Y, gamma, block_size=2048):
+    """ RBF kernel between the rows of X and Y, exp(-gamma * |x - y|^2), computed block_size rows of X at a time
+        returns: array with shape (len(X), len(Y)) """
+    xx = einsum('ij,ij->i', X, X)
+    yy = einsum('ij,ij->i', Y, Y)
+    K = empty((len(X), len(Y)))
+    for i in range(0, len(X), block_size):
+        block = K[i:i + block_size]
+        block[:] = xx[i:i + block_size, None] + yy[None, :] - 2. * (X[i:i + block_size] @ Y.T)
+        # rounding can make the squared distances slightly negative
+        maximum(block, 0., out=block)
+        block *= -gamma
+        exp(block, out=block)
+    return K
+
+
+def resolve_gamma(gamma, X):
+    """ numeric value of gamma for an RBF kernel on training data X (same as sklearn.svm.SVR) """
+    if gamma == 'scale':
+        return 1. / (X.shape[1] * X.var())
+    if gamma == 'auto':
+        return 1. / X.shape[1]
+    return gamma
+
+
+def _gamma_scores(estimator, X, y, train, test, gamma, grid, block_size):
+    """ scores parameter combinations that share the same gamma on one CV fold, using one pair of Gram matrices
+        returns: negative MSE on the test samples, in the same order as grid """
+    X_tr, X_te, y_tr, y_te = X[train], X[test], y[train], y[test]
+    g = resolve_gamma(gamma, X_tr)
+    K_tr, K_te = rbf_gram(X_tr, X_tr, g, block_size=block_size), rbf_gram(X_te, X_tr, g, block_size=block_size)
+    scores = []
+    for params in grid:
+        params = {k: v for k, v in params.items() if k != 'gamma'}
+        est = clone(estimator).set_params(kernel='precomputed', **params)
+        est.fit(K_tr, y_tr)
+        scores.append(-mean_squared_error(y_te, est.predict(K_te)))
+    return scores
+
+
+class RBFGridSearchCV:
+    """ exhaustive search over a parameter grid for an RBF SVR, using precomputed Gram matrices (see module docstring)
+        attributes after fit (same meaning as with GridSearchCV): cv_results_, best_index_, best_params_,
+        best_score_, best_estimator_ """
+
+    def __init__(self, estimator, param_grid, cv=5, n_jobs=None, block_size=2048):
+        """
+            estimator - SVR with kernel='rbf', used as the template for every fit
+            param_grid - dict (or list of dicts) of parameters to search, as with GridSearchCV
+            cv - number of folds (KFold without shuffling, as GridSearchCV does for regressors) or CV splitter
+            n_jobs - number of (CV fold, gamma) pairs scored in parallel (None for 1, -1 for all CPUs)
+            block_size - number of rows per block when computing the Gram matrices
+        """
+        if getattr(estimator, 'kernel', None) != 'rbf':
+            raise ValueError('RBFGridSearchCV: estimator must have kernel="rbf"')
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.block_size = block_size
+
+    def fit(self, X, y):
+        """ runs the search and refits the best estimator on all of X, y
+            returns: self """
+        X, y = asarray(X, dtype=float), asarray(y, dtype=float)
+        grid = list(ParameterGrid(self.param_grid))
+        folds = list(check_cv(self.cv, y, classifier=False).split(X, y))
+        # group the parameter combinations by gamma so each Gram matrix is only computed once per fold
+        by_gamma = {}
+        for i, params in enumerate(grid):
+            by_gamma.setdefault(params.get('gamma', self.estimator.gamma), []).append(i)
+        tasks = [(k, idx, train, test, gamma) for k, (train, test) in enumerate(folds)
+                 for gamma, idx in by_gamma.items()]
+        results = Parallel(n_jobs=self.n_jobs)(
+            delayed(_gamma_scores)(self.estimator, X, y, train, test, gamma, [grid[i] for i in idx], self.block_size)
+            for _, idx, train, test, gamma in tasks
+        )
+        fold_scores = empty((len(folds), len(grid)))
+        for (k, idx, _, _, _), scores in zip(tasks, results):
+            fold_scores[k, idx] = scores
+        self.cv_results_ = {
+            'params': grid,
+            'mean_test_score': mean(fold_scores, axis=0),
+            'std_test_score': std(fold_scores, axis=0),
+        }
+        for k, s in enumerate(fold_scores):
+            self.cv_results_['split{}_test_score'.format(k)] = s
+        # first of the best scores, same tie breaking as GridSearchCV
+        self.best_index_ = int(argmax(self.cv_results_['mean_test_score']))
+        self.best_params_ = grid[self.best_index_]
+        self.best_score_ = self.cv_results_['mean_test_score'][self.best_index_]
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(X, y)
+        return self
+
+    def predict(self, X):
+        """ predictions of the best estimator """
+        return self.best_estimator_.predict(X)
@@ -0,0 +1,147 @@
+"""
+    Self-contained CCS prediction models
+
+    A CCSModel bundles everything needed to go from raw (unscaled) feature vectors to predicted CCS values: the
+    ordered names of the features (see DmimData.data.feature_names), the centering/scaling parameters of the
+    StandardScaler fit on the training set, the fitted model and some metadata about how it was trained. Bundles are
+    saved as a single versioned pickle file, so predicting no longer needs the DMIM database (and rebuilding a DMD
+    just to refit the scaler). RBF SVRs are stored as plain arrays (support vectors, dual coefficients, intercept
+    and gamma) and evaluated with numpy, so loading one does not import sklearn and takes milliseconds, any other
+    estimator is pickled as is.
+"""
+
+import os
+import pickle
+from datetime import datetime
+
+from numpy import asarray, einsum, empty, exp, maximum
+
+
+# identifies bundle files, increment BUNDLE_VERSION whenever the contents of a bundle change
+BUNDLE_FORMAT = 'dmim_ccs_model'
+BUNDLE_VERSION = 1
+
+
+def _model_params(model):
+    """ arrays needed to evaluate an RBF SVR (the estimator itself for anything else)
+        returns: dict """
+    if type(model).__name__ == 'SVR' and model.kernel == 'rbf':
+        return {
+            'kind': 'rbf_svr',
+            'support_vectors': asarray(model.support_vectors_, dtype=float),
+            'dual_coef': asarray(model.dual_coef_, dtype=float).ravel(),
+            'intercept': float(model.intercept_[0]),
+            # numeric value of gamma (resolved from 'scale' or 'auto' when the SVR was fit)
+            'gamma': float(model._gamma),
+        }
+    return {'kind': 'estimator', 'estimator': model}
+
+
+def _rbf_svr_predict(params, X, block_size=2048):
+    """ predictions of an RBF SVR from its arrays (same as SVR.predict), block_size rows of X at a time
+        returns: array with shape (len(X),) """
+    sv, gamma = params['support_vectors'], params['gamma']
+    sv_sq = einsum('ij,ij->i', sv, sv)
+    y = empty(len(X))
+    for i in range(0, len(X), block_size):
+        Xb = X[i:i + block_size]
+        K = einsum('ij,ij->i', Xb, Xb)[:, None] + sv_sq[None, :] - 2. * (Xb @ sv.T)
+        # rounding can make the squared distances slightly negative
+        maximum(K, 0., out=K)
+        K *= -gamma
+        exp(K, out=K)
+        y[i:i + block_size] = K @ params['dual_coef'] + params['intercept']
+    return y
+
+
+class CCSModel:
+    """ CCS prediction model with its feature spec and scaling (see module docstring) """
+
+    def __init__(self, feature_names, mean, scale, model, metadata=None):
+        """
+            feature_names - names of the features, in the order they are expected in the columns of X
+            mean, scale - centering/scaling of each feature (StandardScaler.mean_ and .scale_)
+            model - fitted estimator (an SVR or anything with a predict method) or the dict from _model_params
+            metadata - dict with information about the model (training data, parameters, metrics, ...)
+        """
+        self.feature_names = [str(name) for name in feature_names]
+        self.mean = asarray(mean, dtype=float)
+        self.scale = asarray(scale, dtype=float)
+        self.model = model if isinstance(model, dict) else _model_params(model)
+        self.metadata = dict(metadata) if metadata is not None else {}
+        if self.mean.shape != (len(self.feature_names),) or self.scale.shape != self.mean.shape:
+            msg = 'CCSModel: scaler parameters have shape {} and {} but there are {} features'
+            raise ValueError(msg.format(self.mean.shape, self.scale.shape, len(self.feature_names)))
+
+    @classmethod
+    def from_dmd(cls, data, model, **metadata):
+        """ bundles a model trained on a DMD, after data.featurize(...), data.train_test_split(...) and
+            data.center_and_scale(), any keyword arguments are added to the metadata (e.g. parameters, metrics)
+            returns: CCSModel """
+        from sklearn import __version__ as sklearn_version
+        meta = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'sklearn_version': sklearn_version,
+            'db': os.path.basename(data.db_path_),
+            'seed': data.seed_,
+            'features': data.features_,
+            'n_train': data.n_train_,
+            'n_test': data.n_test_,
+        }
+        meta.update(metadata)
+        return cls(data.feature_names_, data.SScaler_.mean_, data.SScaler_.scale_, model, metadata=meta)
+
+    @property
+    def n_features(self):
+        """ number of features """
+        return len(self.feature_names)
+
+    def transform(self, X):
+        """ centers/scales raw features, same as StandardScaler.transform
+            returns: array with shape (n, n_features) """
+        X = asarray(X, dtype=float)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features:
+            msg = 'CCSModel: expected {} features ({}), got {}'
+            raise ValueError(msg.format(self.n_features, ', '.join(self.feature_names), X.shape[1]))
+        return (X - self.mean) / self.scale
+
+    def predict(self, X):
+        """ predicts CCS from raw (unscaled) features, X has one row per structure with the features in the order of
+            self.feature_names
+            returns: array of predicted CCS """
+        X_ss = self.transform(X)
+        if self.model['kind'] == 'rbf_svr':
+            return _rbf_svr_predict(self.model, X_ss)
+        return self.model['estimator'].predict(X_ss)
+
+    def save(self, fname):
+        """ saves the bundle to fname (written to a temporary file first, so an existing bundle is never left
+            partially overwritten) """
+        bundle = {
+            'format': BUNDLE_FORMAT,
+            'version': BUNDLE_VERSION,
+            'feature_names': self.feature_names,
+            'mean': self.mean,
+            'scale': self.scale,
+            'model': self.model,
+            'metadata': self.metadata,
+        }
+        with open(fname + '.tmp', 'wb') as pf:
+            pickle.dump(bundle, pf, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fname + '.tmp', fname)
+
+    @classmethod
+    def load(cls, fname):
+        """ loads a bundle saved with CCSModel.save
+            returns: CCSModel """
+        with open(fname, 'rb') as pf:
+            bundle = pickle.load(pf)
+        if not isinstance(bundle, dict) or bundle.get('format') != BUNDLE_FORMAT:
+            raise ValueError('CCSModel.load: {} is not a CCS model bundle'.format(fname))
+        if bundle['version'] != BUNDLE_VERSION:
+            msg = 'CCSModel.load: {} has bundle version {}, expected {}'
+            raise ValueError(msg.format(fname, bundle['version'], BUNDLE_VERSION))
+        return cls(bundle['feature_names'], bundle['mean'], bundle['scale'], bundle['model'],
+                   metadata=bundle['metadata'])
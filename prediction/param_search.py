@@ -0,0 +1,53 @@
+"""
+    Common interface for the hyperparameter searches used by the prediction scripts
+
+    search(...) runs either an exhaustive search ('grid', the same search as GridSearchCV, or RBFGridSearchCV for RBF
+    SVRs, see kernel_search.py) or a successive halving search ('halving', HalvingGridSearchCV). Successive halving
+    scores every candidate on a small random subset of the training data, keeps the best 1/factor of them and
+    repeats with factor times as much data, so only a few candidates are ever fit on all of the data. A grid with
+    many more combinations (e.g. log-scaled C/gamma/epsilon from log_grid(...)) can then be searched in about the same
+    time as a coarse exhaustive grid. Both modes use negative MSE as the score and return a fitted search object with
+    the usual best_params_, best_score_ and best_estimator_ attributes.
+"""
+
+from numpy import logspace, log10
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (required to import HalvingGridSearchCV)
+from sklearn.model_selection import GridSearchCV, HalvingGridSearchCV
+
+from kernel_search import RBFGridSearchCV
+
+
+# supported search modes
+SEARCH_MODES = ['grid', 'halving']
+
+
+def log_grid(low, high, n):
+    """ n values evenly spaced on a log scale from low to high (inclusive)
+        returns: list of float """
+    return [float(v) for v in logspace(log10(low), log10(high), n)]
+
+
+def search(estimator, param_grid, X, y, mode='grid', cv=5, n_jobs=-1, factor=3, random_state=None):
+    """ searches param_grid for the parameters of estimator that minimize the CV MSE, then refits the best estimator
+        on all of X, y
+
+        estimator - estimator used as the template for every fit
+        param_grid - dict (or list of dicts) of parameters to search, as with GridSearchCV
+        mode - 'grid' for an exhaustive search or 'halving' for successive halving
+        cv - number of folds or CV splitter
+        n_jobs - number of fits run in parallel (None for 1, -1 for all CPUs)
+        factor - ('halving' only) fraction of candidates kept (1 / factor) and growth of the training subset at each
+                 iteration
+        random_state - ('halving' only) seed for drawing the training subsets
+        returns: fitted search object (best_params_, best_score_, best_estimator_, cv_results_) """
+    if mode not in SEARCH_MODES:
+        raise ValueError('search: mode "{}" invalid, must be one of {}'.format(mode, SEARCH_MODES))
+    if mode == 'halving':
+        gs = HalvingGridSearchCV(estimator, param_grid, factor=factor, resource='n_samples', cv=cv, n_jobs=n_jobs,
+                                 scoring='neg_mean_squared_error', random_state=random_state)
+    elif getattr(estimator, 'kernel', None) == 'rbf':
+        # same search as GridSearchCV(..., scoring='neg_mean_squared_error'), reusing the RBF Gram matrices
+        gs = RBFGridSearchCV(estimator, param_grid=param_grid, cv=cv, n_jobs=n_jobs)
+    else:
+        gs = GridSearchCV(estimator, param_grid=param_grid, cv=cv, n_jobs=n_jobs, scoring='neg_mean_squared_error')
+    return gs.fit(X, y)
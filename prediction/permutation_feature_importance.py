@@ -8,6 +8,7 @@ from pickle import load as pload
 from sklearn.inspection import permutation_importance
 
 from DmimData.data import DMD
+from DmimData.shared_arrays import shared_array
 
 
 # define a global pRNG seed
@@ -70,7 +71,8 @@ def main():
     data.featurize('combined')
     data.train_test_split()
     data.center_and_scale()
-    X = data.SScaler_.transform(data.X_)
+    # shared with the permutation_importance workers
+    X = shared_array(data.SScaler_.transform(data.X_), 'X_ss')
     y = data.y_
 
     with open('comb_svr_seed420.pickle', 'rb') as pf:
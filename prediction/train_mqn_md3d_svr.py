@@ -4,26 +4,51 @@
 """
 
 from sklearn.svm import SVR
-from sklearn.model_selection import GridSearchCV
 from pickle import dump
 
 from DmimData.data import DMD
+from param_search import search, log_grid
 from metrics import all_metrics
+from model_bundle import CCSModel
 
 
 # define a global pRNG seed
 SEED = 420
 
+# hyperparameter search mode, 'grid' (exhaustive, coarse grid) or 'halving' (successive halving, finer grid)
+SEARCH_MODE = 'grid'
 
-def train_svr(X, y):
+# MQNs and MD3Ds in the 'custom' feature set
+CUSTOM_MQNS = ['hac', 'c', 'adb', 'asv', 'ctv', 'hbam', 'hbd']
+CUSTOM_MD3DS = ['pmi1', 'pmi2', 'pmi3', 'rmd02']
+
+
+def train_svr(X, y, mode=SEARCH_MODE):
     """ trains an SVR using X and y data, returns the trained model instance """
-    pg = {'C': [10., 100., 1000.], 'gamma': ['scale', 0.001, 0.01, 0.1]}
-    gs = GridSearchCV(SVR(cache_size=2048, tol=5e-4, kernel='rbf'), param_grid=pg, n_jobs=-1, cv=5, scoring='neg_mean_squared_error', )
-    gs.fit(X, y)
+    if mode == 'halving':
+        pg = {'C': log_grid(1., 1e4, 9), 'gamma': ['scale'] + log_grid(1e-4, 1e-1, 7), 'epsilon': log_grid(0.1, 1., 3)}
+    else:
+        pg = {'C': [10., 100., 1000.], 'gamma': ['scale', 0.001, 0.01, 0.1]}
+    gs = search(SVR(cache_size=2048, tol=5e-4, kernel='rbf'), pg, X, y, mode=mode, cv=5, n_jobs=-1,
+                random_state=SEED)
     print('best params:', gs.best_params_)
     return gs.best_estimator_
 
 
+def save_model(data, svr, label):
+    """ saves the fitted SVR and the scaler fit on the training set, along with a self-contained model bundle
+        (see model_bundle.py) with both of them, the feature names and the training set/test set metrics """
+    with open('{}_svr_seed420.pickle'.format(label), 'wb') as pf:
+        dump(svr, pf)
+    with open('{}_scaler_seed420.pickle'.format(label), 'wb') as pf:
+        dump(data.SScaler_, pf)
+    params = {k: v for k, v in svr.get_params().items() if k in ['C', 'gamma', 'epsilon']}
+    model = CCSModel.from_dmd(data, svr, params=params,
+                              train_metrics=all_metrics(data.y_train_, svr.predict(data.X_train_ss_)),
+                              test_metrics=all_metrics(data.y_test_, svr.predict(data.X_test_ss_)))
+    model.save('{}_ccs_model_seed420.pickle'.format(label))
+
+
 def main():
     """ main execution sequence """
 
@@ -37,6 +62,7 @@ def main():
     mqn.featurize('mqn')
     mqn.train_test_split()
     mqn.center_and_scale()
+    mqn.share_arrays()  # shared with the GridSearchCV workers
     print('training SVR using MQNs ...')
     mqn_svr = train_svr(mqn.X_train_ss_, mqn.y_train_)
     print('training set:')
@@ -44,12 +70,8 @@ def main():
     print('test set:')
     print(all_metrics(mqn.y_test_, mqn_svr.predict(mqn.X_test_ss_)))
     print()
-    # save the fitted SVR
-    with open('mqn_svr_seed420.pickle', 'wb') as pf:
-        dump(mqn_svr, pf)
-    # and save the scaler
-    with open('mqn_scaler_seed420.pickle', 'wb') as pf:
-        dump(mqn.SScaler_, pf)
+    # save the fitted SVR, the scaler and the model bundle
+    save_model(mqn, mqn_svr, 'mqn')
 
 
     # setup DmimData instance (using MD3Ds)
@@ -57,6 +79,7 @@ def main():
     md3d.featurize('md3d')
     md3d.train_test_split()
     md3d.center_and_scale()
+    md3d.share_arrays()  # shared with the GridSearchCV workers
     print('training SVR using MD3Ds ...')
     md3d_svr = train_svr(md3d.X_train_ss_, md3d.y_train_)
     print('training set:')
@@ -64,19 +87,15 @@ def main():
     print('test set:')
     print(all_metrics(md3d.y_test_, md3d_svr.predict(md3d.X_test_ss_)))
     print()
-    # save the fitted SVR
-    with open('md3d_svr_seed420.pickle', 'wb') as pf:
-        dump(md3d_svr, pf)
-    # and save the scaler
-    with open('md3d_scaler_seed420.pickle', 'wb') as pf:
-        dump(md3d.SScaler_, pf)
-
-    """
+    # save the fitted SVR, the scaler and the model bundle
+    save_model(md3d, md3d_svr, 'md3d')
+
     # setup DmimData instance (using combined MQNs and MD3Ds)
     comb = DMD('DMIM_v1.0.db', SEED)
     comb.featurize('combined')
     comb.train_test_split()
     comb.center_and_scale()
+    comb.share_arrays()  # shared with the GridSearchCV workers
     print('training SVR using combined MQNs and MD3Ds ...')
     comb_svr = train_svr(comb.X_train_ss_, comb.y_train_)
     print('training set:')
@@ -84,18 +103,17 @@ def main():
     print('test set:')
     print(all_metrics(comb.y_test_, comb_svr.predict(comb.X_test_ss_)))
     print()
-    # save the fitted SVR
-    with open('comb_svr_seed420.pickle', 'wb') as pf:
-        dump(comb_svr, pf)
-    """
+    # save the fitted SVR, the scaler and the model bundle
+    save_model(comb, comb_svr, 'comb')
 
 
 
     # setup DmimData instance (using combined MQNs and MD3Ds)
     cust = DMD('DMIM_v1.0.db', SEED)
-    cust.featurize('custom', custom_mqns=['hac', 'c', 'adb', 'asv', 'ctv', 'hbam', 'hbd'], custom_md3ds=['pmi1', 'pmi2', 'pmi3', 'rmd02'])
+    cust.featurize('custom', custom_mqns=CUSTOM_MQNS, custom_md3ds=CUSTOM_MD3DS)
     cust.train_test_split()
     cust.center_and_scale()
+    cust.share_arrays()  # shared with the GridSearchCV workers
     print('training SVR using custom MQNs and MD3Ds ...')
     cust_svr = train_svr(cust.X_train_ss_, cust.y_train_)
     print('training set:')
@@ -103,12 +121,8 @@ def main():
     print('test set:')
     print(all_metrics(cust.y_test_, cust_svr.predict(cust.X_test_ss_)))
     print()
-    # save the fitted SVR
-    with open('cust_svr_seed420.pickle', 'wb') as pf:
-        dump(cust_svr, pf)
-    # and save the scaler
-    with open('cust_scaler_seed420.pickle', 'wb') as pf:
-        dump(mqn.SScaler_, pf)
+    # save the fitted SVR, the scaler and the model bundle
+    save_model(cust, cust_svr, 'cust')
     
 
 